@@ -1 +1,2 @@
-from .client import Client
+from .client import AsyncClient, Client
+from .pool import ProxyPool
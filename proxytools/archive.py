@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+"""
+Module for recording fetched pages and replaying them offline.
+
+An archive is an append-only data file of length-prefixed,
+zlib-compressed json records, plus an index file of fixed-size
+(offset, length) entries so records can be read at random and split
+between processes.
+"""
+import json
+import logging
+import mmap
+import multiprocessing
+import os
+import struct
+import time
+import zlib
+
+# Module vars
+_logger = logging.getLogger(__name__)
+
+_LENGTH = struct.Struct('>I')
+_ENTRY = struct.Struct('<QI')
+
+
+class ArchiveError(Exception):
+    """
+    Page archive exception
+    """
+    pass
+
+
+def _index_path(path):
+    return '{}.idx'.format(path)
+
+
+class PageArchive:
+    """
+    Append-only archive of fetched pages.
+    """
+    def __init__(self, path, level=6):
+        """
+        :param path: the archive data file
+        :param level: zlib compression level
+
+        :type path: str
+        :type level: int
+        """
+        self.path = path
+        self.level = level
+        self._recover()
+        self._data = open(path, 'ab')
+        self._index = open(_index_path(path), 'ab')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def _recover(self):
+        """
+        Index records written after the last index entry, and drop
+        partial trailing records and index entries left by an
+        interrupted write.
+        """
+        index_path = _index_path(self.path)
+        if not os.path.exists(self.path):
+            open(self.path, 'wb').close()
+            open(index_path, 'wb').close()
+            return
+        if os.path.exists(index_path):
+            index_size = os.path.getsize(index_path)
+            if index_size % _ENTRY.size:
+                # Appending after a partial entry would misalign every later one
+                _logger.warning('Truncating partial entry in archive index {}'.format(index_path))
+                with open(index_path, 'rb+') as f:
+                    f.truncate(index_size - index_size % _ENTRY.size)
+        try:
+            entries = read_index(self.path)
+        except ArchiveError:
+            entries = []
+        end = entries[-1][0] + entries[-1][1] if entries else 0
+        size = os.path.getsize(self.path)
+        if end == size:
+            return
+        missing = []
+        with open(self.path, 'rb+') as f:
+            f.seek(end)
+            pos = end
+            while pos + _LENGTH.size <= size:
+                length, = _LENGTH.unpack(f.read(_LENGTH.size))
+                if pos + _LENGTH.size + length > size:
+                    break
+                f.seek(length, os.SEEK_CUR)
+                missing.append((pos + _LENGTH.size, length))
+                pos += _LENGTH.size + length
+            if pos != size:
+                _logger.warning('Truncating partial record in archive {}'.format(self.path))
+                f.truncate(pos)
+        with open(index_path, 'ab') as f:
+            for entry in missing:
+                f.write(_ENTRY.pack(*entry))
+
+    def append(self, page, **meta):
+        """
+        Record `page`.
+
+        :param page: the fetched page
+        :param meta: extra fetch metadata
+
+        :type page: proxytools.page.Page
+        """
+        record = {
+            'url': str(page.url),
+            'html': page.html,
+            'timings': page.timings,
+            'fetched_at': time.time()
+        }
+        record.update(meta)
+        data = zlib.compress(json.dumps(record).encode(), self.level)
+        offset = self._data.tell() + _LENGTH.size
+        self._data.write(_LENGTH.pack(len(data)) + data)
+        self._data.flush()
+        self._index.write(_ENTRY.pack(offset, len(data)))
+        self._index.flush()
+
+    def close(self):
+        """
+        Close the archive.
+        """
+        self._data.close()
+        self._index.close()
+
+
+def read_index(path):
+    """
+    Return (offset, length) entries of archive `path`.
+
+    :param path: the archive data file
+    :type path: str
+    :returns: list of tuple
+    """
+    try:
+        with open(_index_path(path), 'rb') as f:
+            data = f.read()
+    except FileNotFoundError:
+        raise ArchiveError('Missing archive index for {}'.format(path))
+    # Ignore a partial trailing entry
+    data = data[:len(data) - len(data) % _ENTRY.size]
+    return list(_ENTRY.iter_unpack(data))
+
+
+class ArchiveReader:
+    """
+    Memory-mapped reader of a page archive.
+    """
+    def __init__(self, path):
+        """
+        :param path: the archive data file
+        :type path: str
+        """
+        self.path = path
+        self.entries = read_index(path)
+        self._file = open(path, 'rb')
+        if os.path.getsize(path):
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self._mmap = b''
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        for offset, length in self.entries:
+            yield self.read(offset, length)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def read(self, offset, length):
+        """
+        Return the record at `offset`.
+
+        :param offset: record offset from the index
+        :param length: record length from the index
+
+        :type offset: int
+        :type length: int
+
+        :returns: dict
+        """
+        return json.loads(zlib.decompress(self._mmap[offset:offset + length]))
+
+    def close(self):
+        """
+        Close the reader.
+        """
+        if isinstance(self._mmap, mmap.mmap):
+            self._mmap.close()
+        self._file.close()
+
+
+# Reader opened once per replay worker process
+_reader = None
+
+
+def _replay_chunk(path, entries):
+    """
+    Parse archived pages `entries` in a replay worker.
+    """
+    # Imported here so spawned workers only load what they need
+    from .parser import ParserError, ProxyParser
+
+    global _reader
+    if _reader is None or _reader.path != path:
+        _reader = ArchiveReader(path)
+    parser = ProxyParser()
+    results = []
+    for offset, length in entries:
+        record = _reader.read(offset, length)
+        start = time.perf_counter()
+        try:
+            proxies = [str(p) for p in parser.parse_proxies(record['html'])]
+            error = None
+        except ParserError as e:
+            proxies = []
+            error = str(e)
+        result = {'url': record['url'], 'proxies': proxies,
+                  'seconds': round(time.perf_counter() - start, 6)}
+        if error:
+            result['error'] = error
+        results.append(result)
+    return results
+
+
+def _replay_star(args):
+    return _replay_chunk(*args)
+
+
+def replay(path, processes=None, chunk_size=64):
+    """
+    Re-run `ProxyParser` over every page in archive `path`.
+
+    Chunks of index entries are parsed in a process pool, each worker
+    memory-mapping the archive. Results are yielded in archive order.
+
+    :param path: the archive data file
+    :param processes: worker processes (defaults to the cpu count)
+    :param chunk_size: pages parsed per task
+
+    :type path: str
+    :type processes: int
+    :type chunk_size: int
+
+    :returns: generator of dict
+    """
+    entries = read_index(path)
+    chunks = [entries[i:i + chunk_size] for i in range(0, len(entries), chunk_size)]
+    if processes == 1:
+        for chunk in chunks:
+            yield from _replay_chunk(path, chunk)
+        return
+    ctx = multiprocessing.get_context('spawn')
+    with ctx.Pool(processes) as pool:
+        for results in pool.imap(_replay_star, [(path, chunk) for chunk in chunks]):
+            yield from results
@@ -0,0 +1,458 @@
+# -*- coding: utf-8 -*-
+"""
+Module for benchmarking the search and test pipeline end to end.
+
+Proxy list sites, forward proxies and the test target are all local
+asyncio servers, so runs are repeatable and measure the pipeline
+rather than the internet.
+"""
+import asyncio
+import logging
+import random
+import socket
+import time
+
+import yarl
+
+from . import httputil
+from .client import AsyncClient
+from .metrics import MetricsRegistry
+from .server import HOP_BY_HOP_HEADERS
+
+# Module vars
+_logger = logging.getLogger(__name__)
+
+TARGET_SELECTOR = '#proxytools-bench'
+TARGET_HTML = ('<!DOCTYPE html><html><head><title>proxytools bench</title></head>'
+               '<body><div id="proxytools-bench">OK</div></body></html>')
+
+ENGINES = ('http', 'browser')
+
+# Chromium sends loopback requests direct unless told otherwise
+BROWSER_ARGS = ['--proxy-bypass-list=<-loopback>']
+
+
+def _respond(writer, status, reason, body=b'', content_type='text/html', keep_alive=True):
+    writer.write('HTTP/1.1 {} {}\r\nContent-Type: {}\r\nContent-Length: {}\r\nConnection: {}\r\n\r\n'
+                 .format(status, reason, content_type, len(body),
+                         'keep-alive' if keep_alive else 'close').encode() + body)
+
+
+def _free_port(host):
+    """
+    Return a port nothing listens on, so connections are refused.
+    """
+    with socket.socket() as sock:
+        sock.bind((host, 0))
+        return sock.getsockname()[1]
+
+
+def _percentile(values, percentile):
+    """
+    Return nearest-rank `percentile` of `values`, None if empty.
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    idx = max(0, min(len(values) - 1, int(round(percentile / 100 * len(values))) - 1))
+    return values[idx]
+
+
+class BenchSites:
+    """
+    Local proxy list sites and test target page.
+
+    Even numbered list pages are plain text, odd numbered ones html
+    tables, so both parser paths are exercised.
+    """
+    def __init__(self, entries, pages=4, host='127.0.0.1'):
+        """
+        :param entries: proxy strings listed across the pages
+        :param pages: number of list pages
+        :param host: interface to listen on
+
+        :type entries: list
+        :type pages: int
+        :type host: str
+        """
+        self.entries = entries
+        self.pages = pages
+        self.host = host
+        self.port = None
+        self.requests = 0
+        self._server = None
+
+    @property
+    def list_urls(self):
+        return ['http://{}:{}/list/{}'.format(self.host, self.port, idx) for idx in range(self.pages)]
+
+    @property
+    def target_url(self):
+        return 'http://{}:{}/target'.format(self.host, self.port)
+
+    def list_page(self, idx):
+        """
+        Return content type and body of list page `idx`.
+
+        :returns: tuple of (str, bytes)
+        """
+        entries = self.entries[idx::self.pages]
+        if idx % 2 == 0:
+            return 'text/plain', '\n'.join(entries).encode()
+        rows = ''.join('<tr><td>{}</td><td>{}</td></tr>'.format(*entry.rsplit(':', 1))
+                       for entry in entries)
+        html = ('<html><body><table><thead><tr><th>IP Address</th><th>Port</th></tr></thead>'
+                '<tbody>{}</tbody></table></body></html>'.format(rows))
+        return 'text/html', html.encode()
+
+    async def start(self):
+        """
+        Start serving.
+        """
+        self._server = await asyncio.start_server(self._handle, self.host, 0)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        """
+        Stop serving.
+        """
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request = await httputil.read_request(reader)
+                except EOFError:
+                    break
+                await httputil.read_body(reader, request)
+                self.requests += 1
+                keep_alive = request.keep_alive()
+                path = yarl.URL(request.target).path
+                if path == '/target':
+                    _respond(writer, 200, 'OK', TARGET_HTML.encode(), keep_alive=keep_alive)
+                elif path.startswith('/list/') and path[6:].isdigit() and int(path[6:]) < self.pages:
+                    content_type, body = self.list_page(int(path[6:]))
+                    _respond(writer, 200, 'OK', body, content_type=content_type, keep_alive=keep_alive)
+                else:
+                    _respond(writer, 404, 'Not Found', keep_alive=keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (httputil.HTTPError, ConnectionError) as e:
+            _logger.debug('Bench site connection error: {}'.format(e))
+        finally:
+            writer.close()
+
+
+class FakeProxy:
+    """
+    Local forward proxy with set latency, drop and failure rates.
+
+    Dropped requests are never answered, failed requests get a 502
+    and the rest are forwarded after `latency` seconds.
+    """
+    def __init__(self, latency=0.05, jitter=0.5, drop_rate=0.0, failure_rate=0.0,
+                 host='127.0.0.1', rng=None):
+        """
+        :param latency: seconds added to each forwarded request
+        :param jitter: random share of `latency` added or removed per request
+        :param drop_rate: share of requests never answered
+        :param failure_rate: share of requests answered with a 502
+        :param host: interface to listen on
+        :param rng: random number generator deciding request fates
+
+        :type latency: float
+        :type jitter: float
+        :type drop_rate: float
+        :type failure_rate: float
+        :type host: str
+        :type rng: random.Random
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.drop_rate = drop_rate
+        self.failure_rate = failure_rate
+        self.host = host
+        self.rng = rng or random.Random()
+        self.port = None
+        self.stats = {'forwarded': 0, 'dropped': 0, 'failed': 0}
+        self._server = None
+
+    def __str__(self):
+        return '{}:{}'.format(self.host, self.port)
+
+    async def start(self):
+        """
+        Start listening.
+        """
+        self._server = await asyncio.start_server(self._handle, self.host, 0)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        """
+        Stop listening.
+        """
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request = await httputil.read_request(reader)
+                except EOFError:
+                    break
+                body, _ = await httputil.read_body(reader, request)
+                fate = self.rng.random()
+                if fate < self.drop_rate:
+                    self.stats['dropped'] += 1
+                    # Hold the connection until the client gives up
+                    while await reader.read(httputil.CHUNK_SIZE):
+                        pass
+                    break
+                await asyncio.sleep(max(0, self.latency * (1 + self.jitter * (2 * self.rng.random() - 1))))
+                if fate < self.drop_rate + self.failure_rate:
+                    self.stats['failed'] += 1
+                    _respond(writer, 502, 'Bad Gateway', keep_alive=False)
+                    await writer.drain()
+                    break
+                if not await self._forward(request, body, writer):
+                    break
+        except (httputil.HTTPError, OSError) as e:
+            _logger.debug('Fake proxy {} connection error: {}'.format(self, e))
+        finally:
+            writer.close()
+
+    async def _forward(self, request, body, writer):
+        """
+        Forward absolute-form `request` to its origin.
+
+        :returns: True if the client connection can be reused
+        """
+        url = yarl.URL(request.target)
+        if request.method == 'CONNECT' or not url.is_absolute():
+            _respond(writer, 501, 'Not Implemented', keep_alive=False)
+            await writer.drain()
+            return False
+        keep_alive = request.keep_alive()
+        for header in HOP_BY_HOP_HEADERS:
+            request.remove_header(header)
+        request.start_line = (request.method, url.raw_path_qs or '/', request.version)
+        request.set_header('Connection', 'close')
+        up_reader, up_writer = await asyncio.open_connection(url.host, url.port)
+        try:
+            up_writer.write(request.to_bytes() + body)
+            await up_writer.drain()
+            response = await httputil.read_response(up_reader)
+            response_body, reusable = await httputil.read_body(up_reader, response, request.method)
+        finally:
+            up_writer.close()
+        keep_alive = keep_alive and reusable
+        response.set_header('Connection', 'keep-alive' if keep_alive else 'close')
+        writer.write(response.to_bytes() + response_body)
+        await writer.drain()
+        self.stats['forwarded'] += 1
+        return keep_alive
+
+
+class BenchEnvironment:
+    """
+    List sites and a fleet of fake proxies, some of them dead.
+    """
+    def __init__(self, proxies=200, pages=4, latency=0.05, jitter=0.5, drop_rate=0.05,
+                 failure_rate=0.1, dead_rate=0.2, seed=0, host='127.0.0.1'):
+        """
+        :param proxies: number of proxies listed
+        :param pages: number of list pages
+        :param latency: median seconds each live proxy adds to a request
+        :param jitter: random share of a proxy's latency added or removed per request
+        :param drop_rate: share of requests live proxies never answer
+        :param failure_rate: share of requests live proxies answer with a 502
+        :param dead_rate: share of listed proxies refusing connections
+        :param seed: random seed for the fleet
+        :param host: interface to listen on
+
+        :type proxies: int
+        :type pages: int
+        :type latency: float
+        :type jitter: float
+        :type drop_rate: float
+        :type failure_rate: float
+        :type dead_rate: float
+        :type seed: int
+        :type host: str
+        """
+        self.num_proxies = proxies
+        self.pages = pages
+        self.latency = latency
+        self.jitter = jitter
+        self.drop_rate = drop_rate
+        self.failure_rate = failure_rate
+        self.dead_rate = dead_rate
+        self.seed = seed
+        self.host = host
+        self.proxies = []
+        self.sites = None
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def start(self):
+        """
+        Start the fleet and list sites.
+        """
+        rng = random.Random(self.seed)
+        entries = []
+        for _ in range(self.num_proxies):
+            if rng.random() < self.dead_rate:
+                entries.append('{}:{}'.format(self.host, _free_port(self.host)))
+                continue
+            # Long tailed, like real proxy latencies
+            proxy = FakeProxy(latency=self.latency * rng.lognormvariate(0, 0.5), jitter=self.jitter,
+                              drop_rate=self.drop_rate, failure_rate=self.failure_rate, host=self.host)
+            await proxy.start()
+            self.proxies.append(proxy)
+            entries.append(str(proxy))
+        self.sites = BenchSites(entries, pages=self.pages, host=self.host)
+        await self.sites.start()
+        self.reset()
+        _logger.info('Bench fleet of {} live and {} dead proxies'
+                     .format(len(self.proxies), len(entries) - len(self.proxies)))
+
+    def reset(self):
+        """
+        Reseed the fleet so every run sees the same request fates.
+        """
+        for idx, proxy in enumerate(self.proxies):
+            proxy.rng.seed('{}-{}'.format(self.seed, idx))
+
+    async def close(self):
+        """
+        Stop the fleet and list sites.
+        """
+        for proxy in self.proxies:
+            await proxy.close()
+        self.proxies = []
+        if self.sites is not None:
+            await self.sites.close()
+            self.sites = None
+
+
+async def run_pipeline(env, engine='http', concurrency=8, timeout=5, headless=True,
+                       bin_path=None, chrome_args=[]):
+    """
+    Fetch the list pages of `env`, parse them and test every proxy found.
+
+    A fresh client with its own metrics registry is used, so runs don't
+    share browsers, latency history or metrics.
+
+    :param env: the bench environment
+    :param engine: `http` or `browser`
+    :param concurrency: concurrent tests
+    :param timeout: seconds to wait for each page and test
+    :param headless: run chrome headless mode
+    :param bin_path: path to chrome executable
+    :param chrome_args: headless chromium args
+
+    :type env: BenchEnvironment
+    :type engine: str
+    :type concurrency: int
+    :type timeout: float
+    :type headless: bool
+    :type bin_path: str
+    :type chrome_args: list
+
+    :returns: dict
+    """
+    if engine not in ENGINES:
+        raise ValueError('Unknown engine: {}'.format(engine))
+    env.reset()
+    chrome_args = list(chrome_args) + BROWSER_ARGS
+    client = AsyncClient(metrics=MetricsRegistry())
+    first_working = None
+    start = time.perf_counter()
+
+    def on_result(result):
+        nonlocal first_working
+        if first_working is None and isinstance(result, dict) and result['status'] == 'OK':
+            first_working = time.perf_counter() - start
+
+    try:
+        if engine == 'http':
+            pages = await asyncio.gather(*[client._get_page_http(url, timeout=timeout)
+                                           for url in env.sites.list_urls])
+        else:
+            pages = await client.get_pages(env.sites.list_urls, timeout=timeout,
+                                           tab_concurrency=env.pages, headless=headless,
+                                           bin_path=bin_path, chrome_args=chrome_args)
+        proxies = [proxy for page in pages for proxy in page.proxies()]
+        test_start = time.perf_counter()
+        results = await client.test_proxies(proxies, env.sites.target_url, timeout=timeout,
+                                             selector=TARGET_SELECTOR, headless=headless,
+                                             browser_concurrency=concurrency, on_result=on_result,
+                                             engine=engine, bin_path=bin_path, chrome_args=chrome_args)
+        end = time.perf_counter()
+    finally:
+        await client.close()
+
+    results = [r for r in results if isinstance(r, dict)]
+    elapsed = [r['elapsed'] for r in results if r.get('elapsed') is not None]
+    test_seconds = end - test_start
+    return {
+        'engine': engine,
+        'concurrency': concurrency,
+        'pages': len(pages),
+        'proxies': len(proxies),
+        'tested': len(results),
+        'working': len([r for r in results if r['status'] == 'OK']),
+        'fetch_seconds': round(test_start - start, 3),
+        'test_seconds': round(test_seconds, 3),
+        'tested_per_second': round(len(results) / test_seconds, 2) if test_seconds else None,
+        'first_working_seconds': round(first_working, 3) if first_working is not None else None,
+        'test_p50': _percentile(elapsed, 50),
+        'test_p99': _percentile(elapsed, 99)
+    }
+
+
+async def run_benchmark(engines=('http',), concurrencies=(8, 32), timeout=5, headless=True,
+                        bin_path=None, chrome_args=[], **env_kwargs):
+    """
+    Run the pipeline for every engine and concurrency setting against
+    one `BenchEnvironment`, reset between runs.
+
+    :param engines: engines to benchmark
+    :param concurrencies: concurrent test settings to benchmark
+    :param timeout: seconds to wait for each page and test
+    :param headless: run chrome headless mode
+    :param bin_path: path to chrome executable
+    :param chrome_args: headless chromium args
+    :param env_kwargs: keyword arguments for `BenchEnvironment`
+
+    :type engines: list
+    :type concurrencies: list
+    :type timeout: float
+    :type headless: bool
+    :type bin_path: str
+    :type chrome_args: list
+
+    :returns: list of dict, one per run
+    """
+    reports = []
+    async with BenchEnvironment(**env_kwargs) as env:
+        for engine in engines:
+            for concurrency in concurrencies:
+                _logger.info('Benchmarking {} engine at concurrency {}'.format(engine, concurrency))
+                reports.append(await run_pipeline(env, engine=engine, concurrency=concurrency,
+                                                  timeout=timeout, headless=headless,
+                                                  bin_path=bin_path, chrome_args=chrome_args))
+    return reports
@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+"""
+Module for sharing chromium between pipeline stages.
+"""
+import asyncio
+import contextlib
+import json
+import logging
+import time
+
+from .memory import process_tree_rss
+from .metrics import REGISTRY
+
+# Module vars
+_logger = logging.getLogger(__name__)
+
+
+class BrowserManager:
+    """
+    Lazily launched browsers shared across calls.
+
+    One browser is kept per set of launch options. A browser is retired
+    once it has opened `max_pages` pages, or its process tree uses more
+    than `max_rss` bytes, and closed when its last context is released.
+    New contexts go to a fresh browser meanwhile, so long runs don't
+    accumulate chromium memory and in-flight work isn't interrupted.
+
+    A browser that crashes or disconnects is dropped and relaunched on
+    next use. Page counts are checked when a context is requested, so a
+    browser held by one long-lived context, as by a long `get_pages`,
+    is only recycled once that context is released.
+    """
+    def __init__(self, launch, close, max_pages=200, max_rss=None, interval=5, metrics=None):
+        """
+        :param launch: coroutine function launching a browser from launch options
+        :param close: coroutine function closing a browser
+        :param max_pages: pages opened before a browser is recycled, None to never recycle
+        :param max_rss: bytes of resident memory before a browser is recycled, None for no limit
+        :param interval: seconds between memory samples
+        :param metrics: registry for browser metrics (defaults to the shared registry)
+
+        :type launch: callable
+        :type close: callable
+        :type max_pages: int
+        :type max_rss: int
+        :type interval: float
+        :type metrics: proxytools.metrics.MetricsRegistry
+        """
+        self.launch = launch
+        self.close_browser = close
+        self.max_pages = max_pages
+        self.max_rss = max_rss
+        self.interval = interval
+        self.metrics = metrics if metrics is not None else REGISTRY
+        self._browsers = {}
+        self._pages = {}
+        self._active = {}
+        self._retired = set()
+        self._stats = {}
+        self._history = []
+        self._watchdog = None
+        self._lock = asyncio.Lock()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    def _key(self, kwargs):
+        return json.dumps(kwargs, sort_keys=True, default=str)
+
+    def _on_target(self, browser, target):
+        if target.type == 'page':
+            self._pages[browser] = self._pages.get(browser, 0) + 1
+
+    def _is_connected(self, browser):
+        # pyppeteer has no public isConnected
+        connection = getattr(browser, '_connection', None)
+        return getattr(connection, '_connected', True)
+
+    def _on_disconnected(self, browser):
+        """
+        Stop handing out `browser` after it crashed or disconnected.
+        """
+        dropped = False
+        for key, val in list(self._browsers.items()):
+            if val is browser:
+                del self._browsers[key]
+                dropped = True
+        stats = self._stats.get(browser)
+        if not dropped or stats is None:
+            # Closed or recycled by us
+            return
+        _logger.warning('Shared browser disconnected, relaunching on next use')
+        stats['recycled'] = 'disconnected'
+        self.metrics.counter('proxytools_browser_recycles_total', 'Shared browsers recycled by reason') \
+            .inc(reason='disconnected')
+        asyncio.ensure_future(self._retire(browser))
+
+    async def browser(self, kwargs):
+        """
+        Return the shared browser for launch options `kwargs`.
+
+        :param kwargs: pyppeteer launch options
+        :type kwargs: dict
+        :returns: pyppeteer.browser.Browser
+        """
+        key = self._key(kwargs)
+        async with self._lock:
+            browser = self._browsers.get(key)
+            if browser is not None and not self._is_connected(browser):
+                self._on_disconnected(browser)
+                browser = None
+            if browser is not None and self.max_pages is not None \
+                    and self._pages.get(browser, 0) >= self.max_pages:
+                _logger.debug('Recycling browser after {} pages'.format(self._pages[browser]))
+                await self._recycle(browser, 'pages')
+                browser = None
+            if browser is None:
+                browser = await self.launch(kwargs)
+                browser.on('targetcreated', lambda target: self._on_target(browser, target))
+                browser.on('disconnected', lambda: self._on_disconnected(browser))
+                self._browsers[key] = browser
+                self._pages[browser] = 0
+                self._active[browser] = 0
+                process = getattr(browser, 'process', None)
+                self._stats[browser] = {
+                    'pid': process.pid if process is not None else None,
+                    'launched_at': time.time(),
+                    'rss': None,
+                    'peak_rss': None,
+                    'recycled': None
+                }
+                if self._watchdog is None:
+                    self._watchdog = asyncio.ensure_future(self._watch())
+            return browser
+
+    async def _recycle(self, browser, reason):
+        """
+        Stop handing out `browser` and close it once drained.
+        """
+        for key, val in list(self._browsers.items()):
+            if val is browser:
+                del self._browsers[key]
+        self._stats[browser]['recycled'] = reason
+        self.metrics.counter('proxytools_browser_recycles_total', 'Shared browsers recycled by reason') \
+            .inc(reason=reason)
+        await self._retire(browser)
+
+    async def _retire(self, browser):
+        if self._active.get(browser, 0) > 0:
+            self._retired.add(browser)
+        else:
+            await self._close(browser)
+
+    async def _close(self, browser):
+        self._retired.discard(browser)
+        stats = self._stats.pop(browser, None)
+        if stats is not None:
+            await self._sample(browser, stats)
+            stats['pages'] = self._pages.get(browser, 0)
+            stats['closed_at'] = time.time()
+            self._history.append(stats)
+        self._pages.pop(browser, None)
+        self._active.pop(browser, None)
+        await self.close_browser(browser)
+
+    async def _sample(self, browser, stats):
+        """
+        Update resident memory of `browser` in `stats`.
+
+        :returns: int bytes or None where unavailable
+        """
+        if stats['pid'] is None:
+            # Attached browsers run outside this host's process tree
+            return None
+        loop = asyncio.get_event_loop()
+        rss = await loop.run_in_executor(None, process_tree_rss, stats['pid'])
+        if rss is not None:
+            stats['rss'] = rss
+            stats['peak_rss'] = max(rss, stats['peak_rss'] or 0)
+        return rss
+
+    async def _watch(self):
+        """
+        Sample browser memory every `interval` seconds, recycling
+        browsers over `max_rss`.
+        """
+        gauge = self.metrics.gauge('proxytools_browser_rss_bytes', 'Resident memory of shared browsers')
+        while True:
+            await asyncio.sleep(self.interval)
+            total = 0
+            for browser, stats in list(self._stats.items()):
+                rss = await self._sample(browser, stats)
+                if rss is None:
+                    continue
+                total += rss
+                if self.max_rss is not None and rss > self.max_rss and stats['recycled'] is None:
+                    _logger.info('Recycling browser using {:.0f}MiB'.format(rss / 2**20))
+                    async with self._lock:
+                        if browser in self._stats:
+                            await self._recycle(browser, 'memory')
+            gauge.set(total)
+
+    @contextlib.asynccontextmanager
+    async def context(self, kwargs):
+        """
+        Async context manager yielding an incognito context on the shared
+        browser for launch options `kwargs`.
+
+        :param kwargs: pyppeteer launch options
+        :type kwargs: dict
+        """
+        browser = await self.browser(kwargs)
+        self._active[browser] += 1
+        try:
+            context = await browser.createIncognitoBrowserContext()
+            try:
+                yield context
+            finally:
+                try:
+                    await context.close()
+                except:
+                    pass
+        finally:
+            # The browser may have been closed while the context was in use
+            if browser in self._active:
+                self._active[browser] -= 1
+                if browser in self._retired and self._active[browser] == 0:
+                    await self._close(browser)
+
+    def stats(self):
+        """
+        Return per-browser statistics, including peak resident memory,
+        of open and closed browsers.
+
+        :returns: list of dict
+        """
+        stats = list(self._history)
+        for browser, data in self._stats.items():
+            stats.append(dict(data, pages=self._pages.get(browser, 0), closed_at=None))
+        return stats
+
+    async def close(self):
+        """
+        Close all browsers.
+        """
+        if self._watchdog is not None:
+            self._watchdog.cancel()
+            try:
+                await self._watchdog
+            except asyncio.CancelledError:
+                pass
+            self._watchdog = None
+        async with self._lock:
+            browsers = list(self._browsers.values()) + list(self._retired)
+            self._browsers = {}
+            for browser in browsers:
+                await self._close(browser)
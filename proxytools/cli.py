@@ -3,13 +3,33 @@
 """
 Proxytools command line client module.
 """
+import asyncio
 import click
+import cProfile
+import itertools
 import json
 import logging
+import mmap
+import multiprocessing
 import os
+import pstats
+import sys
 import time
 
 import proxytools
+import proxytools.archive
+import proxytools.bench
+import proxytools.daemon
+import proxytools.distributed
+import proxytools.export
+import proxytools.hedge
+import proxytools.journal
+import proxytools.metrics
+import proxytools.proxy
+import proxytools.server
+import proxytools.state
+import proxytools.timeout
+import proxytools.trace
 
 _log_levels = [
     'NOTSET',
@@ -32,21 +52,77 @@ class CliError(Exception):
 
 @click.group()
 @click.option('--log-level',  type=click.Choice(_log_levels), default='WARNING', envvar='LOG_LEVEL')
-def cli(log_level):
+@click.option('--metrics-port', help='serve Prometheus metrics on this port', type=click.INT)
+@click.option('--metrics-host', help='interface to serve Prometheus metrics on', default='127.0.0.1')
+@click.option('--metrics-file', help='write metrics as json to this file at exit', type=click.Path())
+@click.option('--trace', help='write Chrome trace-event json to this file at exit', type=click.Path())
+@click.option('--profile', help='profile the run with cProfile', is_flag=True)
+@click.option('--attach', help='use the browser of a running proxytools daemon', is_flag=True,
+              envvar='PROXYTOOLS_ATTACH')
+@click.pass_context
+def cli(ctx, log_level, metrics_port, metrics_host, metrics_file, trace, profile, attach):
     # Configure logging
     level = logging.getLevelName(log_level)
     logging.basicConfig(level=level)
 
+    # Attach clients, including those in child processes, to the daemon
+    if attach:
+        try:
+            endpoint = proxytools.daemon.daemon_endpoint()
+        except proxytools.daemon.DaemonError as e:
+            raise click.UsageError(str(e))
+        os.environ['PROXYTOOLS_BROWSER_ENDPOINT'] = endpoint
+
+    # Configure metrics
+    registry = proxytools.metrics.REGISTRY
+    if metrics_port:
+        server = registry.serve(metrics_port, host=metrics_host)
+        ctx.call_on_close(server.shutdown)
+    if metrics_file:
+        ctx.call_on_close(lambda: registry.dump(metrics_file))
+
+    # Configure tracing
+    if trace:
+        tracer = proxytools.trace.TRACER
+        tracer.enabled = True
+        ctx.call_on_close(lambda: tracer.dump(trace))
+    if profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+        base_path = os.path.splitext(trace)[0] if trace else 'proxytools'
+        ctx.call_on_close(lambda: _write_profile(profiler, base_path))
+
+
+def _write_profile(profiler, base_path, limit=50):
+    """
+    Write raw stats and a hot function report for `profiler`.
+
+    :param profiler: the profiler to stop
+    :param base_path: output path without extension
+    :param limit: number of functions in the report
+
+    :type profiler: cProfile.Profile
+    :type base_path: str
+    :type limit: int
+    """
+    profiler.disable()
+    profiler.dump_stats('{}.prof'.format(base_path))
+    with open('{}.profile.txt'.format(base_path), 'w') as f:
+        stats = pstats.Stats(profiler, stream=f)
+        stats.sort_stats('cumulative').print_stats(limit)
+        stats.sort_stats('tottime').print_stats(limit)
+
 
 ##############
 ## Commands ##
 ##############
 
 @cli.command()
-@click.option('--input-file', '-f',  type=click.File('r'))
+@click.option('--input-file', '-f',  type=click.Path(exists=True, dir_okay=False, allow_dash=True))
 @click.option('--url', '-u',  type=click.STRING)
 @click.option('--timeout', '-t',  type=click.INT, default=10)
 @click.option('--headless/--no-headless', default=True)
+@click.option('--archive', help='record fetched pages to this archive', type=click.Path())
 @click.option('--bin-path',
               help='Path to chromium executuable',
               type=click.Path(exists=True))
@@ -54,7 +130,7 @@ def cli(log_level):
               help='chromium args (comma separated)',
               type=str,
               default='')
-def parse(input_file, url, timeout, headless, bin_path, chrome_args):
+def parse(input_file, url, timeout, headless, archive, bin_path, chrome_args):
     """
     Parse proxies from file or URL
     """
@@ -69,22 +145,96 @@ def parse(input_file, url, timeout, headless, bin_path, chrome_args):
     chrome_args = _args
 
     if input_file:
-        html = html_file.read()
-        proxies = [str(p) for p in parser.parse_proxies(html)]
+        try:
+            proxies = _parse_file(parser, input_file)
+        except proxytools.parser.ParserError as e:
+            raise CliError(str(e))
     elif url:
         client = proxytools.Client()
+        if archive:
+            archive = proxytools.archive.PageArchive(archive)
         try:
             page = client.get_pages(
-                [url], timeout=timeout, headless=headless, bin_path=bin_path, chrome_args=chrome_args)[0]
+                [url], timeout=timeout, headless=headless, archive=archive, bin_path=bin_path,
+                chrome_args=chrome_args)[0]
             proxies = [str(p) for p in parser.parse_proxies(page.html)]
         except IndexError:
             raise CliError('Could not get page')
+        finally:
+            if archive:
+                archive.close()
+            client.close()
     else:
         raise CliError('Supply --input-file or --url')
 
     print(json.dumps(proxies, indent=4))
 
 
+def _parse_file(parser, path):
+    """
+    Parse proxies from file `path`, or stdin for -.
+
+    Plain text files are memory-mapped and scanned in place.
+
+    :param parser: the parser
+    :param path: the file path
+
+    :type parser: proxytools.parser.ProxyParser
+    :type path: str
+
+    :returns: list of proxy strings
+    """
+    if path == '-':
+        data = sys.stdin.buffer.read()
+    else:
+        with open(path, 'rb') as f:
+            if not os.fstat(f.fileno()).st_size:
+                raise CliError('Empty input file')
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        if parser.plain_text(data) is not None:
+            proxies = parser.parse_packed(data).as_strings()
+            if proxies:
+                return proxies
+        html = data[:].decode('utf-8', errors='replace')
+        return [str(p) for p in parser.parse_proxies(html)]
+    finally:
+        if isinstance(data, mmap.mmap):
+            data.close()
+
+
+@cli.command()
+@click.argument('archive', type=click.Path(exists=True))
+@click.option('--processes', '-p', help='number of parser processes (defaults to cpu count)', type=click.INT)
+@click.option('--summary', help='print totals instead of per-page results', is_flag=True)
+def replay(archive, processes, summary):
+    """
+    Re-parse pages recorded in an archive
+    """
+    start = time.perf_counter()
+    pages = 0
+    proxies = 0
+    errors = 0
+    try:
+        for result in proxytools.archive.replay(archive, processes=processes):
+            pages += 1
+            proxies += len(result['proxies'])
+            errors += 'error' in result
+            if not summary:
+                print(json.dumps(result))
+    except proxytools.archive.ArchiveError as e:
+        raise CliError(str(e))
+    if summary:
+        seconds = time.perf_counter() - start
+        print(json.dumps({
+            'pages': pages,
+            'proxies': proxies,
+            'errors': errors,
+            'seconds': round(seconds, 3),
+            'pages_per_second': round(pages / seconds, 1) if seconds else None
+        }, indent=4))
+
+
 @cli.command()
 @click.option('--headless/--no-headless', default=True)
 @click.option('--num', '-n',  help='number of sources to get [1-100]', default=10)
@@ -108,7 +258,11 @@ def sources(headless, num, bin_path, chrome_args):
             _args.append(arg)
     chrome_args = _args
     client = proxytools.Client()
-    urls = client.get_source_urls(headless=headless, num=num, bin_path=bin_path, chrome_args=chrome_args)
+    try:
+        urls = client.get_source_urls(headless=headless, num=num, bin_path=bin_path,
+                                      chrome_args=chrome_args)
+    finally:
+        client.close()
     print(json.dumps(urls, indent=4))
 
 
@@ -135,7 +289,10 @@ def search(source_num, bin_path, chrome_args):
             _args.append(arg)
     chrome_args = _args
     client = proxytools.Client()
-    proxies = client.search_proxies(source_num=source_num, bin_path=bin_path, chrome_args=chrome_args)
+    try:
+        proxies = client.search_proxies(source_num=source_num, bin_path=bin_path, chrome_args=chrome_args)
+    finally:
+        client.close()
     urls = [str(p) for p in proxies]
     print(json.dumps(urls, indent=4))
 
@@ -146,6 +303,10 @@ def search(source_num, bin_path, chrome_args):
 @click.option('--headless/--no-headless', default=True)
 @click.option('--browser-concurrency',  help='number of concurrent browser sessions', default=1)
 @click.option('--selector', '-s',  help='css selector for page validation')
+@click.option('--adaptive-timeout', help='derive per-proxy timeouts from connect probes', is_flag=True)
+@click.option('--target', '-T', multiple=True,
+              help='additional "URL [SELECTOR]" target each proxy must load')
+@click.option('--any-target', help='pass proxies loading any target instead of all', is_flag=True)
 @click.option('--bin-path',
               help='Path to chromium executuable',
               type=click.Path(exists=True))
@@ -153,7 +314,8 @@ def search(source_num, bin_path, chrome_args):
               help='chromium args (comma separated)',
               type=str,
               default='')
-def test(proxy, url, headless, browser_concurrency, selector, bin_path, chrome_args):
+def test(proxy, url, headless, browser_concurrency, selector, adaptive_timeout, target, any_target,
+         bin_path, chrome_args):
     """
     Test a proxy for a given URL
     """
@@ -165,16 +327,114 @@ def test(proxy, url, headless, browser_concurrency, selector, bin_path, chrome_a
                 arg = '--{}'.format(arg)
             _args.append(arg)
     client = proxytools.Client()
-    results = client.test_proxies([proxy], url, headless=headless, browser_concurrency=browser_concurrency, selector=selector)
+    try:
+        results = client.test_proxies([proxy], _targets(url, selector, target), headless=headless,
+                                      browser_concurrency=browser_concurrency, selector=selector,
+                                      adaptive_timeout=adaptive_timeout, require_all=not any_target)
+    finally:
+        client.close()
     print(json.dumps(results, indent=4))
 
 
+def _targets(url, selector, extra):
+    """
+    Return `url` alone, or with `extra` "URL [SELECTOR]" targets as a target list.
+    """
+    if not extra:
+        return url
+    targets = [(url, selector)]
+    for target in extra:
+        parts = target.strip().split(None, 1)
+        targets.append((parts[0], parts[1] if len(parts) > 1 else None))
+    return targets
+
+
+def _report_stats(client):
+    """
+    Print concurrency limits chosen by the adaptive controllers and peak
+    memory of shared browsers to stderr.
+
+    :param client: the client that ran
+    :type client: proxytools.Client
+    """
+    stats = client.stats()
+    for name, data in stats['concurrency'].items():
+        click.echo('Concurrency of {}: final {}, peak {} (max {})'.format(
+            name, data['limit'], data['peak_limit'], data['max_limit']), err=True)
+    for data in stats['browsers']:
+        peak = '{:.0f}MiB'.format(data['peak_rss'] / 2**20) if data['peak_rss'] else 'unknown'
+        click.echo('Browser {}: {} pages, peak memory {}{}'.format(
+            data['pid'], data['pages'], peak,
+            ', recycled for {}'.format(data['recycled']) if data['recycled'] else ''), err=True)
+
+
+def _endpoint(proxy):
+    """
+    Return host:port of proxy string `proxy`, ignoring its scheme.
+    """
+    proxy = proxytools.proxy.Proxy.from_string(proxy)
+    return '{}:{}'.format(proxy.host, proxy.port)
+
+
+def _read_proxies(f):
+    """
+    Yield proxies from a JSON array, NDJSON or plain host:port lines.
+
+    NDJSON lines may be proxy strings, result records with a `proxy` key
+    or `host`/`port` objects. Line formats are read one line at a time.
+
+    :param f: the input file
+    :type f: file object
+    """
+    first = ''
+    while True:
+        first = f.read(1)
+        if not first:
+            return
+        if not first.isspace():
+            break
+    if first == '[':
+        yield from json.loads(first + f.read())
+        return
+    for line in itertools.chain([first + f.readline()], f):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        if line[0] not in '{"':
+            yield line
+            continue
+        item = json.loads(line)
+        if isinstance(item, dict):
+            if 'proxy' in item:
+                item = item['proxy']
+            else:
+                item = '{}://{}:{}'.format(item.get('scheme', 'http'), item['host'], item['port'])
+        yield item
+
+
 @cli.command()
 @click.argument('json-file', type=click.File('r'))
 @click.argument('url', type=click.STRING)
 @click.option('--headless/--no-headless', default=True)
 @click.option('--browser-concurrency',  help='number of concurrent browser sessions', default=1)
 @click.option('--selector', '-s',  help='css selector for page validation')
+@click.option('--adaptive-timeout', help='derive per-proxy timeouts from connect probes', is_flag=True)
+@click.option('--sweep', help='drop dead endpoints with a TCP connect sweep first', is_flag=True)
+@click.option('--detect-protocol', help='detect http/socks protocol of proxies first', is_flag=True)
+@click.option('--processes', '-p', help='number of processes to shard tests across', default=1)
+@click.option('--schedule', help='test proxies most likely to work first', is_flag=True)
+@click.option('--journal', help='checkpoint results to this journal file, which must not exist unless resuming',
+              type=click.Path())
+@click.option('--resume', help='skip proxies already recorded in the journal', is_flag=True)
+@click.option('--ndjson', help='print results as NDJSON as they complete', is_flag=True)
+@click.option('--target', '-T', multiple=True,
+              help='additional "URL [SELECTOR]" target each proxy must load')
+@click.option('--any-target', help='pass proxies loading any target instead of all', is_flag=True)
+@click.option('--adaptive-concurrency', help='adapt concurrency to throughput and load, up to the set maximums',
+              is_flag=True)
+@click.option('--publish', help='publish working proxies to this memory-mappable file', type=click.Path())
+@click.option('--engine', help='load targets in chromium, or fetch them over plain http without javascript',
+              type=click.Choice(['browser', 'http']), default='browser')
 @click.option('--bin-path',
               help='Path to chromium executuable',
               type=click.Path(exists=True))
@@ -182,9 +442,14 @@ def test(proxy, url, headless, browser_concurrency, selector, bin_path, chrome_a
               help='chromium args (comma separated)',
               type=str,
               default='')
-def test_from_file(json_file, url, headless, browser_concurrency, selector, bin_path, chrome_args):
+def test_from_file(json_file, url, headless, browser_concurrency, selector, adaptive_timeout, sweep,
+                   detect_protocol, processes, schedule, journal, resume, ndjson, target, any_target,
+                   adaptive_concurrency, publish, engine, bin_path, chrome_args):
     """
-    Test proxies from json file for a given URL
+    Test proxies from file for a given URL
+
+    JSON-FILE may be a JSON array, NDJSON or plain host:port lines, or -
+    for stdin. Line formats are read incrementally.
     """
     chrome_args = chrome_args.split(',')
     _args = []
@@ -193,16 +458,72 @@ def test_from_file(json_file, url, headless, browser_concurrency, selector, bin_
             if not arg.startswith('--'):
                 arg = '--{}'.format(arg)
             _args.append(arg)
-    proxies = json.load(json_file)
+    if resume and not journal:
+        raise click.UsageError('--resume requires --journal')
+    proxies = _read_proxies(json_file)
+    previous = []
+    if journal:
+        if not resume and os.path.exists(journal):
+            raise click.UsageError('journal {} exists; pass --resume or remove it'.format(journal))
+        journal = proxytools.journal.Journal(journal)
+        previous = list(journal.records())
+        # Matched on host:port, records may carry a detected socks scheme
+        done = {_endpoint(record['proxy']) for record in previous}
+        proxies = (p for p in proxies if _endpoint(p) not in done)
+        if done:
+            _logger.info('Resuming: {} proxies already done'.format(len(done)))
+    if ndjson:
+        for record in previous:
+            print(json.dumps(record), flush=True)
+    # Sweeps, protocol detection, scheduling and sharding need the whole list
+    if sweep or detect_protocol or schedule or processes > 1:
+        proxies = list(proxies)
+
+    working = [record for record in previous if record['status'] == 'OK']
+
+    def on_result(result):
+        if publish and isinstance(result, dict) and result['status'] == 'OK':
+            working.append(result)
+        # Exceptions are not journaled, so those proxies are retried on resume
+        if journal and isinstance(result, dict):
+            journal.write(result)
+        if ndjson:
+            if isinstance(result, dict):
+                print(json.dumps(result), flush=True)
+            else:
+                logging.warning(result)
+
     client = proxytools.Client()
-    results = client.test_proxies(proxies,
-                                  url,
-                                  headless=headless,
-                                  browser_concurrency=browser_concurrency,
-                                  selector=selector,
-                                  bin_path=bin_path,
-                                  chrome_args=chrome_args)
-    print(json.dumps(results, indent=4))
+    try:
+        if sweep:
+            proxies = client.sweep(proxies)
+        if detect_protocol:
+            proxies = client.detect_protocols(proxies)
+        results = client.test_proxies(proxies,
+                                      _targets(url, selector, target),
+                                      headless=headless,
+                                      browser_concurrency=browser_concurrency,
+                                      selector=selector,
+                                      adaptive_timeout=adaptive_timeout,
+                                      processes=processes,
+                                      on_result=on_result,
+                                      collect=not ndjson,
+                                      require_all=not any_target,
+                                      schedule=schedule,
+                                      adaptive_concurrency=adaptive_concurrency,
+                                      engine=engine,
+                                      bin_path=bin_path,
+                                      chrome_args=chrome_args)
+    finally:
+        if journal:
+            journal.close()
+        client.close()
+    if adaptive_concurrency:
+        _report_stats(client)
+    if publish:
+        proxytools.export.publish(publish, working)
+    if not ndjson:
+        print(json.dumps(previous + results, indent=4))
 
 
 @cli.command()
@@ -216,6 +537,24 @@ def test_from_file(json_file, url, headless, browser_concurrency, selector, bin_
 @click.option('--debug', '-d', help='debug output for crawler', is_flag=True)
 @click.option('--source-num', '-n',  help='number of sources to get from Google [1-100]',
               default=10)
+@click.option('--max-latency', help='drop proxies slower than this many seconds', type=click.FLOAT)
+@click.option('--rank', help='return fastest proxies first', is_flag=True)
+@click.option('--candidates', help='working proxies to collect before ranking', type=click.INT)
+@click.option('--adaptive-timeout', help='derive per-proxy timeouts from connect probes', is_flag=True)
+@click.option('--sweep', help='drop dead endpoints with a TCP connect sweep first', is_flag=True)
+@click.option('--detect-protocol', help='detect http/socks protocol of proxies first', is_flag=True)
+@click.option('--processes', '-p', help='number of processes to shard tests across', default=1)
+@click.option('--schedule', help='test proxies most likely to work first', is_flag=True)
+@click.option('--fetch-budget', help='max sources to fetch, best-yielding first', type=click.INT)
+@click.option('--test-budget', help='max proxies to test, from best-yielding sources first', type=click.INT)
+@click.option('--archive', help='record fetched pages to this archive', type=click.Path())
+@click.option('--hedge', help='start a backup fetch of slow source pages in another tab or over plain http',
+              type=click.Choice(['tab', 'http']))
+@click.option('--adaptive-concurrency', help='adapt concurrency to throughput and load, up to the set maximums',
+              is_flag=True)
+@click.option('--max-browser-memory', help='MiB of memory before the shared browser is recycled',
+              type=click.INT)
+@click.option('--publish', help='publish working proxies to this memory-mappable file', type=click.Path())
 @click.option('--bin-path',
               help='Path to chromium executuable',
               type=click.Path(exists=True))
@@ -223,7 +562,10 @@ def test_from_file(json_file, url, headless, browser_concurrency, selector, bin_
               help='chromium args (comma separated)',
               type=str,
               default='')
-def get(test_url, headless, tab_concurrency, browser_concurrency, limit, selector, source_num, geo, bin_path, chrome_args, debug):
+def get(test_url, headless, tab_concurrency, browser_concurrency, limit, selector, source_num,
+        max_latency, rank, candidates, adaptive_timeout, sweep, detect_protocol, processes, schedule,
+        fetch_budget, test_budget, archive, hedge, adaptive_concurrency, max_browser_memory, publish,
+        geo, bin_path, chrome_args, debug):
     """
     Get a working proxy
     """
@@ -234,25 +576,290 @@ def get(test_url, headless, tab_concurrency, browser_concurrency, limit, selecto
             if not arg.startswith('--'):
                 arg = '--{}'.format(arg)
             _args.append(arg)
-    client = proxytools.Client(debug=True)
-    results = client.get_proxies(test_url,
-                                 headless=headless,
-                                 tab_concurrency=tab_concurrency,
-                                 browser_concurrency=browser_concurrency,
-                                 limit=limit,
-                                 selector=selector,
-                                 source_num=source_num,
-                                 bin_path=bin_path,
-                                 chrome_args=chrome_args)
+    if archive:
+        archive = proxytools.archive.PageArchive(archive)
+    if hedge:
+        # Page latencies persist across runs, so hedging is tuned from the start
+        history = proxytools.timeout.LatencyHistory(path=proxytools.state.state_path('page_latency.json'))
+        hedge = proxytools.hedge.HedgePolicy(mode=hedge, history=history)
+    client = proxytools.Client(debug=True, archive=archive, hedge=hedge,
+                               max_browser_memory=max_browser_memory)
+    try:
+        results = client.get_proxies(test_url,
+                                     headless=headless,
+                                     tab_concurrency=tab_concurrency,
+                                     browser_concurrency=browser_concurrency,
+                                     limit=limit,
+                                     selector=selector,
+                                     source_num=source_num,
+                                     max_latency=max_latency,
+                                     rank=rank,
+                                     candidates=candidates,
+                                     adaptive_timeout=adaptive_timeout,
+                                     sweep=sweep,
+                                     detect_protocol=detect_protocol,
+                                     processes=processes,
+                                     schedule=schedule,
+                                     fetch_budget=fetch_budget,
+                                     test_budget=test_budget,
+                                     adaptive_concurrency=adaptive_concurrency,
+                                     bin_path=bin_path,
+                                     chrome_args=chrome_args)
+    finally:
+        client.close()
+        if archive:
+            archive.close()
+    if adaptive_concurrency or max_browser_memory:
+        _report_stats(client)
+    if publish:
+        proxytools.export.publish(publish, results)
     if geo:
         wait = 1  #  seconds between WHOIS request
         for result in results:
             proxy = proxytools.proxy.Proxy.from_string(result['proxy'])
-            country = proxy.country()
+            with client.tracer.span('whois', host=proxy.host):
+                country = proxy.country()
             result['country'] = country
             time.sleep(wait)
     print(json.dumps(results, indent=4))
 
 
+@cli.command()
+@click.argument('test-url', type=click.STRING)
+@click.option('--input-file', '-f', help='json list of proxies to validate', type=click.File('r'))
+@click.option('--host', help='interface to listen on', default='127.0.0.1')
+@click.option('--port', '-p', help='port to listen on', default=8899)
+@click.option('--strategy', help='upstream rotation strategy',
+              type=click.Choice(proxytools.server.UpstreamSelector.strategies), default='round-robin')
+@click.option('--retries', help='upstream proxies tried per request', default=3)
+@click.option('--headless/--no-headless', default=True)
+@click.option('--browser-concurrency',  help='number of concurrent browser sessions', default=1)
+@click.option('--tab-concurrency',  help='number of concurrent browser tabs', default=1)
+@click.option('--limit', '-l',  help='number of upstream proxies to get', default=10)
+@click.option('--selector', '-s',  help='css selector for page validation')
+@click.option('--source-num', '-n',  help='number of sources to get from Google [1-100]',
+              default=10)
+@click.option('--bin-path',
+              help='Path to chromium executuable',
+              type=click.Path(exists=True))
+@click.option('--chrome-args',
+              help='chromium args (comma separated)',
+              type=str,
+              default='')
+def serve(test_url, input_file, host, port, strategy, retries, headless, browser_concurrency,
+          tab_concurrency, limit, selector, source_num, bin_path, chrome_args):
+    """
+    Run a local forward proxy rotating over working proxies
+    """
+    chrome_args = chrome_args.split(',')
+    _args = []
+    for arg in chrome_args:
+        if len(arg) > 0:
+            if not arg.startswith('--'):
+                arg = '--{}'.format(arg)
+            _args.append(arg)
+    chrome_args = _args
+    client = proxytools.Client()
+    try:
+        if input_file:
+            proxies = json.load(input_file)
+            results = client.test_proxies(proxies,
+                                          test_url,
+                                          headless=headless,
+                                          browser_concurrency=browser_concurrency,
+                                          selector=selector,
+                                          exit_success_count=limit,
+                                          bin_path=bin_path,
+                                          chrome_args=chrome_args)
+        else:
+            results = client.get_proxies(test_url,
+                                         headless=headless,
+                                         tab_concurrency=tab_concurrency,
+                                         browser_concurrency=browser_concurrency,
+                                         limit=limit,
+                                         selector=selector,
+                                         source_num=source_num,
+                                         bin_path=bin_path,
+                                         chrome_args=chrome_args)
+    finally:
+        # Testing is done, the server only relays
+        client.close()
+    try:
+        server = proxytools.server.ForwardProxyServer.from_results(
+            results, strategy=strategy, host=host, port=port, retries=retries)
+    except ValueError as e:
+        raise CliError(str(e))
+
+    client.loop.run_until_complete(server.start())
+    print('Serving on {}:{} with {} upstream proxies'.format(
+        server.host, server.port, len(server.selector.upstreams)))
+    try:
+        client.loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        client.loop.run_until_complete(server.close())
+
+
+@cli.command()
+@click.argument('queue-file', type=click.Path())
+@click.argument('json-file', type=click.File('r'))
+@click.argument('url', type=click.STRING)
+@click.option('--selector', '-s',  help='css selector for page validation')
+@click.option('--timeout', '-t',  type=click.INT, default=10)
+@click.option('--limit', '-l',  help='stop when this many working proxies are found', type=click.INT)
+@click.option('--lease-seconds', help='seconds a worker holds jobs without renewing', default=60)
+@click.option('--max-attempts', help='leases per job before it is marked failed', default=3)
+def coordinator(queue_file, json_file, url, selector, timeout, limit, lease_seconds, max_attempts):
+    """
+    Queue proxies for workers and stream back results
+    """
+    queue = proxytools.distributed.WorkQueue(
+        queue_file, lease_seconds=lease_seconds, max_attempts=max_attempts)
+    coordinator = proxytools.distributed.Coordinator(queue)
+    count = coordinator.submit(json.load(json_file), url, selector=selector, timeout=timeout)
+    _logger.info('Queued {} proxies'.format(count))
+    for result in coordinator.stream(exit_success_count=limit):
+        print(json.dumps(result), flush=True)
+
+
+@cli.command()
+@click.option('--stop', help='stop the running daemon', is_flag=True)
+@click.option('--headless/--no-headless', default=True)
+@click.option('--bin-path',
+              help='Path to chromium executuable',
+              type=click.Path(exists=True))
+@click.option('--chrome-args',
+              help='chromium args (comma separated)',
+              type=str,
+              default='')
+def daemon(stop, headless, bin_path, chrome_args):
+    """
+    Keep a warm chromium running for --attach
+    """
+    if stop:
+        try:
+            proxytools.daemon.stop_daemon()
+        except proxytools.daemon.DaemonError as e:
+            raise CliError(str(e))
+        return
+    chrome_args = chrome_args.split(',')
+    _args = []
+    for arg in chrome_args:
+        if len(arg) > 0:
+            if not arg.startswith('--'):
+                arg = '--{}'.format(arg)
+            _args.append(arg)
+    loop = asyncio.get_event_loop()
+    try:
+        loop.run_until_complete(
+            proxytools.daemon.run_daemon(headless=headless, bin_path=bin_path, chrome_args=_args))
+    except proxytools.daemon.DaemonError as e:
+        raise CliError(str(e))
+
+
+def _run_worker(queue_file, lease_seconds, wait, worker_kwargs):
+    """
+    Run a queue worker in the current process.
+    """
+    client = proxytools.Client()
+    queue = proxytools.distributed.WorkQueue(queue_file, lease_seconds=lease_seconds)
+    worker = proxytools.distributed.Worker(client.async_client, queue, **worker_kwargs)
+    try:
+        client.loop.run_until_complete(worker.run(wait=wait))
+    finally:
+        client.close()
+        queue.close()
+
+
+@cli.command()
+@click.argument('queue-file', type=click.Path(exists=True))
+@click.option('--processes', '-p', help='number of worker processes to run', default=1)
+@click.option('--batch-size', help='jobs leased at once', type=click.INT)
+@click.option('--lease-seconds', help='seconds a worker holds jobs without renewing', default=60)
+@click.option('--wait', help='keep polling for jobs when the queue is finished', is_flag=True)
+@click.option('--headless/--no-headless', default=True)
+@click.option('--browser-concurrency',  help='number of concurrent browser sessions', default=1)
+@click.option('--bin-path',
+              help='Path to chromium executuable',
+              type=click.Path(exists=True))
+@click.option('--chrome-args',
+              help='chromium args (comma separated)',
+              type=str,
+              default='')
+def worker(queue_file, processes, batch_size, lease_seconds, wait, headless, browser_concurrency,
+           bin_path, chrome_args):
+    """
+    Test proxies from a coordinator queue
+    """
+    chrome_args = chrome_args.split(',')
+    _args = []
+    for arg in chrome_args:
+        if len(arg) > 0:
+            if not arg.startswith('--'):
+                arg = '--{}'.format(arg)
+            _args.append(arg)
+    chrome_args = _args
+    worker_kwargs = {
+        'batch_size': batch_size,
+        'browser_concurrency': browser_concurrency,
+        'headless': headless,
+        'bin_path': bin_path,
+        'chrome_args': chrome_args
+    }
+    if processes == 1:
+        _run_worker(queue_file, lease_seconds, wait, worker_kwargs)
+        return
+
+    ctx = multiprocessing.get_context('spawn')
+    procs = [ctx.Process(target=_run_worker, args=(queue_file, lease_seconds, wait, worker_kwargs))
+             for _ in range(processes)]
+    for proc in procs:
+        proc.start()
+    for proc in procs:
+        proc.join()
+
+
+@cli.command()
+@click.option('--engine', '-e', help='engine to benchmark (repeatable)', multiple=True,
+              type=click.Choice(proxytools.bench.ENGINES), default=['http'])
+@click.option('--concurrency', '-c', help='concurrent tests to benchmark (repeatable)', multiple=True,
+              type=click.INT, default=[8, 32])
+@click.option('--proxies', help='number of proxies listed', default=200)
+@click.option('--pages', help='number of list pages', default=4)
+@click.option('--latency', help='median seconds each proxy adds to a request', default=0.05)
+@click.option('--drop-rate', help='share of requests proxies never answer', default=0.05)
+@click.option('--failure-rate', help='share of requests proxies answer with a 502', default=0.1)
+@click.option('--dead-rate', help='share of listed proxies refusing connections', default=0.2)
+@click.option('--timeout', help='seconds to wait for each page and test', default=5)
+@click.option('--seed', help='random seed for the proxy fleet', default=0)
+@click.option('--headless/--no-headless', default=True)
+@click.option('--bin-path',
+              help='Path to chromium executuable',
+              type=click.Path(exists=True))
+@click.option('--chrome-args',
+              help='chromium args (comma separated)',
+              type=str,
+              default='')
+def bench(engine, concurrency, proxies, pages, latency, drop_rate, failure_rate, dead_rate, timeout,
+          seed, headless, bin_path, chrome_args):
+    """
+    Benchmark the pipeline against local proxy list sites and proxies
+    """
+    chrome_args = chrome_args.split(',')
+    _args = []
+    for arg in chrome_args:
+        if len(arg) > 0:
+            if not arg.startswith('--'):
+                arg = '--{}'.format(arg)
+            _args.append(arg)
+    loop = asyncio.get_event_loop()
+    reports = loop.run_until_complete(proxytools.bench.run_benchmark(
+        engines=engine, concurrencies=concurrency, timeout=timeout, headless=headless,
+        bin_path=bin_path, chrome_args=_args, proxies=proxies, pages=pages, latency=latency,
+        drop_rate=drop_rate, failure_rate=failure_rate, dead_rate=dead_rate, seed=seed))
+    print(json.dumps(reports, indent=4))
+
+
 if __name__ == '__main__':
     cli()
@@ -4,18 +4,35 @@
 Module containing ProxyTool class.
 """
 import asyncio
+import bs4
+import contextlib
 import datetime
+import functools
 import itertools
 import logging
+import os
 import pyppeteer
 import re
 import requests
 import socket
 import time
 import yarl
+from pyppeteer.browser import BrowserContext
 # Proxytools
+from . import httputil
+from .browser import BrowserManager
+from .concurrency import AIMDController
+from .metrics import REGISTRY
 from .page import Page
+from .parser import ProxyParser
+from .probe import PROTOCOL_SCHEMES, ProbeError, connect_time, detect_protocols, sweep
 from .proxy import Proxy
+from .scheduler import SuccessScheduler
+from .sources import SourceAllocator
+from .shard import test_proxies_in_processes
+from .state import state_path
+from .timeout import AdaptiveTimeout, LatencyHistory
+from .trace import TRACER
 
 # Module vars
 _logger = logging.getLogger(__name__)
@@ -36,18 +53,127 @@ class ProxyToolError(Exception):
     pass
 
 
-class Client:
+class AsyncClient:
     """
-    Proxytools client.
+    Asynchronous proxytools client.
 
-    The is the main entry point for proxytools.
+    Methods are coroutines run in the caller's event loop, so proxy
+    discovery can share a loop with other asyncio work.
     """
-    def __init__(self, debug=False):
-        self.loop = asyncio.get_event_loop()
+    def __init__(self, metrics=None, tracer=None, browser_endpoint=None, max_browser_pages=200,
+                 max_browser_memory=None, archive=None, hedge=None):
+        """
+        :param metrics: registry for pipeline metrics (defaults to the shared registry)
+        :param tracer: span tracer (defaults to the shared tracer)
+        :param browser_endpoint: devtools websocket of a running browser to attach to
+            instead of launching chromium, e.g. from `proxytools daemon` (defaults to
+            the PROXYTOOLS_BROWSER_ENDPOINT environment variable)
+        :param max_browser_pages: pages opened before the shared browser is recycled
+        :param max_browser_memory: MiB of resident memory before the shared browser is recycled
+        :param archive: record pages fetched by `get_pages` to this archive
+        :param hedge: policy for backup fetches of slow source pages in `get_pages`
+
+        :type metrics: proxytools.metrics.MetricsRegistry
+        :type tracer: proxytools.trace.Tracer
+        :type browser_endpoint: str
+        :type max_browser_pages: int
+        :type max_browser_memory: int
+        :type archive: proxytools.archive.PageArchive
+        :type hedge: proxytools.hedge.HedgePolicy
+        """
         self.geoip_url = yarl.URL('http://ip-api.com/json/')
         self.whois_server = 'whois.apnic.net'
-        self.debug = debug
-        self.loop.set_debug(self.debug)
+        self._latency_history = None
+        self._scheduler = None
+        self._sources = None
+        self.metrics = metrics if metrics is not None else REGISTRY
+        self.tracer = tracer if tracer is not None else TRACER
+        self.parser = ProxyParser(metrics=self.metrics, tracer=self.tracer)
+        self.browser_endpoint = browser_endpoint or os.environ.get('PROXYTOOLS_BROWSER_ENDPOINT')
+        self.browsers = BrowserManager(
+            self._launch, self._close_browser, max_pages=max_browser_pages,
+            max_rss=max_browser_memory * 2**20 if max_browser_memory else None, metrics=self.metrics)
+        self.archive = archive
+        self.hedge = hedge
+        # Adaptive concurrency controllers of the last run, by stage
+        self.concurrency = {}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.browsers.close()
+
+    async def close(self):
+        """
+        Close browsers shared between calls.
+        """
+        await self.browsers.close()
+
+    def stats(self):
+        """
+        Return statistics of the client's last runs.
+
+        :returns: dict
+        """
+        return {
+            'concurrency': {name: controller.as_dict() for name, controller in self.concurrency.items()},
+            'browsers': self.browsers.stats()
+        }
+
+    @contextlib.asynccontextmanager
+    async def _adaptive_concurrency(self, name, max_limit):
+        """
+        Run an AIMD controller for stage `name`, capped at `max_limit`.
+        """
+        controller = AIMDController(max_limit, name=name)
+        self.concurrency[name] = controller
+        gauge = self.metrics.gauge('proxytools_concurrency_limit', 'Adaptive concurrency limits')
+        async with controller:
+            gauge.set(controller.limit, stage=name)
+            try:
+                yield controller
+            finally:
+                gauge.set(controller.limit, stage=name)
+
+    @property
+    def latency_history(self):
+        """
+        Historical latencies of successful proxy tests.
+
+        Loaded lazily from the proxytools state directory.
+
+        :returns: proxytools.timeout.LatencyHistory
+        """
+        if self._latency_history is None:
+            self._latency_history = LatencyHistory(path=state_path('latency.json'))
+        return self._latency_history
+
+    @property
+    def scheduler(self):
+        """
+        Success statistics used to order proxy tests.
+
+        Loaded lazily from the proxytools state directory.
+
+        :returns: proxytools.scheduler.SuccessScheduler
+        """
+        if self._scheduler is None:
+            self._scheduler = SuccessScheduler(path=state_path('scheduler.json'))
+        return self._scheduler
+
+    @property
+    def sources(self):
+        """
+        Per-source yield statistics used to allocate crawl budget.
+
+        Loaded lazily from the proxytools state directory.
+
+        :returns: proxytools.sources.SourceAllocator
+        """
+        if self._sources is None:
+            self._sources = SourceAllocator(path=state_path('sources.json'))
+        return self._sources
 
     def _chunker(self, iterable, n, fillvalue=None):
         """
@@ -66,6 +192,113 @@ class Client:
         args = [iter(iterable)] * n
         return itertools.zip_longest(*args, fillvalue=fillvalue)
 
+    def _as_proxy(self, proxy):
+        """
+        Return `proxy` as a Proxy instance.
+
+        :param proxy: proxy or proxy url string
+        :type proxy: proxytools.Proxy or str
+        :returns: proxytools.Proxy
+        """
+        if isinstance(proxy, Proxy):
+            return proxy
+        return Proxy.from_string(str(proxy))
+
+    def _is_success(self, result, max_latency=None):
+        """
+        Return True if test `result` is OK and within `max_latency`.
+
+        :param result: proxy test result
+        :param max_latency: max seconds allowed for the page test
+
+        :type result: dict
+        :type max_latency: float
+
+        :returns: bool
+        """
+        if not isinstance(result, dict) or result['status'] != 'OK':
+            return False
+        if max_latency is None:
+            return True
+        total = result.get('latency', {}).get('total')
+        return total is not None and total <= max_latency
+
+    def _latency_key(self, result):
+        """
+        Sort key ranking test results by total page test latency.
+
+        :param result: proxy test result
+        :type result: dict
+        :returns: float
+        """
+        total = result.get('latency', {}).get('total')
+        if total is None:
+            return float('inf')
+        return total
+
+    async def _launch(self, kwargs):
+        """
+        Launch chromium with pyppeteer launch options `kwargs`.
+
+        When attached to a running browser, connect to it instead and
+        ignore `kwargs`.
+
+        :param kwargs: pyppeteer launch options
+        :type kwargs: dict
+        :returns: pyppeteer.browser.Browser
+        """
+        if self.browser_endpoint:
+            with self.tracer.span('browser.connect'):
+                browser = await pyppeteer.connect(browserWSEndpoint=self.browser_endpoint)
+            self.metrics.counter('proxytools_browser_connects_total', 'Attachments to a running browser').inc()
+            return browser
+        start = time.perf_counter()
+        with self.tracer.span('browser.launch'):
+            browser = await pyppeteer.launch(kwargs)
+        self.metrics.counter('proxytools_browser_launches_total', 'Chromium launches').inc()
+        self.metrics.histogram('proxytools_browser_launch_seconds', 'Chromium launch duration') \
+            .observe(time.perf_counter() - start)
+        return browser
+
+    async def _close_browser(self, browser):
+        """
+        Close `browser`, or disconnect from it if attached.
+
+        :param browser: the browser
+        :type browser: pyppeteer.browser.Browser
+        """
+        try:
+            if self.browser_endpoint:
+                await browser.disconnect()
+            else:
+                await browser.close()
+        except:
+            pass
+
+    async def _new_context(self, browser, proxy=None):
+        """
+        Create an incognito browser context, optionally routed through `proxy`.
+
+        Proxied contexts let one running browser test many proxies
+        without relaunching with --proxy-server flags.
+
+        :param browser: the browser
+        :param proxy: the proxy for all context traffic
+
+        :type browser: pyppeteer.browser.Browser
+        :type proxy: proxytools.Proxy
+
+        :returns: pyppeteer.browser.BrowserContext
+        """
+        if proxy is None:
+            return await browser.createIncognitoBrowserContext()
+        obj = await browser._connection.send('Target.createBrowserContext',
+                                             {'proxyServer': str(proxy)})
+        context_id = obj['browserContextId']
+        context = BrowserContext(browser, context_id)
+        browser._contexts[context_id] = context
+        return context
+
     def detect_cloudflare(self, html):
         """
         Return True if html is cloudflare.
@@ -76,8 +309,8 @@ class Client:
         else:
             return False
 
-    async def _async_get_pages(self, urls, tab_concurrency=10, headless=True,
-                               timeout=10, bin_path=None, chrome_args=[]):
+    async def _get_pages(self, urls, tab_concurrency=10, headless=True,
+                               timeout=10, bin_path=None, chrome_args=[], concurrency=None):
         """
         Asynchronously get pages from `urls` using chromium.
 
@@ -86,12 +319,14 @@ class Client:
         :param headless: use chrome in headless mode
         :param bin_path: path to chrome executable
         :param chrome_args: headless chrome args
+        :param concurrency: controller limiting concurrent tabs instead of `tab_concurrency`
 
         :type urls: list
         :type tab_concurrency: int
         :type headless: bool
         :type bin_path: str
         :type chrome_args: list
+        :type concurrency: proxytools.concurrency.AIMDController
 
         :returns: list
         """
@@ -101,33 +336,38 @@ class Client:
         }
         if bin_path:
             kwargs['executablePath'] = bin_path
-        browser = await pyppeteer.launch(kwargs)
-        # browser = await pyppeteer.launch({'headless': headless})
         pages = []
-        # Create incognito tab
-        context = await browser.createIncognitoBrowserContext()
-        for chunk in self._chunker(urls, tab_concurrency):
-            new_pages = await asyncio.gather(
-                *[self.get_page(url, context, timeout=timeout) for url in chunk if url],
-                return_exceptions=True)
-            pages.extend(new_pages)
-
-        # Cleanup
-        try:
-            await context.close()
-        except:
-            pass
-
-        try:
-            await browser.close()
-        except:
-            pass
+        queue_depth = self.metrics.gauge('proxytools_queue_depth', 'Items waiting in pipeline queues')
+        queue_depth.set(len(urls), queue='pages')
+        # Incognito context on the shared browser
+        async with self.browsers.context(kwargs) as context:
+            if concurrency is not None:
+                async def get_page(url):
+                    async with concurrency.slot():
+                        try:
+                            page = await self.get_page(url, context, timeout=timeout, hedge=self.hedge)
+                        except Exception:
+                            concurrency.record(False)
+                            raise
+                        finally:
+                            queue_depth.dec(1, queue='pages')
+                        concurrency.record(True)
+                        return page
+
+                return await asyncio.gather(*[get_page(url) for url in urls if url],
+                                            return_exceptions=True)
+            for chunk in self._chunker(urls, tab_concurrency):
+                new_pages = await asyncio.gather(
+                    *[self.get_page(url, context, timeout=timeout, hedge=self.hedge) for url in chunk if url],
+                    return_exceptions=True)
+                pages.extend(new_pages)
+                queue_depth.dec(len(new_pages), queue='pages')
 
         return pages
 
-    async def _async_get_source_urls(self, num=10, headless=True, bin_path=None, chrome_args=[]):
+    async def get_source_urls(self, headless=True, num=10, bin_path=None, chrome_args=[]):
         """
-        Scrape proxy sources from Google.
+        Search Google for URLs containing free proxy lists.
 
         :param num: number of results to fetch [1-100]
         :param headless: use chrome in headless mode
@@ -143,6 +383,7 @@ class Client:
         """
         if num < 1 or num > 100:
             raise ValueError('source `num` must be between 1-100]')
+        _logger.info('Searching Google for proxy sources..')
 
         urls = []
         kwargs = {
@@ -151,195 +392,559 @@ class Client:
         }
         if bin_path:
             kwargs['executablePath'] = bin_path
-        browser = await pyppeteer.launch(kwargs)
-        # browser = await pyppeteer.launch({'headless': headless})
-        # Create incognito tab
-        context = await browser.createIncognitoBrowserContext()
-        tab = await context.newPage()
-        await tab._client.send('Emulation.clearDeviceMetricsOverride');
-        await tab.goto('https://www.google.com/search?q=free+proxy+list&gws_rd=cr&num={}'.format(num))
-        results = await tab.querySelectorAll('div.srg div.r ')
-        for result in results:
-            link = await result.querySelector('a')
-            prop = await link.getProperty('href')
-            url =  await prop.jsonValue()
-            urls.append(url)
-
-        # Cleanup
-        try:
-            await tab.close()
-        except:
-            pass
-
-        try:
-            await context.close()
-        except:
-            pass
-
-        try:
-            await browser.close()
-        except:
-            pass
+        # Incognito tab on the shared browser
+        async with self.browsers.context(kwargs) as context:
+            tab = await context.newPage()
+            await tab._client.send('Emulation.clearDeviceMetricsOverride');
+            await tab.goto('https://www.google.com/search?q=free+proxy+list&gws_rd=cr&num={}'.format(num))
+            results = await tab.querySelectorAll('div.srg div.r ')
+            for result in results:
+                link = await result.querySelector('a')
+                prop = await link.getProperty('href')
+                url =  await prop.jsonValue()
+                urls.append(url)
+
+            # Cleanup
+            try:
+                await tab.close()
+            except:
+                pass
 
         return urls
 
-    async def _async_test_proxy(self,
+    async def _test_proxy(self,
                                 proxy,
                                 url,
                                 headless=True,
                                 timeout=10,
                                 bin_path=None,
                                 chrome_args=[],
-                                selector=None):
+                                selector=None,
+                                adaptive=None,
+                                require_all=True,
+                                engine='browser'):
         """
         Test `proxy` by attempting to load `url'.
 
+        Only with an `adaptive` timeout policy is the proxy connect probed
+        first; proxies failing the probe are skipped without launching a
+        browser and `latency['connect']` is set. The `http` engine
+        fetches targets over plain HTTP through the proxy instead of
+        chromium, checking `selector` against the raw HTML.
+
+        `url` may also be a list of targets, each a URL or a (url,
+        selector) pair, tested in turn within one browser context. The
+        result then carries per-target results under `targets`.
+
         :param proxy: The proxy to test
-        :param url: the URL to test against
+        :param url: the URL or list of targets to test against
         :param selector: css selector used to verify page load
         :param headless: run chrome headless mode
         :param timeout: the async task timeout
         :param bin_path: path to chrome executable
         :param chrome_args: headless chromium args
+        :param adaptive: per-proxy timeout policy
+        :param require_all: with several targets, all must pass and testing
+            stops at the first failure, otherwise any passing target is OK
+        :param engine: `browser` or `http`
 
         :type proxy: proxytools.Proxy
-        :type url: yarl.URL
+        :type url: yarl.URL or list
         :type selector: str
         :type headless: bool
         :type timeout: int
         :type bin_path: str
         :type chrome_args: list
+        :type adaptive: proxytools.timeout.AdaptiveTimeout
+        :type require_all: bool
+        :type engine: str
 
         :returns: dict
         """
-        chrome_args.append('--proxy-server=http={}'.format(str(proxy)))
-        chrome_args.append('--proxy-server=https={}'.format(str(proxy)))
-
-        kwargs = {
-            'headless': headless,
-            'args':  chrome_args
+        proxy = self._as_proxy(proxy)
+        test_start = time.perf_counter()
+        outcomes = self.metrics.counter('proxytools_proxy_tests_total', 'Proxy tests by outcome')
+        latency = {
+            'connect': None,
+            'ttfb': None,
+            'navigation': None,
+            'selector': None,
+            'total': None
         }
+        if adaptive:
+            # Probe first, so dead proxies are skipped and timeouts scale with RTT
+            try:
+                with self.tracer.span('connect_probe', proxy=proxy):
+                    latency['connect'] = await connect_time(proxy.host, proxy.port,
+                                                            timeout=adaptive.probe_timeout)
+            except ProbeError as e:
+                _logger.debug('Connect probe failed for {}: {}'.format(str(proxy), e))
+                outcomes.inc(outcome='ProbeError')
+                return {'proxy': str(proxy),
+                        'status': 'Connect probe failed: {}'.format(e),
+                        'latency': latency,
+                        'elapsed': round(time.perf_counter() - test_start, 3)}
+            timeout = adaptive.timeout_for(latency['connect'])
+
+        browser = None
+        context = None
+        try:
+            if engine == 'http':
+                def test_target(target_url, target_selector):
+                    return self._test_target_http(proxy, target_url, timeout, target_selector, adaptive)
+            else:
+                # Copy args so proxy flags don't leak between tests
+                chrome_args = list(chrome_args)
+                if proxy.scheme.startswith('socks'):
+                    chrome_args.append('--proxy-server={}'.format(str(proxy)))
+                else:
+                    chrome_args.append('--proxy-server=http={}'.format(str(proxy)))
+                    chrome_args.append('--proxy-server=https={}'.format(str(proxy)))
+
+                kwargs = {
+                    'headless': headless,
+                    'args':  chrome_args
+                }
+
+                if bin_path:
+                    kwargs['executablePath'] = bin_path
+
+                browser = await self._launch(kwargs)
+
+                # Create incognito tab, proxied per context on an attached browser
+                context = await self._new_context(browser, proxy if self.browser_endpoint else None)
+
+                def test_target(target_url, target_selector):
+                    return self._test_target(proxy, target_url, context, timeout, target_selector, adaptive)
+
+            targets = None
+            if isinstance(url, list):
+                targets = []
+                for target in url:
+                    if isinstance(target, (list, tuple)):
+                        target_url, target_selector = target
+                    else:
+                        target_url, target_selector = target, selector
+                    target_status, _, target_latency = await test_target(target_url, target_selector)
+                    targets.append({'url': str(target_url), 'selector': target_selector,
+                                    'status': target_status, 'latency': target_latency})
+                    if require_all and target_status != 'OK':
+                        break
+                passed = [t for t in targets if t['status'] == 'OK']
+                if require_all:
+                    ok = len(passed) == len(url)
+                else:
+                    ok = len(passed) > 0
+                if ok:
+                    status = 'OK'
+                    outcome = 'OK'
+                    # Slowest passing target bounds the proxy's latency
+                    latency['total'] = max(t['latency']['total'] for t in passed)
+                else:
+                    failed = [t for t in targets if t['status'] != 'OK']
+                    status = '{}: {}'.format(failed[-1]['url'], failed[-1]['status'])
+                    outcome = 'TargetFailed'
+            else:
+                status, outcome, target_latency = await test_target(url, selector)
+                latency.update(target_latency)
+        finally:
+            # Cleanup, also when the test is cancelled
+            if context is not None:
+                try:
+                    await context.close()
+                except:
+                    pass
+            if browser is not None:
+                await self._close_browser(browser)
+
+        elapsed = time.perf_counter() - test_start
+        outcomes.inc(outcome=outcome)
+        self.metrics.histogram('proxytools_proxy_test_seconds', 'Proxy test duration') \
+            .observe(elapsed)
+
+        for key, val in latency.items():
+            if val is not None:
+                latency[key] = round(val, 3)
+
+        result = {'proxy': str(proxy), 'status': status, 'latency': latency,
+                  'elapsed': round(elapsed, 3)}
+        if targets is not None:
+            for target in url[len(targets):]:
+                if isinstance(target, (list, tuple)):
+                    target_url, target_selector = target
+                else:
+                    target_url, target_selector = target, selector
+                targets.append({'url': str(target_url), 'selector': target_selector,
+                                'status': 'Skipped', 'latency': {}})
+            result['targets'] = targets
+        if adaptive:
+            result['timeout'] = round(timeout, 3)
+        return result
+
+    async def _test_target(self, proxy, url, context, timeout, selector, adaptive):
+        """
+        Load `url` through `proxy` in browser `context`.
 
-        if bin_path:
-            kwargs['executablePath'] = bin_path
-
-        browser = await pyppeteer.launch(kwargs)
-
-        # Create incognito tab
-        context = await browser.createIncognitoBrowserContext()
+        :returns: tuple of status, outcome and latency dict
+        """
+        latency = {}
         try:
-            page = await self.get_page(url, context, timeout=timeout, selector=selector)
+            with self.tracer.span('test_proxy', proxy=proxy, url=url):
+                page = await self.get_page(url, context, timeout=timeout, selector=selector)
             status = 'OK'
+            outcome = 'OK'
+            latency.update(page.timings)
+            latency['total'] = page.timings['navigation'] + page.timings.get('selector', 0)
+            if adaptive:
+                adaptive.record(latency['total'])
         except Exception as e:
             status = str(e)
+            outcome = type(e).__name__
+        for key, val in latency.items():
+            if val is not None:
+                latency[key] = round(val, 3)
+        return status, outcome, latency
 
-        # Cleanup
-        try:
-            await context.close()
-        except:
-            pass
+    async def _test_target_http(self, proxy, url, timeout, selector, adaptive):
+        """
+        Fetch `url` over plain HTTP through `proxy`, checking the raw
+        HTML for `selector`.
 
+        :returns: tuple of status, outcome and latency dict
+        """
+        latency = {}
+        if proxy.scheme.startswith('socks'):
+            return 'SOCKS proxies need the browser engine', 'Unsupported', latency
+        start = time.perf_counter()
         try:
-            await browser.close()
-        except:
-            pass
-
-        return {'proxy': str(proxy), 'status': status}
+            with self.tracer.span('test_proxy_http', proxy=proxy, url=url):
+                response, body = await httputil.fetch(
+                    yarl.URL(str(url)), timeout=timeout, proxy=proxy, timings=latency)
+            latency['navigation'] = time.perf_counter() - start
+            if response.status >= 400:
+                raise TaskError('HTTP status {}'.format(response.status))
+            if selector:
+                selector_start = time.perf_counter()
+                try:
+                    html = body.decode(httputil.charset(response), errors='replace')
+                except LookupError:
+                    html = body.decode('utf-8', errors='replace')
+                if bs4.BeautifulSoup(html, 'html.parser').select_one(selector) is None:
+                    raise TaskError('Selector not found: {}'.format(selector))
+                latency['selector'] = time.perf_counter() - selector_start
+            status = 'OK'
+            outcome = 'OK'
+            latency['total'] = time.perf_counter() - start
+            if adaptive:
+                adaptive.record(latency['total'])
+        except asyncio.TimeoutError:
+            status = 'HTTP fetch timed out'
+            outcome = 'TaskTimeout'
+        except (OSError, EOFError, httputil.HTTPError) as e:
+            status = str(e)
+            outcome = 'TaskError'
+        except TaskError as e:
+            status = str(e)
+            outcome = type(e).__name__
+        for key, val in latency.items():
+            if val is not None:
+                latency[key] = round(val, 3)
+        return status, outcome, latency
 
-    async def _async_test_proxies(self,
+    async def _test_proxies(self,
                                   proxies,
                                   url,
                                   headless=True,
                                   timeout=10,
                                   browser_concurrency=1,
                                   exit_success_count=None,
+                                  max_latency=None,
                                   selector=None,
                                   bin_path=None,
-                                  chrome_args=[]):
+                                  chrome_args=[],
+                                  adaptive=None,
+                                  on_result=None,
+                                  should_stop=None,
+                                  collect=True,
+                                  require_all=True,
+                                  concurrency=None,
+                                  engine='browser'):
         """
         Test `proxies` by attempting to load `url' and awaiting `selector`.
 
-        :param proxies: list of proxies
-        :param url: the URL to test the proxies against
+        `proxies` may be any iterable or async iterable. It is consumed
+        through a bounded queue, so proxies are read only as fast as
+        `browser_concurrency` workers test them.
+
+        :param proxies: iterable of proxies
+        :param url: the URL, or list of URLs and (url, selector) targets, to test the proxies against
         :param headless: run chrome headless mode
         :param timeout: seconds to wait before quitting each test
         :param browser_concurrency: max concurrent chromium tabs
         :param selector: css selector used to verify page load
         :param exit_success_count: exit when number of working proxies is reached
+        :param max_latency: only count proxies within this many seconds as working
         :param bin_path: path to chrome executable
         :param chrome_args: headless chromium args
-
-        :type proxies: list of proxytools.Proxy
-        :type url: yarl.URL
+        :param adaptive: per-proxy timeout policy
+        :param on_result: callback receiving each result as it completes
+        :param should_stop: callable checked before each test, True stops testing
+        :param collect: keep results in the returned list, disable to stream via `on_result`
+        :param require_all: with several targets, a proxy must pass every target
+        :param concurrency: controller limiting concurrent tests below `browser_concurrency`
+        :param engine: `browser` to load pages in chromium, `http` to fetch them over plain HTTP
+
+        :type proxies: iterable of proxytools.Proxy
+        :type url: yarl.URL or list
         :type headless: bool
         :type timeout: int
         :type browser_concurrency: int
         :type selector: str
         :type exit_success_count: int
+        :type max_latency: float
         :type bin_path: str
         :type chrome_args: list
+        :type adaptive: proxytools.timeout.AdaptiveTimeout
+        :type on_result: callable
+        :type should_stop: callable
+        :type collect: bool
+        :type require_all: bool
+        :type concurrency: proxytools.concurrency.AIMDController
+        :type engine: str
 
-        :returns: dict
+        :returns: list
         """
         results = []
         count = 0
         status_ok_count = 0
+        done = asyncio.Event()
         start_ts = datetime.datetime.now()
-        for chunk in self._chunker(proxies, browser_concurrency):
-            n_results = await asyncio.gather(
-                *[self._async_test_proxy(
+        queue_depth = self.metrics.gauge('proxytools_queue_depth', 'Items waiting in pipeline queues')
+        # Bounded so large inputs are read only as fast as they are tested
+        queue = asyncio.Queue(maxsize=browser_concurrency * 2)
+        total = len(proxies) if hasattr(proxies, '__len__') else None
+
+        async def produce():
+            cancelled = False
+            try:
+                if hasattr(proxies, '__aiter__'):
+                    async for proxy in proxies:
+                        if done.is_set():
+                            break
+                        if proxy:
+                            await queue.put(proxy)
+                else:
+                    for proxy in proxies:
+                        if done.is_set():
+                            break
+                        if proxy:
+                            await queue.put(proxy)
+            except asyncio.CancelledError:
+                # Consumers are cancelled too, sentinels could block on a full queue
+                cancelled = True
+                raise
+            finally:
+                if not cancelled:
+                    for _ in range(browser_concurrency):
+                        await queue.put(None)
+
+        async def test(proxy):
+            try:
+                return await self._test_proxy(
                     proxy, url, headless=headless,
-                    timeout=timeout, selector=selector, bin_path=bin_path, chrome_args=chrome_args) for proxy in chunk],
-                return_exceptions=True)
-            count += len(chunk)
-            minutes = round((datetime.datetime.now() - start_ts).seconds / 60, 2)
-            _logger.info('Tested {} of {} proxies in {} minutes'
-                         .format(count, len(proxies), minutes))
-            for result in n_results:
-                results.append(result)
-                if isinstance(result, dict):
-                    if result['status'] == 'OK':
-                        status_ok_count += 1
-                    if exit_success_count is not None:
-                        if status_ok_count == exit_success_count:
-                            return results
-            # results.extend(n_results)
+                    timeout=timeout, selector=selector, bin_path=bin_path, chrome_args=chrome_args,
+                    adaptive=adaptive, require_all=require_all, engine=engine)
+            except Exception as e:
+                return e
+
+        async def consume():
+            nonlocal count, status_ok_count
+            while True:
+                proxy = await queue.get()
+                if proxy is None:
+                    return
+                if done.is_set():
+                    continue
+                if should_stop is not None and should_stop():
+                    done.set()
+                    continue
+                if concurrency is not None:
+                    async with concurrency.slot():
+                        result = await test(proxy)
+                    concurrency.record(self._is_success(result))
+                else:
+                    result = await test(proxy)
+                if done.is_set():
+                    continue
+                count += 1
+                queue_depth.set(queue.qsize(), queue='tests')
+                if count % browser_concurrency == 0:
+                    minutes = round((datetime.datetime.now() - start_ts).seconds / 60, 2)
+                    _logger.info('Tested {} of {} proxies in {} minutes'
+                                 .format(count, total if total is not None else '?', minutes))
+                if collect:
+                    results.append(result)
+                if on_result is not None:
+                    on_result(result)
+                if isinstance(result, dict) and self._is_success(result, max_latency):
+                    status_ok_count += 1
+                    if exit_success_count is not None and status_ok_count >= exit_success_count:
+                        done.set()
+
+        producer = asyncio.ensure_future(produce())
+        consumers = [asyncio.ensure_future(consume()) for _ in range(browser_concurrency)]
+        try:
+            await asyncio.gather(*consumers)
+            await producer
+        finally:
+            # A failed consumer stops the rest, rather than leaving them and
+            # the producer waiting on each other
+            for task in consumers + [producer]:
+                task.cancel()
+            await asyncio.gather(*consumers, producer, return_exceptions=True)
+        queue_depth.set(0, queue='tests')
         return results
 
-    async def get_page(self, url, context, timeout=10, selector=None):
+    async def sweep(self, proxies, timeout=2, concurrency=4096):
+        """
+        Drop proxies that don't accept a TCP connection.
+
+        A cheap liveness check to run before `test_proxies`.
+
+        :param proxies: list of proxies
+        :param timeout: seconds to wait for each connect
+        :param concurrency: max open sockets, capped by the file descriptor limit
+
+        :type proxies: list of proxytools.Proxy
+        :type timeout: float
+        :type concurrency: int
+
+        :returns: list
+        """
+        proxies = list(proxies)
+        start_ts = datetime.datetime.now()
+        endpoints = ((p.host, p.port) for p in map(self._as_proxy, proxies))
+        alive = await sweep(endpoints, timeout=timeout, concurrency=concurrency)
+        seconds = (datetime.datetime.now() - start_ts).seconds
+        _logger.info('Sweep found {} of {} proxies alive in {} seconds'
+                     .format(len(alive), len(proxies), seconds))
+        return [proxy for idx, proxy in enumerate(proxies) if idx in alive]
+
+    async def detect_protocols(self, proxies, timeout=5, concurrency=1024):
+        """
+        Set the scheme of `proxies` from HTTP, CONNECT, SOCKS4 and SOCKS5
+        handshakes, dropping proxies that speak none of them.
+
+        :param proxies: list of proxies
+        :param timeout: seconds allowed for each proxy
+        :param concurrency: max open sockets, capped by the file descriptor limit
+
+        :type proxies: list of proxytools.Proxy
+        :type timeout: float
+        :type concurrency: int
+
+        :returns: list of proxytools.Proxy
+        """
+        proxies = [self._as_proxy(p) for p in proxies]
+        endpoints = ((p.host, p.port) for p in proxies)
+        protocols = await detect_protocols(endpoints, timeout=timeout, concurrency=concurrency)
+        detected = []
+        for idx, proxy in enumerate(proxies):
+            if idx in protocols:
+                proxy.scheme = PROTOCOL_SCHEMES[protocols[idx]]
+                detected.append(proxy)
+        _logger.info('Detected protocol for {} of {} proxies'.format(len(detected), len(proxies)))
+        return detected
+
+    async def get_page(self, url, context=None, timeout=10, selector=None, hedge=None):
         """
         Asynchronously fetch page from `url` using chromium
         browser `context`.
 
+        Without a `context`, the page is fetched in a fresh incognito
+        context on the client's shared headless browser.
+
         :param url: the page URL
         :param context: pyppeteer browser context
         :param timeout: seconds to wait before quiting
         :param selector: css selector used to verify page load
+        :param hedge: start a backup fetch when the page is slow to load
 
         :type url: yarl.URL
         :type context: pyppeteer.browser.BrowserContext
         :type timeout: int
         :type selector: str
+        :type hedge: proxytools.hedge.HedgePolicy
 
         :returns: Page
         :raises: TaskTimeout
         """
-        tab = await context.newPage()
-        # Fix viewport
-        await tab._client.send('Emulation.clearDeviceMetricsOverride');
+        if context is None:
+            async with self.browsers.context({'headless': True, 'args': []}) as context:
+                return await self.get_page(url, context, timeout=timeout, selector=selector, hedge=hedge)
+        if hedge is not None:
+            primary = functools.partial(self.get_page, url, context, timeout=timeout, selector=selector)
+            if hedge.mode == 'http':
+                backup = functools.partial(self._get_page_http, url, timeout=timeout)
+            else:
+                backup = primary
+            hedges = self.metrics.counter('proxytools_page_hedges_total', 'Backup page fetches by winner')
+            backup_wins = hedge.backup_wins
+            hedged = hedge.hedged
+            try:
+                return await hedge.run(primary, backup, timeout=timeout)
+            finally:
+                if hedge.hedged > hedged:
+                    hedges.inc(winner='backup' if hedge.backup_wins > backup_wins else 'primary')
+        with self.tracer.span('newPage'):
+            tab = await context.newPage()
+            # Fix viewport
+            await tab._client.send('Emulation.clearDeviceMetricsOverride');
+        try:
+            return await self._load_tab(tab, url, timeout, selector)
+        finally:
+            # Close page tab, also when the fetch failed or lost a hedge
+            try:
+                await tab.close()
+            except:
+                pass
+
+    async def _load_tab(self, tab, url, timeout, selector):
+        """
+        Load `url` in browser `tab`.
+
+        :returns: Page
+        :raises: TaskTimeout, TaskError
+        """
         _logger.info('Fetching {}'.format(url))
+        # Record arrival of the first response headers
+        timings = {}
+        first_response = []
+        tab.on('response', lambda response: first_response.append(time.perf_counter()))
+        fetches = self.metrics.counter('proxytools_page_fetches_total', 'Page fetches by outcome')
         # Get page html
         # Proxy timeouts don't seem to respect load_timeout, so enforce it with asyncio
+        start = time.perf_counter()
         try:
-            resp = await asyncio.wait_for(tab.goto(str(url), timeout=timeout*1000), timeout=timeout)
+            with self.tracer.span('tab.goto', url=url):
+                resp = await asyncio.wait_for(tab.goto(str(url), timeout=timeout*1000), timeout=timeout)
         except asyncio.TimeoutError:
             _logger.warning('Timed out fetching: {}'.format(str(url)))
+            fetches.inc(outcome='TaskTimeout')
             raise TaskTimeout('Navigation timed out')
         except Exception as e:
+            fetches.inc(outcome='TaskError')
             raise TaskError(str(e))
+        timings['navigation'] = time.perf_counter() - start
+        fetches.inc(outcome='OK')
+        self.metrics.histogram('proxytools_page_fetch_seconds', 'Page navigation duration') \
+            .observe(timings['navigation'])
+        if first_response:
+            timings['ttfb'] = first_response[0] - start
 
         # Handle cloudlflare
-        html = await resp.text()
+        with self.tracer.span('resp.text'):
+            html = await resp.text()
 
         # Needs work
         # if self.detect_cloudflare(html):
@@ -355,17 +960,41 @@ class Client:
 
         _logger.info('Got {}'.format(str(url)))
         if selector:
-            await tab.waitForSelector(selector, timeout=timeout*1000)
-        html = await resp.text()
-        # Close page tab
-        try:
-            await tab.close()
-        except:
-            pass
-        page = Page(url=url, html=html)
+            selector_start = time.perf_counter()
+            with self.tracer.span('waitForSelector', selector=selector):
+                await tab.waitForSelector(selector, timeout=timeout*1000)
+            timings['selector'] = time.perf_counter() - selector_start
+        with self.tracer.span('resp.text'):
+            html = await resp.text()
+        page = Page(url=url, html=html, timings=timings, parser=self.parser)
         return page
 
-    def get_pages(self, urls, timeout=10, tab_concurrency=10, headless=True, bin_path=None, chrome_args=[]):
+    async def _get_page_http(self, url, timeout=10):
+        """
+        Fetch page from `url` over plain HTTP, without running javascript.
+
+        :returns: Page
+        :raises: TaskTimeout, TaskError
+        """
+        start = time.perf_counter()
+        try:
+            with self.tracer.span('http.fetch', url=url):
+                response, body = await httputil.fetch(yarl.URL(str(url)), timeout=timeout)
+        except asyncio.TimeoutError:
+            raise TaskTimeout('HTTP fetch timed out')
+        except (OSError, EOFError, httputil.HTTPError) as e:
+            raise TaskError(str(e))
+        if response.status >= 400:
+            raise TaskError('HTTP status {}'.format(response.status))
+        timings = {'navigation': time.perf_counter() - start}
+        try:
+            html = body.decode(httputil.charset(response), errors='replace')
+        except LookupError:
+            html = body.decode('utf-8', errors='replace')
+        return Page(url=url, html=html, timings=timings, parser=self.parser)
+
+    async def get_pages(self, urls, timeout=10, tab_concurrency=10, headless=True, archive=None,
+                        adaptive_concurrency=False, bin_path=None, chrome_args=[]):
         """
         Get pages from `urls` using chromium browser.
 
@@ -376,11 +1005,16 @@ class Client:
         :param bin_path: path to chrome executable
         :param chrome_args: headless chromium args
         :param tab_concurrency: max concurrent chromium tabs
+        :param archive: record fetched pages to this archive (defaults to the client's archive)
+        :param adaptive_concurrency: adapt concurrent tabs to throughput and load,
+            up to `tab_concurrency`
 
         :type urls: list
         :type bin_path: str
         :type chrome_args: list
         :type tab_concurrency: int
+        :type archive: proxytools.archive.PageArchive
+        :type adaptive_concurrency: bool
 
         :type urls: list
         :type bin_path: str
@@ -389,43 +1023,38 @@ class Client:
         """
         # Convert url strings in to yarl.URLs
         urls = [yarl.URL(url) for url in urls]
-        results = self.loop.run_until_complete(
-            self._async_get_pages(urls,
-                                  timeout=timeout,
-                                  headless=headless,
-                                  bin_path=bin_path,
-                                  tab_concurrency=tab_concurrency,
-                                  chrome_args=chrome_args))
+        if adaptive_concurrency:
+            async with self._adaptive_concurrency('pages', tab_concurrency) as concurrency:
+                results = await self._get_pages(urls,
+                                                timeout=timeout,
+                                                headless=headless,
+                                                bin_path=bin_path,
+                                                chrome_args=chrome_args,
+                                                concurrency=concurrency)
+        else:
+            results = await self._get_pages(urls,
+                                            timeout=timeout,
+                                            headless=headless,
+                                            bin_path=bin_path,
+                                            tab_concurrency=tab_concurrency,
+                                            chrome_args=chrome_args)
+        archive = archive if archive is not None else self.archive
         pages = []
         for result in results:
             if isinstance(result, Page):
                 pages.append(result)
+                if archive is not None:
+                    archive.append(result)
             else:
                 _logger.warning(result)
+        if self.hedge is not None:
+            self.hedge.save()
 
         return pages
 
-    def get_source_urls(self, headless=True, num=10, bin_path=None, chrome_args=[]):
-        """
-        Search Google for URLs containing free proxy lists.
-
-        :param num: number of proxy sources to get from Google
-        :param headless: run chrome headless mode
-        :param bin_path: path to chrome executable
-        :param chrome_args: headless chromium args
-
-        :type num: int
-        :type headless: bool
-        :type bin_path: str
-        :type chrome_args: list
-
-        :returns: list
-        """
-        _logger.info('Searching Google for proxy sources..')
-        return self.loop.run_until_complete(
-            self._async_get_source_urls(headless=headless, num=num, bin_path=bin_path, chrome_args=chrome_args))
-
-    def get_pages_with_proxies(self, source_num=10, headless=True, tab_concurrency=10, bin_path=None, chrome_args=[]):
+    async def get_pages_with_proxies(self, source_num=10, headless=True, tab_concurrency=10,
+                                     fetch_budget=None, adaptive_concurrency=False,
+                                     bin_path=None, chrome_args=[]):
         """
         Scrape the web for pages containing proxies.
 
@@ -434,24 +1063,42 @@ class Client:
         :param bin_path: path to chrome executable
         :param chrome_args: headless chromium args
         :param tab_concurrency: max concurrent chromium tabs
+        :param fetch_budget: fetch at most this many sources, best-yielding first,
+            and record source statistics
+        :param adaptive_concurrency: adapt concurrent tabs to throughput and load,
+            up to `tab_concurrency`
 
         :type source_num: int
         :type headless: bool
         :type bin_path: str
         :type chrome_args: list
         :type tab_concurrency: int
+        :type fetch_budget: int
+        :type adaptive_concurrency: bool
 
         :returns: list
         """
-        urls = self.get_source_urls(num=source_num, headless=headless, bin_path=bin_path, chrome_args=chrome_args)
+        urls = await self.get_source_urls(num=source_num, headless=headless, bin_path=bin_path, chrome_args=chrome_args)
         _logger.info('Found {} source URLs'.format(len(urls)))
-        pages = self.get_pages(urls, headless=headless, tab_concurrency=tab_concurrency, bin_path=bin_path, chrome_args=chrome_args)
+        if fetch_budget is not None:
+            urls = self.sources.allocate(urls, fetch_budget)
+        pages = await self.get_pages(urls, headless=headless, tab_concurrency=tab_concurrency,
+                                     adaptive_concurrency=adaptive_concurrency,
+                                     bin_path=bin_path, chrome_args=chrome_args)
         _logger.info('Downloaded {} pages'.format(len(pages)))
         proxy_pages = [page for page in pages if page.contains_ips()]
         _logger.info('Found {} pages containing proxies'.format(len(pages)))
+        if fetch_budget is not None:
+            # Failed fetches and pages without proxies yield nothing
+            proxy_urls = {str(page.url) for page in proxy_pages}
+            for url in urls:
+                if str(url) not in proxy_urls:
+                    self.sources.record_fetch(url, 0)
         return proxy_pages
 
-    def search_proxies(self, source_num=10, tab_concurrency=10, headless=True, bin_path=None, chrome_args=[]):
+    async def search_proxies(self, source_num=10, tab_concurrency=10, headless=True,
+                             fetch_budget=None, adaptive_concurrency=False,
+                             bin_path=None, chrome_args=[]):
         """
         Scrape the web for proxies.
 
@@ -460,69 +1107,180 @@ class Client:
         :param bin_path: path to chrome executable
         :param chrome_args: headless chromium args
         :param tab_concurrency: max concurrent chromium tabs
+        :param fetch_budget: fetch at most this many sources, best-yielding first,
+            and record source statistics
+        :param adaptive_concurrency: adapt concurrent tabs to throughput and load,
+            up to `tab_concurrency`
 
         :type source_num: int
         :type headless: bool
         :type bin_path: str
         :type chrome_args: list
         :type tab_concurrency: int
+        :type fetch_budget: int
+        :type adaptive_concurrency: bool
 
         :returns: list
         """
         proxies = []
-        proxy_pages = self.get_pages_with_proxies(source_num=source_num,
-                                                  headless=headless,
-                                                  tab_concurrency=tab_concurrency,
-                                                  bin_path=bin_path,
-                                                  chrome_args=chrome_args)
+        proxy_pages = await self.get_pages_with_proxies(source_num=source_num,
+                                                        headless=headless,
+                                                        tab_concurrency=tab_concurrency,
+                                                        fetch_budget=fetch_budget,
+                                                        adaptive_concurrency=adaptive_concurrency,
+                                                        bin_path=bin_path,
+                                                        chrome_args=chrome_args)
         for page in proxy_pages:
-            proxies.extend(page.proxies())
+            page_proxies = page.proxies()
+            if fetch_budget is not None:
+                self.sources.record_fetch(page.url, len(page_proxies))
+            proxies.extend(page_proxies)
         _logger.info('Scraped {} proxies'.format(len(proxies)))
         return proxies
 
-    def test_proxies(self, proxies, url, timeout=10,
-                     selector=None, headless=True, browser_concurrency=2,
-                     exit_success_count=None, bin_path=None, chrome_args=[]):
+    async def test_proxies(self, proxies, url, timeout=10,
+                           selector=None, headless=True, browser_concurrency=2,
+                           exit_success_count=None, max_latency=None, adaptive_timeout=False,
+                           processes=1, on_result=None, collect=True, require_all=True,
+                           should_stop=None, schedule=False, adaptive_concurrency=False,
+                           engine='browser', bin_path=None, chrome_args=[]):
         """
         Test proxies can load page at `url`.
 
-        :param proxies: list of proxies
-        :param url: the URL to test the proxies against
+        `url` may be a list of targets, each a URL or a (url, selector)
+        pair, checked in one browser context per proxy. Results then
+        include per-target results under `targets`.
+
+        :param proxies: iterable or async iterable of proxies
+        :param url: the URL or list of targets to test the proxies against
         :param headless: run chrome headless mode
         :param timeout: seconds to wait before quitting each test
         :param browser_concurrency: max concurrent chromium browsers
         :param selector: css selector used to verify page load
         :param exit_success_count: exit when number of working proxies is reached
+        :param max_latency: only count proxies within this many seconds as working
+        :param adaptive_timeout: derive per-proxy timeouts from connect probes and history
+        :param processes: shard tests across this many processes, each with its own browsers
+        :param on_result: callback receiving each result as it completes
+        :param collect: keep results in the returned list, disable to stream via `on_result`
+        :param require_all: with several targets, all must pass and testing stops at the
+            first failure, otherwise any passing target is OK
+        :param should_stop: callable checked before each test, True stops testing
+        :param schedule: test proxies most likely to work first and learn from the results
+        :param adaptive_concurrency: adapt concurrent tests to throughput and load,
+            up to `browser_concurrency`
+        :param engine: `browser` to load pages in chromium, `http` to fetch them over
+            plain HTTP through the proxy, checking `selector` without running javascript
         :param bin_path: path to chrome executable
         :param chrome_args: headless chromium args
 
-        :type proxies: list of proxytools.Proxy
-        :type url: yarl.URL
+        :type proxies: iterable of proxytools.Proxy
+        :type url: yarl.URL or list
         :type headless: bool
         :type timeout: int
         :type browser_concurrency: int
         :type selector: str
         :type exit_success_count: int
+        :type max_latency: float
+        :type adaptive_timeout: bool
+        :type processes: int
+        :type on_result: callable
+        :type collect: bool
+        :type require_all: bool
+        :type should_stop: callable
+        :type schedule: bool
+        :type adaptive_concurrency: bool
+        :type engine: str
         :type bin_path: str
         :type chrome_args: list
 
-        :returns: dict
+        :returns: list
+        :raises: ValueError
         """
-        return self.loop.run_until_complete(
-            self._async_test_proxies(proxies,
-                                     url,
-                                     timeout=timeout,
-                                     browser_concurrency=browser_concurrency,
-                                     selector=selector,
-                                     exit_success_count=exit_success_count,
-                                     headless=headless,
-                                     bin_path=bin_path,
-                                     chrome_args=chrome_args))
-
-    def get_proxies(self, test_url, limit=10, timeout=10,
-                    selector=None, headless=True, browser_concurrency=2,
-                    tab_concurrency=10, source_num=10,
-                    bin_path=None, chrome_args=[]):
+        if isinstance(url, list) and not url:
+            raise ValueError('At least one target URL is required')
+        # Scheduling and sharding need the whole list
+        if (schedule or processes > 1) and hasattr(proxies, '__aiter__'):
+            proxies = [proxy async for proxy in proxies]
+        if schedule:
+            proxies = self.scheduler.order([self._as_proxy(p) for p in proxies])
+            proxy_map = {str(p): p for p in proxies}
+            callback = on_result
+
+            def on_result(result):
+                if isinstance(result, dict) and result['proxy'] in proxy_map:
+                    self.scheduler.record(proxy_map[result['proxy']], result['status'] == 'OK')
+                if callback is not None:
+                    callback(result)
+
+            try:
+                return await self.test_proxies(
+                    proxies, url, timeout=timeout, selector=selector, headless=headless,
+                    browser_concurrency=browser_concurrency, exit_success_count=exit_success_count,
+                    max_latency=max_latency, adaptive_timeout=adaptive_timeout, processes=processes,
+                    on_result=on_result, collect=collect, require_all=require_all,
+                    should_stop=should_stop, adaptive_concurrency=adaptive_concurrency,
+                    engine=engine, bin_path=bin_path, chrome_args=chrome_args)
+            finally:
+                self.scheduler.save()
+
+        if processes > 1:
+            loop = asyncio.get_event_loop()
+            if on_result is not None:
+                # Deliver results on the caller's loop rather than the executor thread
+                callback = on_result
+                on_result = lambda result: loop.call_soon_threadsafe(callback, result)
+            return await loop.run_in_executor(None, functools.partial(
+                test_proxies_in_processes,
+                proxies, url, processes,
+                is_success=lambda result: self._is_success(result, max_latency),
+                exit_success_count=exit_success_count,
+                on_result=on_result,
+                require_all=require_all,
+                timeout=timeout,
+                browser_concurrency=browser_concurrency,
+                selector=selector,
+                max_latency=max_latency,
+                headless=headless,
+                adaptive_timeout=adaptive_timeout,
+                adaptive_concurrency=adaptive_concurrency,
+                engine=engine,
+                bin_path=bin_path,
+                chrome_args=chrome_args))
+
+        adaptive = None
+        if adaptive_timeout:
+            adaptive = AdaptiveTimeout(timeout=timeout, history=self.latency_history)
+        kwargs = dict(timeout=timeout,
+                      browser_concurrency=browser_concurrency,
+                      selector=selector,
+                      exit_success_count=exit_success_count,
+                      max_latency=max_latency,
+                      headless=headless,
+                      bin_path=bin_path,
+                      chrome_args=chrome_args,
+                      adaptive=adaptive,
+                      on_result=on_result,
+                      should_stop=should_stop,
+                      collect=collect,
+                      require_all=require_all,
+                      engine=engine)
+        if adaptive_concurrency:
+            async with self._adaptive_concurrency('tests', browser_concurrency) as concurrency:
+                results = await self._test_proxies(proxies, url, concurrency=concurrency, **kwargs)
+        else:
+            results = await self._test_proxies(proxies, url, **kwargs)
+        if adaptive:
+            self.latency_history.save()
+        return results
+
+    async def get_proxies(self, test_url, limit=10, timeout=10,
+                          selector=None, headless=True, browser_concurrency=2,
+                          tab_concurrency=10, source_num=10, max_latency=None,
+                          rank=False, candidates=None, adaptive_timeout=False,
+                          sweep=False, detect_protocol=False, processes=1, schedule=False,
+                          fetch_budget=None, test_budget=None, adaptive_concurrency=False,
+                          bin_path=None, chrome_args=[]):
         """
         Scrape the web for working proxies.
         Test proxies can load `test_url`.
@@ -535,6 +1293,18 @@ class Client:
         :param tab_concurrency: max number of concurrent chromium tabs
         :param selector: css selector used to verify proxy is working
         :param source_num: number of proxy sources to get from Google
+        :param max_latency: drop proxies slower than this many seconds
+        :param rank: return fastest proxies first
+        :param candidates: working proxies to collect before ranking (defaults to `limit`)
+        :param adaptive_timeout: derive per-proxy timeouts from connect probes and history
+        :param sweep: drop dead endpoints with a TCP connect sweep before testing
+        :param detect_protocol: detect http/socks protocol of proxies before testing
+        :param processes: shard tests across this many processes
+        :param schedule: test proxies most likely to work first and learn from the results
+        :param fetch_budget: fetch at most this many sources, best-yielding first
+        :param test_budget: test at most this many proxies, from best-yielding sources first
+        :param adaptive_concurrency: adapt concurrent tabs and tests to throughput and load,
+            up to `tab_concurrency` and `browser_concurrency`
         :param bin_path: path to chrome executable
         :param chrome_args: headless chromium args
 
@@ -546,41 +1316,287 @@ class Client:
         :type tab_concurrency: int
         :type selector: str
         :type source_num: int
+        :type max_latency: float
+        :type rank: bool
+        :type candidates: int
+        :type adaptive_timeout: bool
+        :type sweep: bool
+        :type detect_protocol: bool
+        :type processes: int
+        :type schedule: bool
+        :type fetch_budget: int
+        :type test_budget: int
+        :type adaptive_concurrency: bool
         :type bin_path: str
         :type chrome_args: list
 
         :returns: dict
         """
-        proxies = self.search_proxies(source_num=source_num,
-                                      headless=headless,
-                                      tab_concurrency=tab_concurrency,
-                                      bin_path=bin_path,
-                                      chrome_args=chrome_args)
-
-        results = self.test_proxies(proxies,
-                                    test_url,
-                                    headless=headless,
-                                    browser_concurrency=browser_concurrency,
-                                    selector=selector,
-                                    exit_success_count=limit,
-                                    bin_path=bin_path,
-                                    chrome_args=chrome_args)
-        proxies = [r for r in results if r['status'] == 'OK']
+        proxies = await self.search_proxies(source_num=source_num,
+                                            headless=headless,
+                                            tab_concurrency=tab_concurrency,
+                                            fetch_budget=fetch_budget,
+                                            adaptive_concurrency=adaptive_concurrency,
+                                            bin_path=bin_path,
+                                            chrome_args=chrome_args)
+
+        if sweep:
+            proxies = await self.sweep(proxies)
+        if detect_protocol:
+            proxies = await self.detect_protocols(proxies)
+
+        on_result = None
+        track_sources = fetch_budget is not None or test_budget is not None
+        if test_budget is not None:
+            proxies = self.sources.allocate_tests(proxies, test_budget)
+        if track_sources:
+            source_map = {str(p): p.source for p in proxies if p.source}
+
+            def on_result(result):
+                if isinstance(result, dict) and result['proxy'] in source_map:
+                    self.sources.record_test(source_map[result['proxy']], result['status'] == 'OK')
+
+        exit_success_count = limit
+        if rank and candidates:
+            exit_success_count = max(limit, candidates)
+
+        results = await self.test_proxies(proxies,
+                                          test_url,
+                                          timeout=timeout,
+                                          headless=headless,
+                                          browser_concurrency=browser_concurrency,
+                                          selector=selector,
+                                          exit_success_count=exit_success_count,
+                                          max_latency=max_latency,
+                                          adaptive_timeout=adaptive_timeout,
+                                          processes=processes,
+                                          schedule=schedule,
+                                          on_result=on_result,
+                                          adaptive_concurrency=adaptive_concurrency,
+                                          bin_path=bin_path,
+                                          chrome_args=chrome_args)
+        if track_sources:
+            self.sources.commit()
+            self.sources.save()
+        proxies = [r for r in results if self._is_success(r, max_latency)]
+        if rank:
+            proxies.sort(key=self._latency_key)
         return proxies[0:limit]
 
-    def get_geography(self, proxies):
+    async def get_geography(self, proxies):
         """
         Get geographic location of `proxies`.
 
+        Whois lookups run in the default executor so they don't block
+        the event loop.
+
         :param proxies: list of proxy URLs
         :type proxies: list
         :returns: dict
         """
+        loop = asyncio.get_event_loop()
         results = {}
         for p in proxies:
             proxy = Proxy.from_string(p)
-            country = proxy.country()
+            with self.tracer.span('whois', host=proxy.host):
+                country = await loop.run_in_executor(None, proxy.country)
             results[p] = country
-            time.sleep(1)
+            await asyncio.sleep(1)
 
         return results
+
+
+class Client:
+    """
+    Proxytools client.
+
+    The is the main entry point for proxytools. A blocking wrapper
+    running `AsyncClient` coroutines in its own event loop.
+    """
+    def __init__(self, debug=False, metrics=None, tracer=None, browser_endpoint=None,
+                 max_browser_pages=200, max_browser_memory=None, archive=None, hedge=None):
+        """
+        :param debug: enable asyncio debug mode
+        :param metrics: registry for pipeline metrics (defaults to the shared registry)
+        :param tracer: span tracer (defaults to the shared tracer)
+        :param browser_endpoint: devtools websocket of a running browser to attach to
+            instead of launching chromium, e.g. from `proxytools daemon` (defaults to
+            the PROXYTOOLS_BROWSER_ENDPOINT environment variable)
+        :param max_browser_pages: pages opened before the shared browser is recycled
+        :param max_browser_memory: MiB of resident memory before the shared browser is recycled
+        :param archive: record pages fetched by `get_pages` to this archive
+        :param hedge: policy for backup fetches of slow source pages in `get_pages`
+
+        :type debug: bool
+        :type metrics: proxytools.metrics.MetricsRegistry
+        :type tracer: proxytools.trace.Tracer
+        :type browser_endpoint: str
+        :type max_browser_pages: int
+        :type max_browser_memory: int
+        :type archive: proxytools.archive.PageArchive
+        :type hedge: proxytools.hedge.HedgePolicy
+        """
+        self.loop = asyncio.get_event_loop()
+        self.debug = debug
+        self.loop.set_debug(self.debug)
+        self.async_client = AsyncClient(metrics=metrics, tracer=tracer,
+                                        browser_endpoint=browser_endpoint,
+                                        max_browser_pages=max_browser_pages,
+                                        max_browser_memory=max_browser_memory,
+                                        archive=archive,
+                                        hedge=hedge)
+        self.metrics = self.async_client.metrics
+        self.tracer = self.async_client.tracer
+        self.parser = self.async_client.parser
+
+    @property
+    def latency_history(self):
+        """
+        Historical latencies of successful proxy tests.
+
+        :returns: proxytools.timeout.LatencyHistory
+        """
+        return self.async_client.latency_history
+
+    @property
+    def geoip_url(self):
+        """
+        See `AsyncClient.geoip_url`.
+        """
+        return self.async_client.geoip_url
+
+    @geoip_url.setter
+    def geoip_url(self, url):
+        self.async_client.geoip_url = url
+
+    @property
+    def whois_server(self):
+        """
+        See `AsyncClient.whois_server`.
+        """
+        return self.async_client.whois_server
+
+    @whois_server.setter
+    def whois_server(self, server):
+        self.async_client.whois_server = server
+
+    def stats(self):
+        """
+        See `AsyncClient.stats`.
+        """
+        return self.async_client.stats()
+
+    def _run(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    def close(self):
+        """
+        Close browsers shared between calls.
+        """
+        self._run(self.async_client.close())
+
+    def detect_cloudflare(self, html):
+        """
+        Return True if html is cloudflare.
+        """
+        return self.async_client.detect_cloudflare(html)
+
+    def get_page(self, *args, **kwargs):
+        """
+        Get page at `url` using chromium browser.
+
+        See `AsyncClient.get_page`.
+
+        :returns: proxytools.page.Page
+        """
+        return self._run(self.async_client.get_page(*args, **kwargs))
+
+    def get_pages(self, *args, **kwargs):
+        """
+        Get pages from `urls` using chromium browser.
+
+        See `AsyncClient.get_pages`.
+
+        :returns: list of proxytools.page.Page
+        """
+        return self._run(self.async_client.get_pages(*args, **kwargs))
+
+    def get_source_urls(self, *args, **kwargs):
+        """
+        Search Google for URLs containing free proxy lists.
+
+        See `AsyncClient.get_source_urls`.
+
+        :returns: list
+        """
+        return self._run(self.async_client.get_source_urls(*args, **kwargs))
+
+    def get_pages_with_proxies(self, *args, **kwargs):
+        """
+        Scrape the web for pages containing proxies.
+
+        See `AsyncClient.get_pages_with_proxies`.
+
+        :returns: list
+        """
+        return self._run(self.async_client.get_pages_with_proxies(*args, **kwargs))
+
+    def search_proxies(self, *args, **kwargs):
+        """
+        Scrape the web for proxies.
+
+        See `AsyncClient.search_proxies`.
+
+        :returns: list
+        """
+        return self._run(self.async_client.search_proxies(*args, **kwargs))
+
+    def sweep(self, *args, **kwargs):
+        """
+        Drop proxies that don't accept a TCP connection.
+
+        See `AsyncClient.sweep`.
+
+        :returns: list
+        """
+        return self._run(self.async_client.sweep(*args, **kwargs))
+
+    def detect_protocols(self, *args, **kwargs):
+        """
+        Detect proxy protocols, dropping proxies that speak none.
+
+        See `AsyncClient.detect_protocols`.
+
+        :returns: list of proxytools.Proxy
+        """
+        return self._run(self.async_client.detect_protocols(*args, **kwargs))
+
+    def test_proxies(self, *args, **kwargs):
+        """
+        Test proxies can load page at `url`.
+
+        See `AsyncClient.test_proxies`.
+
+        :returns: list
+        """
+        return self._run(self.async_client.test_proxies(*args, **kwargs))
+
+    def get_proxies(self, *args, **kwargs):
+        """
+        Scrape the web for working proxies.
+
+        See `AsyncClient.get_proxies`.
+
+        :returns: list
+        """
+        return self._run(self.async_client.get_proxies(*args, **kwargs))
+
+    def get_geography(self, *args, **kwargs):
+        """
+        Get geographic location of `proxies`.
+
+        See `AsyncClient.get_geography`.
+
+        :returns: dict
+        """
+        return self._run(self.async_client.get_geography(*args, **kwargs))
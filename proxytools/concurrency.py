@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+"""
+Module for adaptive concurrency limits.
+"""
+import asyncio
+import contextlib
+import logging
+import time
+
+from .memory import memory_used
+
+# Module vars
+_logger = logging.getLogger(__name__)
+
+
+class AIMDController:
+    """
+    Additive increase, multiplicative decrease concurrency limit.
+
+    Every `window` seconds the limit grows by `increase` while
+    throughput holds up, and is cut by `decrease` when the error rate
+    rises above its recent average, the event loop lags or system
+    memory runs short.
+    """
+    def __init__(self, max_limit, min_limit=1, initial=None, increase=1, decrease=0.7,
+                 window=5, error_tolerance=0.1, min_samples=10, max_lag=0.25, max_memory=0.9,
+                 name='tasks'):
+        """
+        :param max_limit: max concurrent tasks
+        :param min_limit: min concurrent tasks
+        :param initial: starting limit (defaults to a quarter of `max_limit`)
+        :param increase: tasks added per window without trouble
+        :param decrease: factor the limit is cut by on trouble
+        :param window: seconds between adjustments
+        :param error_tolerance: rise in error rate over its average that counts as trouble
+        :param min_samples: tasks completed in a window before its error rate is judged
+        :param max_lag: seconds of event loop lag that count as trouble
+        :param max_memory: used share of system memory that counts as trouble
+        :param name: stage name used in logs and stats
+
+        :type max_limit: int
+        :type min_limit: int
+        :type initial: int
+        :type increase: int
+        :type decrease: float
+        :type window: float
+        :type error_tolerance: float
+        :type min_samples: int
+        :type max_lag: float
+        :type max_memory: float
+        :type name: str
+        """
+        self.max_limit = max(max_limit, min_limit)
+        self.min_limit = min_limit
+        if initial is None:
+            initial = self.max_limit // 4
+        self.limit = min(max(initial, min_limit), self.max_limit)
+        self.increase = increase
+        self.decrease = decrease
+        self.window = window
+        self.error_tolerance = error_tolerance
+        self.min_samples = min_samples
+        self.max_lag = max_lag
+        self.max_memory = max_memory
+        self.name = name
+        self.active = 0
+        self.peak_limit = self.limit
+        self.adjustments = []
+        self._cond = None
+        self._monitor = None
+        self._reset_window()
+        self._error_rate = None
+        self._last_throughput = None
+
+    def _reset_window(self):
+        self._window_start = time.perf_counter()
+        self._completed = 0
+        self._errors = 0
+        self._lag = 0.0
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.stop()
+
+    async def start(self):
+        """
+        Start sampling event loop lag and adjusting the limit.
+        """
+        self._cond = asyncio.Condition()
+        self._reset_window()
+        self._monitor = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        """
+        Stop adjusting the limit.
+        """
+        if self._monitor is not None:
+            self._monitor.cancel()
+            try:
+                await self._monitor
+            except asyncio.CancelledError:
+                pass
+            self._monitor = None
+        _logger.info('Concurrency of {}: final {}, peak {}'.format(self.name, self.limit, self.peak_limit))
+
+    async def _run(self, interval=0.1):
+        loop = asyncio.get_event_loop()
+        while True:
+            before = loop.time()
+            await asyncio.sleep(interval)
+            self._lag = max(self._lag, loop.time() - before - interval)
+            if time.perf_counter() - self._window_start >= self.window:
+                self.adjust()
+                async with self._cond:
+                    self._cond.notify_all()
+
+    @contextlib.asynccontextmanager
+    async def slot(self):
+        """
+        Hold one of `limit` concurrent slots.
+        """
+        async with self._cond:
+            await self._cond.wait_for(lambda: self.active < self.limit)
+            self.active += 1
+        try:
+            yield
+        finally:
+            async with self._cond:
+                self.active -= 1
+                self._cond.notify_all()
+
+    def record(self, success):
+        """
+        Record a completed task.
+
+        :param success: the task succeeded
+        :type success: bool
+        """
+        self._completed += 1
+        if not success:
+            self._errors += 1
+
+    def adjust(self):
+        """
+        Adjust the limit from the signals of the current window.
+
+        :returns: int the new limit
+        """
+        elapsed = time.perf_counter() - self._window_start
+        completed, errors, lag = self._completed, self._errors, self._lag
+        self._reset_window()
+        memory = memory_used()
+
+        reason = None
+        if lag > self.max_lag:
+            reason = 'loop lag {:.2f}s'.format(lag)
+        elif memory is not None and memory > self.max_memory:
+            reason = 'memory {:.0%}'.format(memory)
+        elif completed >= self.min_samples:
+            error_rate = errors / completed
+            if self._error_rate is not None and error_rate > self._error_rate + self.error_tolerance:
+                reason = 'error rate {:.0%}'.format(error_rate)
+            # Smoothed, so a lasting shift in input quality is absorbed
+            if self._error_rate is None:
+                self._error_rate = error_rate
+            else:
+                self._error_rate = 0.3 * error_rate + 0.7 * self._error_rate
+
+        previous = self.limit
+        if reason:
+            self.limit = max(self.min_limit, int(self.limit * self.decrease))
+        elif completed:
+            throughput = completed / elapsed
+            # Grow while throughput holds up, allowing for noise
+            if self._last_throughput is None or throughput >= self._last_throughput * 0.9:
+                self.limit = min(self.max_limit, self.limit + self.increase)
+            self._last_throughput = throughput
+        self.peak_limit = max(self.peak_limit, self.limit)
+        if self.limit != previous:
+            _logger.debug('Concurrency of {}: {} -> {}{}'.format(
+                self.name, previous, self.limit, ' ({})'.format(reason) if reason else ''))
+            self.adjustments.append((round(time.time(), 3), self.limit, reason))
+        return self.limit
+
+    def as_dict(self):
+        """
+        Return dictionary representation of object.
+
+        :returns: dict
+        """
+        return {
+            'limit': self.limit,
+            'peak_limit': self.peak_limit,
+            'min_limit': self.min_limit,
+            'max_limit': self.max_limit,
+            'adjustments': len(self.adjustments)
+        }
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""
+Module for a persistent Chromium daemon.
+
+The daemon keeps a warm browser running and records its devtools
+websocket endpoint in the state directory, so short-lived clients can
+attach with `pyppeteer.connect` instead of launching Chromium.
+"""
+import asyncio
+import logging
+import os
+import pyppeteer
+import signal
+
+from .state import load_json, state_path, save_json
+
+# Module vars
+_logger = logging.getLogger(__name__)
+
+DAEMON_STATE = 'daemon.json'
+
+
+class DaemonError(Exception):
+    """
+    Chromium daemon exception
+    """
+    pass
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def daemon_info(path=None):
+    """
+    Return state of the running daemon, or None if no daemon is running.
+
+    :param path: the daemon state file (defaults to the shared state file)
+    :type path: str
+
+    :returns: dict
+    """
+    path = path or state_path(DAEMON_STATE)
+    info = load_json(path)
+    if not info or not _pid_alive(info.get('pid', 0)):
+        return None
+    return info
+
+
+def daemon_endpoint(path=None):
+    """
+    Return websocket endpoint of the running daemon.
+
+    :param path: the daemon state file (defaults to the shared state file)
+    :type path: str
+
+    :raises DaemonError: if no daemon is running
+
+    :returns: str
+    """
+    info = daemon_info(path)
+    if info is None:
+        raise DaemonError('No proxytools daemon is running')
+    return info['ws_endpoint']
+
+
+async def run_daemon(headless=True, bin_path=None, chrome_args=[], path=None):
+    """
+    Launch Chromium and serve it until SIGINT or SIGTERM.
+
+    :param headless: run chrome headless mode
+    :param bin_path: path to chrome executable
+    :param chrome_args: chromium args
+    :param path: the daemon state file (defaults to the shared state file)
+
+    :type headless: bool
+    :type bin_path: str
+    :type chrome_args: list
+    :type path: str
+    """
+    path = path or state_path(DAEMON_STATE)
+    if daemon_info(path) is not None:
+        raise DaemonError('A proxytools daemon is already running')
+
+    kwargs = {
+        'headless': headless,
+        'args': chrome_args,
+        # Signals are handled here so the state file is removed on exit
+        'handleSIGINT': False,
+        'handleSIGTERM': False,
+        'handleSIGHUP': False
+    }
+    if bin_path:
+        kwargs['executablePath'] = bin_path
+    browser = await pyppeteer.launch(kwargs)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_event_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    browser.on('disconnected', stop.set)
+
+    save_json(path, {'pid': os.getpid(), 'ws_endpoint': browser.wsEndpoint})
+    _logger.info('Chromium daemon listening on {}'.format(browser.wsEndpoint))
+    try:
+        await stop.wait()
+    finally:
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+        try:
+            await browser.close()
+        except:
+            pass
+
+
+def stop_daemon(path=None):
+    """
+    Signal the running daemon to exit.
+
+    :param path: the daemon state file (defaults to the shared state file)
+    :type path: str
+
+    :raises DaemonError: if no daemon is running
+    """
+    info = daemon_info(path)
+    if info is None:
+        raise DaemonError('No proxytools daemon is running')
+    os.kill(info['pid'], signal.SIGTERM)
@@ -0,0 +1,502 @@
+# -*- coding: utf-8 -*-
+"""
+Module for distributing proxy tests over worker processes and nodes.
+
+Work is shared through a SQLite queue file, which can live on shared
+storage. Workers lease batches of jobs and must renew the lease while
+testing, so jobs held by a dead worker return to the queue once their
+lease expires.
+"""
+import asyncio
+import concurrent.futures
+import functools
+import json
+import logging
+import os
+import socket
+import sqlite3
+import time
+
+# Module vars
+_logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    proxy TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    worker TEXT,
+    lease_until REAL,
+    attempts INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, lease_until);
+CREATE INDEX IF NOT EXISTS jobs_attempts ON jobs (status, attempts);
+CREATE TABLE IF NOT EXISTS results (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    job_id INTEGER NOT NULL,
+    result TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+MAX_ATTEMPTS = 3
+
+
+class WorkQueueError(Exception):
+    """
+    Generic work queue exception.
+    """
+    pass
+
+
+def worker_id():
+    """
+    Return an id unique to this process across nodes.
+
+    :returns: str
+    """
+    return '{}-{}'.format(socket.gethostname(), os.getpid())
+
+
+class WorkQueue:
+    """
+    Leased job queue stored in a SQLite file.
+
+    Calls block on SQLite locks, so async code should make them from a
+    thread, one at a time.
+    """
+    def __init__(self, path, lease_seconds=60, max_attempts=None):
+        """
+        :param path: the queue file
+        :param lease_seconds: seconds a worker holds jobs without renewing
+        :param max_attempts: leases per job before it is marked failed, stored
+            with the queue so every worker applies it (defaults to the stored
+            value, or MAX_ATTEMPTS)
+
+        :type path: str
+        :type lease_seconds: float
+        :type max_attempts: int
+        """
+        self.path = path
+        self.lease_seconds = lease_seconds
+        # Autocommit mode, transactions are managed explicitly
+        self.conn = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self.conn.executescript(SCHEMA)
+        if max_attempts is not None:
+            with self._transaction() as conn:
+                conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+                             ('max_attempts', str(max_attempts)))
+
+    @property
+    def max_attempts(self):
+        """
+        Leases per job before it is marked failed, as stored with the queue.
+        """
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'max_attempts'").fetchone()
+        return int(row[0]) if row is not None else MAX_ATTEMPTS
+
+    def close(self):
+        self.conn.close()
+
+    def _transaction(self):
+        """
+        Return context manager running statements in a write transaction.
+        """
+        queue = self
+
+        class Transaction:
+            def __enter__(self):
+                queue.conn.execute('BEGIN IMMEDIATE')
+                return queue.conn
+
+            def __exit__(self, exc_type, exc, tb):
+                queue.conn.execute('ROLLBACK' if exc_type else 'COMMIT')
+
+        return Transaction()
+
+    def set_task(self, url, selector=None, timeout=10):
+        """
+        Set the test every job in the queue runs.
+
+        :param url: the URL to test the proxies against
+        :param selector: css selector used to verify page load
+        :param timeout: seconds to wait before quitting each test
+
+        :type url: str
+        :type selector: str
+        :type timeout: int
+        """
+        task = json.dumps({'url': url, 'selector': selector, 'timeout': timeout})
+        with self._transaction() as conn:
+            conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', ('task', task))
+
+    def task(self):
+        """
+        Return the test configuration set by the coordinator.
+
+        :returns: dict
+        :raises: WorkQueueError
+        """
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'task'").fetchone()
+        if row is None:
+            raise WorkQueueError('Queue has no task configured')
+        return json.loads(row[0])
+
+    def put(self, proxies, batch_size=1000):
+        """
+        Add `proxies` to the queue.
+
+        :param proxies: proxies to test
+        :param batch_size: rows inserted per transaction
+
+        :type proxies: iterable
+        :type batch_size: int
+
+        :returns: int number of jobs added
+        """
+        count = 0
+        batch = []
+        for proxy in proxies:
+            batch.append((str(proxy),))
+            if len(batch) >= batch_size:
+                with self._transaction() as conn:
+                    conn.executemany('INSERT INTO jobs (proxy) VALUES (?)', batch)
+                count += len(batch)
+                batch = []
+        if batch:
+            with self._transaction() as conn:
+                conn.executemany('INSERT INTO jobs (proxy) VALUES (?)', batch)
+            count += len(batch)
+        return count
+
+    def _reclaim(self, conn, now):
+        """
+        Return expired leases to the queue, failing exhausted jobs.
+        """
+        conn.execute(
+            "UPDATE jobs SET status = 'pending', worker = NULL "
+            "WHERE status = 'leased' AND lease_until < ?", (now,))
+        exhausted = conn.execute(
+            "SELECT id, proxy, attempts FROM jobs WHERE status = 'pending' AND attempts >= ?",
+            (self.max_attempts,)).fetchall()
+        for job_id, proxy, attempts in exhausted:
+            _logger.warning('Job for {} failed after {} leases'.format(proxy, attempts))
+            conn.execute("UPDATE jobs SET status = 'failed' WHERE id = ?", (job_id,))
+            result = {'proxy': proxy, 'status': 'Failed after {} leases'.format(attempts)}
+            conn.execute('INSERT INTO results (job_id, result) VALUES (?, ?)',
+                         (job_id, json.dumps(result)))
+
+    def reclaim(self):
+        """
+        Return expired leases to the queue.
+        """
+        with self._transaction() as conn:
+            self._reclaim(conn, time.time())
+
+    def lease(self, worker, n):
+        """
+        Lease up to `n` pending jobs to `worker`.
+
+        :param worker: the worker id
+        :param n: max jobs to lease
+
+        :type worker: str
+        :type n: int
+
+        :returns: list of (job id, proxy) tuples
+        """
+        now = time.time()
+        with self._transaction() as conn:
+            self._reclaim(conn, now)
+            jobs = conn.execute(
+                "SELECT id, proxy FROM jobs WHERE status = 'pending' ORDER BY id LIMIT ?",
+                (n,)).fetchall()
+            conn.executemany(
+                "UPDATE jobs SET status = 'leased', worker = ?, lease_until = ?, "
+                "attempts = attempts + 1 WHERE id = ?",
+                [(worker, now + self.lease_seconds, job_id) for job_id, _ in jobs])
+        return jobs
+
+    def renew(self, worker, job_ids):
+        """
+        Extend `worker`'s lease on `job_ids`.
+
+        :param worker: the worker id
+        :param job_ids: the leased job ids
+
+        :type worker: str
+        :type job_ids: list
+        """
+        lease_until = time.time() + self.lease_seconds
+        with self._transaction() as conn:
+            conn.executemany(
+                "UPDATE jobs SET lease_until = ? WHERE id = ? AND worker = ? AND status = 'leased'",
+                [(lease_until, job_id, worker) for job_id in job_ids])
+
+    def complete(self, worker, job_id, result):
+        """
+        Record `result` for a job leased by `worker`.
+
+        Results for leases that have since been reclaimed are dropped.
+
+        :param worker: the worker id
+        :param job_id: the job id
+        :param result: the proxy test result
+
+        :type worker: str
+        :type job_id: int
+        :type result: dict
+
+        :returns: bool True if recorded
+        """
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET status = 'done', worker = NULL "
+                "WHERE id = ? AND worker = ? AND status = 'leased'",
+                (job_id, worker))
+            if cursor.rowcount == 0:
+                return False
+            conn.execute('INSERT INTO results (job_id, result) VALUES (?, ?)',
+                         (job_id, json.dumps(result)))
+        return True
+
+    def release(self, worker, job_ids):
+        """
+        Return jobs leased by `worker` to the queue without a result.
+
+        :param worker: the worker id
+        :param job_ids: the leased job ids
+
+        :type worker: str
+        :type job_ids: list
+        """
+        with self._transaction() as conn:
+            conn.executemany(
+                "UPDATE jobs SET status = 'pending', worker = NULL "
+                "WHERE id = ? AND worker = ? AND status = 'leased'",
+                [(job_id, worker) for job_id in job_ids])
+
+    def cancel(self):
+        """
+        Cancel all pending jobs.
+        """
+        with self._transaction() as conn:
+            conn.execute("UPDATE jobs SET status = 'cancelled' WHERE status = 'pending'")
+
+    def last_seq(self):
+        """
+        Return the sequence number of the latest result.
+
+        :returns: int, 0 if there are no results
+        """
+        row = self.conn.execute('SELECT MAX(seq) FROM results').fetchone()
+        return row[0] or 0
+
+    def results(self, after=0):
+        """
+        Return results recorded after sequence number `after`.
+
+        :param after: last sequence number already read
+        :type after: int
+        :returns: list of (seq, result) tuples
+        """
+        rows = self.conn.execute(
+            'SELECT seq, result FROM results WHERE seq > ? ORDER BY seq', (after,)).fetchall()
+        return [(seq, json.loads(result)) for seq, result in rows]
+
+    def counts(self):
+        """
+        Return number of jobs by status.
+
+        :returns: dict
+        """
+        rows = self.conn.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status').fetchall()
+        return dict(rows)
+
+    def finished(self):
+        """
+        Return True if no jobs are pending or leased.
+
+        :returns: bool
+        """
+        counts = self.counts()
+        return not counts.get('pending') and not counts.get('leased')
+
+
+class Worker:
+    """
+    Tests proxies leased from a WorkQueue.
+    """
+    def __init__(self, client, queue, batch_size=None, browser_concurrency=2,
+                 headless=True, bin_path=None, chrome_args=[]):
+        """
+        :param client: client used to test proxies
+        :param queue: the shared work queue
+        :param batch_size: jobs leased at once (defaults to 2 x browser_concurrency)
+        :param browser_concurrency: max concurrent chromium browsers
+        :param headless: run chrome headless mode
+        :param bin_path: path to chrome executable
+        :param chrome_args: headless chromium args
+
+        :type client: proxytools.AsyncClient
+        :type queue: WorkQueue
+        :type batch_size: int
+        :type browser_concurrency: int
+        :type headless: bool
+        :type bin_path: str
+        :type chrome_args: list
+        """
+        self.client = client
+        self.queue = queue
+        self.batch_size = batch_size or browser_concurrency * 2
+        self.browser_concurrency = browser_concurrency
+        self.headless = headless
+        self.bin_path = bin_path
+        self.chrome_args = chrome_args
+        self.id = worker_id()
+        # One thread, so queue calls never overlap on the connection
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+    async def _call(self, method, *args):
+        """
+        Run blocking queue `method` off the event loop.
+        """
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(method, *args))
+
+    async def _heartbeat(self, job_ids):
+        interval = self.queue.lease_seconds / 3
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self._call(self.queue.renew, self.id, job_ids)
+                interval = self.queue.lease_seconds / 3
+            except Exception as e:
+                # Retry sooner, before the lease runs out
+                _logger.warning('Lease renewal failed, retrying: {}'.format(e))
+                interval = min(self.queue.lease_seconds / 10, 5)
+
+    async def run_batch(self):
+        """
+        Lease and test one batch of jobs.
+
+        :returns: int number of jobs tested
+        """
+        jobs = await self._call(self.queue.lease, self.id, self.batch_size)
+        if not jobs:
+            return 0
+        task = await self._call(self.queue.task)
+        # Duplicate proxies in a batch are tested once and share the result
+        job_ids = {}
+        for job_id, proxy in jobs:
+            job_ids.setdefault(str(self.client._as_proxy(proxy)), []).append(job_id)
+        heartbeat = asyncio.ensure_future(self._heartbeat([job_id for job_id, _ in jobs]))
+        try:
+            results = await self.client.test_proxies(
+                list(job_ids), task['url'],
+                selector=task['selector'], timeout=task['timeout'],
+                browser_concurrency=self.browser_concurrency, headless=self.headless,
+                bin_path=self.bin_path, chrome_args=self.chrome_args)
+        finally:
+            heartbeat.cancel()
+            try:
+                await heartbeat
+            except asyncio.CancelledError:
+                pass
+
+        for result in results:
+            if not isinstance(result, dict):
+                _logger.warning(result)
+                continue
+            for job_id in job_ids.pop(result['proxy'], []):
+                if not await self._call(self.queue.complete, self.id, job_id, result):
+                    _logger.warning('Lease lost for {}'.format(result['proxy']))
+        # Jobs without a result are retried by another lease
+        if job_ids:
+            await self._call(self.queue.release, self.id,
+                             [job_id for ids in job_ids.values() for job_id in ids])
+        return len(jobs)
+
+    async def run(self, wait=False, poll_interval=5):
+        """
+        Test jobs until the queue is finished.
+
+        :param wait: keep polling for new jobs once the queue is finished
+        :param poll_interval: seconds between polls for new jobs
+
+        :type wait: bool
+        :type poll_interval: float
+        """
+        _logger.info('Worker {} started'.format(self.id))
+        while True:
+            tested = await self.run_batch()
+            if tested:
+                continue
+            if not wait and await self._call(self.queue.finished):
+                break
+            await asyncio.sleep(poll_interval)
+        self._executor.shutdown(wait=False)
+        _logger.info('Worker {} finished'.format(self.id))
+
+
+class Coordinator:
+    """
+    Submits proxies to a WorkQueue and streams back results.
+    """
+    def __init__(self, queue):
+        """
+        :param queue: the shared work queue
+        :type queue: WorkQueue
+        """
+        self.queue = queue
+        # Results already in a reused queue file aren't streamed again
+        self.seq = queue.last_seq()
+
+    def submit(self, proxies, url, selector=None, timeout=10):
+        """
+        Queue `proxies` for testing against `url`.
+
+        :param proxies: proxies to test
+        :param url: the URL to test the proxies against
+        :param selector: css selector used to verify page load
+        :param timeout: seconds to wait before quitting each test
+
+        :type proxies: iterable
+        :type url: str
+        :type selector: str
+        :type timeout: int
+
+        :returns: int number of jobs added
+        """
+        self.queue.set_task(url, selector=selector, timeout=timeout)
+        return self.queue.put(proxies)
+
+    def stream(self, exit_success_count=None, poll_interval=1):
+        """
+        Yield results as workers complete jobs.
+
+        :param exit_success_count: cancel pending jobs when number of working proxies is reached
+        :param poll_interval: seconds between polls for results
+
+        :type exit_success_count: int
+        :type poll_interval: float
+
+        :returns: generator of dict
+        """
+        status_ok_count = 0
+        while True:
+            self.queue.reclaim()
+            finished = self.queue.finished()
+            for self.seq, result in self.queue.results(after=self.seq):
+                yield result
+                if result['status'] == 'OK':
+                    status_ok_count += 1
+                    if exit_success_count is not None and status_ok_count == exit_success_count:
+                        self.queue.cancel()
+                        return
+            if finished:
+                return
+            time.sleep(poll_interval)
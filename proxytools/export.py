@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+"""
+Module for sharing the working proxy set with other processes.
+
+The set is published as a file of fixed-size packed records that
+consumers memory-map. Each publish writes a new file and renames it
+over the old one, so readers never see a partial write and keep a
+consistent mapping of the previous generation until they refresh.
+"""
+import collections
+import logging
+import math
+import mmap
+import os
+import random
+import socket
+import struct
+
+from .proxy import Proxy
+
+# Module vars
+_logger = logging.getLogger(__name__)
+
+MAGIC = b'PXTL'
+VERSION = 1
+SCHEMES = ('http', 'https', 'socks4', 'socks5')
+
+# magic, version, record size, generation, record count
+_HEADER = struct.Struct('<4sHHQI')
+# IPv6 (or IPv4-mapped) address, port, scheme index, flags, latency seconds
+_RECORD = struct.Struct('<16sHBBf')
+_V4_PREFIX = b'\x00' * 10 + b'\xff\xff'
+
+ProxyRecord = collections.namedtuple('ProxyRecord', ['host', 'port', 'scheme', 'latency'])
+
+
+class ExportError(Exception):
+    """
+    Proxy set export exception
+    """
+    pass
+
+
+def _pack(proxy, latency):
+    try:
+        address = _V4_PREFIX + socket.inet_pton(socket.AF_INET, proxy.host)
+    except OSError:
+        try:
+            address = socket.inet_pton(socket.AF_INET6, proxy.host)
+        except OSError:
+            raise ExportError('Not an IP address: {}'.format(proxy.host))
+    try:
+        scheme = SCHEMES.index(proxy.scheme)
+    except ValueError:
+        raise ExportError('Unknown scheme: {}'.format(proxy.scheme))
+    return _RECORD.pack(address, proxy.port, scheme, 0,
+                        latency if latency is not None else math.nan)
+
+
+def _as_entry(item):
+    """
+    Return (proxy, latency) of a test result, proxy or proxy string.
+    """
+    if isinstance(item, dict):
+        latency = (item.get('latency') or {}).get('total')
+        return Proxy.from_string(item['proxy']), latency
+    if isinstance(item, Proxy):
+        return item, None
+    return Proxy.from_string(str(item)), None
+
+
+def read_generation(path):
+    """
+    Return the generation of the proxy set published at `path`.
+
+    :param path: the export file
+    :type path: str
+    :returns: int, 0 if nothing is published
+    """
+    try:
+        with open(path, 'rb') as f:
+            header = f.read(_HEADER.size)
+    except FileNotFoundError:
+        return 0
+    if len(header) < _HEADER.size or header[:4] != MAGIC:
+        return 0
+    return _HEADER.unpack(header)[3]
+
+
+def publish(path, proxies):
+    """
+    Atomically replace the proxy set at `path` with `proxies`.
+
+    :param path: the export file
+    :param proxies: working proxies, as test results, proxies or proxy strings
+    :type path: str
+    :type proxies: iterable
+    :returns: int the new generation
+    """
+    records = []
+    for item in proxies:
+        proxy, latency = _as_entry(item)
+        try:
+            records.append(_pack(proxy, latency))
+        except ExportError as e:
+            _logger.warning('Skipping {}: {}'.format(str(proxy), e))
+    generation = read_generation(path) + 1
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(_HEADER.pack(MAGIC, VERSION, _RECORD.size, generation, len(records)))
+            f.write(b''.join(records))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    _logger.info('Published {} proxies to {} (generation {})'.format(len(records), path, generation))
+    return generation
+
+
+class ProxySetReader:
+    """
+    Memory-mapped reader of a published proxy set.
+
+    Reads unpack records straight from the mapping without locks. Call
+    `refresh` to pick up a newer generation.
+    """
+    def __init__(self, path, rng=None):
+        """
+        :param path: the export file
+        :param rng: random number generator used by `choice`
+
+        :type path: str
+        :type rng: random.Random
+        """
+        self.path = path
+        self.rng = rng or random.Random()
+        self._file = None
+        self._mmap = None
+        self._inode = None
+        self.generation = 0
+        self.count = 0
+        self._open()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += self.count
+        if not 0 <= idx < self.count:
+            raise IndexError('Proxy index out of range')
+        packed, port, scheme, flags, latency = _RECORD.unpack_from(
+            self._mmap, _HEADER.size + idx * _RECORD.size)
+        if packed[:12] == _V4_PREFIX:
+            host = socket.inet_ntop(socket.AF_INET, packed[12:])
+        else:
+            host = socket.inet_ntop(socket.AF_INET6, packed)
+        return ProxyRecord(host, port, SCHEMES[scheme], None if math.isnan(latency) else latency)
+
+    def __iter__(self):
+        for idx in range(self.count):
+            yield self[idx]
+
+    def _open(self):
+        try:
+            f = open(self.path, 'rb')
+        except FileNotFoundError:
+            raise ExportError('No proxy set published at {}'.format(self.path))
+        stat = os.fstat(f.fileno())
+        if stat.st_size < _HEADER.size:
+            f.close()
+            raise ExportError('Truncated proxy set {}'.format(self.path))
+        mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, record_size, generation, count = _HEADER.unpack_from(mapping)
+        if magic != MAGIC or version != VERSION or record_size != _RECORD.size:
+            mapping.close()
+            f.close()
+            raise ExportError('Unsupported proxy set format in {}'.format(self.path))
+        self.close()
+        self._file, self._mmap, self._inode = f, mapping, stat.st_ino
+        self.generation, self.count = generation, count
+
+    def refresh(self):
+        """
+        Remap the file if a newer generation was published.
+
+        :returns: bool True if the proxy set changed
+        """
+        try:
+            inode = os.stat(self.path).st_ino
+        except FileNotFoundError:
+            return False
+        if inode == self._inode:
+            return False
+        generation = self.generation
+        self._open()
+        return self.generation != generation
+
+    def choice(self):
+        """
+        Return a random proxy.
+
+        :returns: ProxyRecord
+        :raises: IndexError if the set is empty
+        """
+        if not self.count:
+            raise IndexError('Proxy set is empty')
+        return self[self.rng.randrange(self.count)]
+
+    def proxy(self, idx):
+        """
+        Return record `idx` as a `Proxy`.
+
+        :returns: proxytools.Proxy
+        """
+        record = self[idx]
+        return Proxy(record.host, record.port, scheme=record.scheme)
+
+    def close(self):
+        """
+        Close the mapping.
+        """
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""
+Module for hedging slow requests with a backup attempt.
+"""
+import asyncio
+import logging
+import time
+
+from .timeout import LatencyHistory
+
+# Module vars
+_logger = logging.getLogger(__name__)
+
+
+class HedgePolicy:
+    """
+    Starts a backup attempt of a request that is slower than usual.
+
+    Once a request has run for a high percentile of observed latencies,
+    a second attempt is started and whichever finishes first wins; the
+    other is cancelled. Until enough latencies are observed, a backup is
+    started after `default_ratio` of the request timeout instead. Backups
+    are capped at `max_ratio` of requests, plus a `burst` allowance, so
+    hedging can't multiply load on a struggling source.
+    """
+    def __init__(self, mode='tab', percentile=90, min_samples=20, min_delay=0.5,
+                 max_ratio=0.1, burst=1, default_ratio=0.5, history=None):
+        """
+        :param mode: how backups are fetched, 'tab' (another browser tab)
+            or 'http' (plain HTTP, without javascript)
+        :param percentile: latency percentile after which a backup is started
+        :param min_samples: latencies observed before hedging starts
+        :param min_delay: min seconds before a backup is started
+        :param max_ratio: max share of requests that get a backup
+        :param burst: backups allowed beyond `max_ratio`, so the first slow
+            requests of a run can be hedged
+        :param default_ratio: share of the timeout waited before a backup
+            while fewer than `min_samples` latencies are observed
+        :param history: latency samples (defaults to a new in-memory history)
+
+        :type mode: str
+        :type percentile: float
+        :type min_samples: int
+        :type min_delay: float
+        :type max_ratio: float
+        :type burst: int
+        :type default_ratio: float
+        :type history: proxytools.timeout.LatencyHistory
+        """
+        if mode not in ('tab', 'http'):
+            raise ValueError('Unknown hedge mode: {}'.format(mode))
+        self.mode = mode
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+        self.max_ratio = max_ratio
+        self.burst = burst
+        self.default_ratio = default_ratio
+        self.history = history if history is not None else LatencyHistory()
+        self.requests = 0
+        self.hedged = 0
+        self.backup_wins = 0
+
+    def delay(self, timeout=None):
+        """
+        Return seconds to wait before starting a backup.
+
+        :param timeout: the request timeout, used until enough latencies are observed
+        :type timeout: float
+        :returns: float or None without enough latencies or a timeout
+        """
+        if len(self.history) < self.min_samples:
+            if timeout is None:
+                return None
+            return max(self.default_ratio * timeout, self.min_delay)
+        return max(self.history.percentile(self.percentile), self.min_delay)
+
+    def allow(self):
+        """
+        Return True if another backup stays within `max_ratio` and `burst`.
+
+        :returns: bool
+        """
+        return self.hedged + 1 <= self.max_ratio * self.requests + self.burst
+
+    def save(self):
+        """
+        Persist observed latencies, if the history has a path.
+        """
+        self.history.save()
+
+    async def run(self, primary, backup, timeout=None):
+        """
+        Await `primary()`, racing it against `backup()` if it is slow.
+
+        :param primary: coroutine function making the first attempt
+        :param backup: coroutine function making the backup attempt
+        :param timeout: the request timeout, used until enough latencies are observed
+
+        :type primary: callable
+        :type backup: callable
+        :type timeout: float
+
+        :returns: result of the first successful attempt
+        :raises: exception of the primary attempt if both fail
+        """
+        self.requests += 1
+        start = time.perf_counter()
+        first = asyncio.ensure_future(primary())
+        second = None
+        delay = self.delay(timeout)
+        try:
+            if delay is not None:
+                await asyncio.wait({first}, timeout=delay)
+            if delay is None or first.done() or not self.allow():
+                result = await first
+                self.history.record(time.perf_counter() - start)
+                return result
+
+            self.hedged += 1
+            _logger.info('Request slower than {:.2f}s, starting backup'.format(delay))
+            second = asyncio.ensure_future(backup())
+            pending = {first, second}
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is second:
+                            self.backup_wins += 1
+                        self.history.record(time.perf_counter() - start)
+                        return task.result()
+            # Both attempts failed
+            return first.result()
+        finally:
+            for task in (first, second):
+                if task is not None and not task.done():
+                    task.cancel()
+
+    def as_dict(self):
+        """
+        Return dictionary representation of object.
+
+        :returns: dict
+        """
+        return {
+            'mode': self.mode,
+            'requests': self.requests,
+            'hedged': self.hedged,
+            'backup_wins': self.backup_wins
+        }
@@ -0,0 +1,450 @@
+# -*- coding: utf-8 -*-
+"""
+Minimal HTTP/1.1 message framing helpers for asyncio streams.
+"""
+import asyncio
+import logging
+import ssl
+import time
+
+import yarl
+
+# Module vars
+_logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 65536
+
+
+class HTTPError(Exception):
+    """
+    Malformed or incomplete HTTP message.
+    """
+    pass
+
+
+class Message:
+    """
+    HTTP request or response head.
+    """
+    def __init__(self, start_line, headers):
+        """
+        :param start_line: request or status line parts
+        :param headers: list of (name, value) pairs
+
+        :type start_line: tuple
+        :type headers: list
+        """
+        self.start_line = start_line
+        self.headers = headers
+
+    def header(self, name, default=None):
+        """
+        Return value of header `name` (case insensitive).
+
+        :param name: the header name
+        :param default: value returned if header is absent
+
+        :type name: str
+
+        :returns: str
+        """
+        name = name.lower()
+        for key, val in self.headers:
+            if key.lower() == name:
+                return val
+        return default
+
+    def remove_header(self, name):
+        """
+        Remove all headers called `name` (case insensitive).
+
+        :param name: the header name
+        :type name: str
+        """
+        name = name.lower()
+        self.headers = [(k, v) for k, v in self.headers if k.lower() != name]
+
+    def set_header(self, name, val):
+        """
+        Replace header `name` with `val`.
+
+        :param name: the header name
+        :param val: the header value
+
+        :type name: str
+        :type val: str
+        """
+        self.remove_header(name)
+        self.headers.append((name, val))
+
+    @property
+    def version(self):
+        """
+        HTTP version string, e.g. HTTP/1.1.
+        """
+        raise NotImplementedError
+
+    def keep_alive(self):
+        """
+        Return True if the sender wants a persistent connection.
+
+        :returns: bool
+        """
+        connection = (self.header('Connection') or self.header('Proxy-Connection') or '').lower()
+        if self.version == 'HTTP/1.0':
+            return connection == 'keep-alive'
+        return connection != 'close'
+
+    def to_bytes(self):
+        """
+        Serialise message head.
+
+        :returns: bytes
+        """
+        lines = [' '.join(self.start_line)]
+        lines.extend('{}: {}'.format(k, v) for k, v in self.headers)
+        return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+
+class Request(Message):
+    @property
+    def method(self):
+        return self.start_line[0]
+
+    @property
+    def target(self):
+        return self.start_line[1]
+
+    @property
+    def version(self):
+        return self.start_line[2]
+
+
+class Response(Message):
+    @property
+    def version(self):
+        return self.start_line[0]
+
+    @property
+    def status(self):
+        return int(self.start_line[1])
+
+
+def _parse_head(data):
+    """
+    Split raw message head into start line parts and headers.
+    """
+    try:
+        text = data.decode('latin-1')
+    except UnicodeDecodeError:
+        raise HTTPError('Could not decode message head')
+    lines = text.split('\r\n')
+    start_line = lines[0].split(' ', 2)
+    headers = []
+    for line in lines[1:]:
+        if not line:
+            continue
+        if ':' not in line:
+            raise HTTPError('Malformed header: {}'.format(line))
+        key, val = line.split(':', 1)
+        headers.append((key.strip(), val.strip()))
+    return start_line, headers
+
+
+async def read_head(reader):
+    """
+    Read a message head from `reader`.
+
+    :param reader: the stream to read
+    :type reader: asyncio.StreamReader
+    :returns: bytes
+    :raises: HTTPError
+    """
+    try:
+        return await reader.readuntil(b'\r\n\r\n')
+    except asyncio.IncompleteReadError as e:
+        if not e.partial:
+            raise EOFError('Connection closed')
+        raise HTTPError('Incomplete message head')
+    except asyncio.LimitOverrunError:
+        raise HTTPError('Message head too large')
+
+
+async def read_request(reader):
+    """
+    Read request head from `reader`.
+
+    :param reader: the stream to read
+    :type reader: asyncio.StreamReader
+    :returns: Request
+    :raises: HTTPError, EOFError
+    """
+    start_line, headers = _parse_head(await read_head(reader))
+    if len(start_line) != 3:
+        raise HTTPError('Malformed request line')
+    return Request(tuple(start_line), headers)
+
+
+async def read_response(reader):
+    """
+    Read response head from `reader`.
+
+    :param reader: the stream to read
+    :type reader: asyncio.StreamReader
+    :returns: Response
+    :raises: HTTPError, EOFError
+    """
+    start_line, headers = _parse_head(await read_head(reader))
+    if len(start_line) < 2 or not start_line[1].isdigit():
+        raise HTTPError('Malformed status line')
+    if len(start_line) == 2:
+        start_line.append('')
+    return Response(tuple(start_line), headers)
+
+
+def has_body(message, request_method=None):
+    """
+    Return True if `message` is followed by a body.
+
+    :param message: request or response head
+    :param request_method: method of the request a response answers
+
+    :type message: Message
+    :type request_method: str
+
+    :returns: bool
+    """
+    if isinstance(message, Response):
+        if request_method == 'HEAD' or message.status in (204, 304) or message.status < 200:
+            return False
+        if request_method == 'CONNECT' and 200 <= message.status < 300:
+            return False
+        return True
+    return (message.header('Content-Length') is not None
+            or message.header('Transfer-Encoding') is not None)
+
+
+async def read_body(reader, message, request_method=None):
+    """
+    Read the raw (still framed) body following `message`.
+
+    :param reader: the stream to read
+    :param message: request or response head
+    :param request_method: method of the request a response answers
+
+    :type reader: asyncio.StreamReader
+    :type message: Message
+    :type request_method: str
+
+    :returns: tuple of (bytes, bool) where bool is False if the body was
+              delimited by connection close
+    :raises: HTTPError
+    """
+    chunks = []
+    reusable = await relay_body(reader, chunks.append, message, request_method)
+    return b''.join(chunks), reusable
+
+
+async def relay_body(reader, write, message, request_method=None, drain=None):
+    """
+    Pass the raw body following `message` from `reader` to `write`.
+
+    :param reader: the stream to read
+    :param write: callable receiving body bytes
+    :param message: request or response head
+    :param request_method: method of the request a response answers
+    :param drain: coroutine function awaited after each write for flow control
+
+    :type reader: asyncio.StreamReader
+    :type write: callable
+    :type message: Message
+    :type request_method: str
+    :type drain: callable
+
+    :returns: False if the body was delimited by connection close
+    :raises: HTTPError
+    """
+    if not has_body(message, request_method):
+        return True
+
+    try:
+        transfer_encoding = (message.header('Transfer-Encoding') or '').lower()
+        if 'chunked' in transfer_encoding:
+            while True:
+                line = await reader.readuntil(b'\r\n')
+                write(line)
+                try:
+                    size = int(line.split(b';', 1)[0].strip(), 16)
+                except ValueError:
+                    raise HTTPError('Malformed chunk size')
+                if size == 0:
+                    # Trailers end with an empty line
+                    while True:
+                        line = await reader.readuntil(b'\r\n')
+                        write(line)
+                        if line == b'\r\n':
+                            return True
+                write(await reader.readexactly(size + 2))
+                if drain:
+                    await drain()
+
+        length = message.header('Content-Length')
+        if length is not None:
+            try:
+                remaining = int(length)
+            except ValueError:
+                raise HTTPError('Malformed Content-Length')
+            while remaining > 0:
+                data = await reader.read(min(remaining, CHUNK_SIZE))
+                if not data:
+                    raise HTTPError('Incomplete body')
+                write(data)
+                remaining -= len(data)
+                if drain:
+                    await drain()
+            return True
+    except asyncio.IncompleteReadError:
+        raise HTTPError('Incomplete body')
+
+    # Body delimited by connection close
+    while True:
+        data = await reader.read(CHUNK_SIZE)
+        if not data:
+            return False
+        write(data)
+        if drain:
+            await drain()
+
+
+def decode_chunked(data):
+    """
+    Return the payload of chunked body `data`.
+
+    :param data: raw chunked body
+    :type data: bytes
+    :returns: bytes
+    :raises: HTTPError
+    """
+    chunks = []
+    pos = 0
+    while True:
+        end = data.find(b'\r\n', pos)
+        if end == -1:
+            raise HTTPError('Incomplete chunked body')
+        try:
+            size = int(data[pos:end].split(b';', 1)[0].strip(), 16)
+        except ValueError:
+            raise HTTPError('Malformed chunk size')
+        if size == 0:
+            return b''.join(chunks)
+        chunks.append(data[end + 2:end + 2 + size])
+        pos = end + 4 + size
+
+
+def charset(message, default='utf-8'):
+    """
+    Return the charset declared in the Content-Type of `message`.
+
+    :param message: request or response head
+    :type message: Message
+    :returns: str
+    """
+    for param in (message.header('Content-Type') or '').split(';')[1:]:
+        key, _, val = param.partition('=')
+        if key.strip().lower() == 'charset' and val.strip():
+            return val.strip().strip('"')
+    return default
+
+
+async def fetch(url, timeout=10, max_redirects=5, headers=None, proxy=None, timings=None):
+    """
+    GET `url` over plain HTTP/1.1 (or TLS for https), following redirects.
+
+    Bodies are requested uncompressed and returned de-chunked. Through
+    an HTTP `proxy`, http URLs are requested in absolute form and https
+    URLs through a CONNECT tunnel.
+
+    :param url: the URL to fetch
+    :param timeout: seconds to wait for the whole exchange
+    :param max_redirects: redirects followed before giving up
+    :param headers: extra request headers
+    :param proxy: HTTP proxy to send the request through
+    :param timings: dict receiving seconds to the last response head as `ttfb`
+
+    :type url: yarl.URL
+    :type timeout: float
+    :type max_redirects: int
+    :type headers: dict
+    :type proxy: proxytools.Proxy
+    :type timings: dict
+
+    :returns: tuple of (Response, bytes)
+    :raises: HTTPError, OSError, asyncio.TimeoutError
+    """
+    return await asyncio.wait_for(_fetch(url, max_redirects, headers or {}, proxy, timings),
+                                  timeout=timeout)
+
+
+async def _open(url, proxy):
+    """
+    Open a connection for requesting `url`, directly or through `proxy`.
+
+    :returns: tuple of reader, writer and the request target
+    """
+    secure = url.scheme == 'https'
+    if proxy is None:
+        reader, writer = await asyncio.open_connection(
+            url.host, url.port, ssl=secure or None, server_hostname=url.host if secure else None)
+        return reader, writer, url.raw_path_qs or '/'
+    reader, writer = await asyncio.open_connection(proxy.host, proxy.port)
+    if not secure:
+        return reader, writer, str(url)
+    authority = '{}:{}'.format(url.host, url.port)
+    try:
+        writer.write(Request(('CONNECT', authority, 'HTTP/1.1'), [('Host', authority)]).to_bytes())
+        await writer.drain()
+        response = await read_response(reader)
+        if not 200 <= response.status < 300:
+            raise HTTPError('Proxy refused tunnel: {}'.format(response.status))
+        # StreamWriter.start_tls needs Python 3.11
+        await writer.start_tls(ssl.create_default_context(), server_hostname=url.host)
+    except BaseException:
+        writer.close()
+        raise
+    return reader, writer, url.raw_path_qs or '/'
+
+
+async def _fetch(url, max_redirects, headers, proxy, timings):
+    start = time.perf_counter()
+    for _ in range(max_redirects + 1):
+        reader, writer, target = await _open(url, proxy)
+        try:
+            host = url.host if url.is_default_port() else '{}:{}'.format(url.host, url.port)
+            request = Request(('GET', target, 'HTTP/1.1'), [
+                ('Host', host),
+                ('User-Agent', 'Mozilla/5.0'),
+                ('Accept', '*/*'),
+                ('Accept-Encoding', 'identity'),
+                ('Connection', 'close'),
+            ])
+            for key, val in headers.items():
+                request.set_header(key, val)
+            writer.write(request.to_bytes())
+            await writer.drain()
+            response = await read_response(reader)
+            if timings is not None:
+                timings['ttfb'] = time.perf_counter() - start
+            body, _ = await read_body(reader, response, 'GET')
+        finally:
+            try:
+                writer.close()
+            except:
+                pass
+        if 'chunked' in (response.header('Transfer-Encoding') or '').lower():
+            body = decode_chunked(body)
+        location = response.header('Location')
+        if response.status in (301, 302, 303, 307, 308) and location:
+            url = url.join(yarl.URL(location))
+            continue
+        return response, body
+    raise HTTPError('Too many redirects')
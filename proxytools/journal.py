@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+Module for checkpointing proxy test results.
+
+Results are appended to an NDJSON journal as they complete, so an
+interrupted run can be resumed without retesting finished proxies.
+"""
+import json
+import logging
+import os
+import time
+
+# Module vars
+_logger = logging.getLogger(__name__)
+
+
+class Journal:
+    """
+    Append-only journal of proxy test results.
+
+    Writes are buffered and flushed with fsync once `batch_size` results
+    are waiting or `flush_interval` seconds have passed.
+    """
+    def __init__(self, path, flush_interval=1.0, batch_size=100):
+        """
+        :param path: the journal file
+        :param flush_interval: max seconds between fsyncs
+        :param batch_size: max buffered results
+
+        :type path: str
+        :type flush_interval: float
+        :type batch_size: int
+        """
+        self.path = path
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self._buffer = []
+        self._last_flush = time.monotonic()
+        self._repair()
+        self._file = open(path, 'a')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def _repair(self):
+        """
+        Drop a partial last line left by an interrupted write.
+        """
+        try:
+            f = open(self.path, 'rb+')
+        except FileNotFoundError:
+            return
+        with f:
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            if size == 0:
+                return
+            f.seek(size - 1)
+            if f.read(1) == b'\n':
+                return
+            # Scan back to the last complete record
+            pos = size
+            while pos > 0:
+                step = min(4096, pos)
+                pos -= step
+                f.seek(pos)
+                idx = f.read(step).rfind(b'\n')
+                if idx != -1:
+                    pos += idx + 1
+                    break
+            _logger.warning('Truncating partial record in journal {}'.format(self.path))
+            f.truncate(pos)
+
+    def records(self):
+        """
+        Yield results recorded in the journal.
+
+        :returns: generator of dict
+        """
+        if not self._file.closed:
+            self.flush()
+        with open(self.path) as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    _logger.warning('Skipping corrupt journal record')
+
+    def completed(self):
+        """
+        Return proxies with a recorded result.
+
+        :returns: set
+        """
+        return {record['proxy'] for record in self.records()}
+
+    def write(self, result):
+        """
+        Append `result` to the journal.
+
+        :param result: proxy test result
+        :type result: dict
+        """
+        self._buffer.append(json.dumps(result) + '\n')
+        if (len(self._buffer) >= self.batch_size
+                or time.monotonic() - self._last_flush >= self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        """
+        Write buffered results and fsync the journal.
+        """
+        if self._buffer:
+            self._file.write(''.join(self._buffer))
+            self._buffer = []
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._last_flush = time.monotonic()
+
+    def close(self):
+        """
+        Flush and close the journal.
+        """
+        if not self._file.closed:
+            self.flush()
+            self._file.close()
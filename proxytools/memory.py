@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+Module for sampling system and process memory.
+
+Uses psutil if installed, falling back to /proc on Linux.
+"""
+import logging
+import os
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# Module vars
+_logger = logging.getLogger(__name__)
+
+
+def memory_used():
+    """
+    Return the used share of system memory.
+
+    :returns: float [0-1] or None where unavailable
+    """
+    if psutil is not None:
+        return psutil.virtual_memory().percent / 100
+    try:
+        with open('/proc/meminfo') as f:
+            info = dict(line.split(':', 1) for line in f)
+        total = int(info['MemTotal'].split()[0])
+        available = int(info['MemAvailable'].split()[0])
+    except (OSError, KeyError, ValueError):
+        return None
+    return 1 - available / total
+
+
+def _proc_children():
+    """
+    Return a map of pid to child pids read from /proc.
+    """
+    children = {}
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            with open('/proc/{}/stat'.format(name)) as f:
+                stat = f.read()
+        except OSError:
+            continue
+        # The command name may contain spaces, fields follow its closing paren
+        ppid = int(stat.rsplit(')', 1)[1].split()[1])
+        children.setdefault(ppid, []).append(int(name))
+    return children
+
+
+def _proc_rss(pid):
+    with open('/proc/{}/statm'.format(pid)) as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def process_tree_rss(pid):
+    """
+    Return resident memory of process `pid` and all its descendants.
+
+    :param pid: the root process id
+    :type pid: int
+    :returns: int bytes or None where unavailable
+    """
+    if psutil is not None:
+        try:
+            root = psutil.Process(pid)
+            processes = [root] + root.children(recursive=True)
+        except psutil.Error:
+            return None
+        total = 0
+        for process in processes:
+            try:
+                total += process.memory_info().rss
+            except psutil.Error:
+                pass
+        return total
+
+    if not os.path.isdir('/proc/{}'.format(pid)):
+        return None
+    try:
+        children = _proc_children()
+    except OSError:
+        return None
+    total = 0
+    stack = [pid]
+    while stack:
+        current = stack.pop()
+        try:
+            total += _proc_rss(current)
+        except (OSError, ValueError, IndexError):
+            # Exited while sampling
+            continue
+        stack.extend(children.get(current, []))
+    return total
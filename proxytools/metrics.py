@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+"""
+Module for pipeline metrics.
+
+Metrics are exported as Prometheus text or JSON.
+"""
+import bisect
+import http.server
+import json
+import logging
+import threading
+
+# Module vars
+_logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('"', '\\"')) for k, v in pairs) + '}'
+
+
+class Metric:
+    """
+    Base class for labelled metrics.
+    """
+    type = None
+
+    def __init__(self, name, help=''):
+        """
+        :param name: the metric name
+        :param help: the metric description
+
+        :type name: str
+        :type help: str
+        """
+        self.name = name
+        self.help = help
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def samples(self):
+        """
+        Return list of (name, label key, value) samples.
+
+        :returns: list
+        """
+        with self._lock:
+            return [(self.name, key, val) for key, val in self._values.items()]
+
+    def as_dict(self):
+        """
+        Return dictionary representation of object.
+
+        :returns: dict
+        """
+        with self._lock:
+            values = [{'labels': dict(key), 'value': val} for key, val in self._values.items()]
+        return {'type': self.type, 'help': self.help, 'values': values}
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        """
+        Increment counter by `amount`.
+
+        :param amount: the increment
+        :type amount: float
+        """
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, val, **labels):
+        """
+        Set gauge to `val`.
+
+        :param val: the value
+        :type val: float
+        """
+        with self._lock:
+            self._values[_label_key(labels)] = val
+
+    def inc(self, amount=1, **labels):
+        """
+        Increment gauge by `amount`.
+
+        :param amount: the increment
+        :type amount: float
+        """
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        """
+        Decrement gauge by `amount`.
+
+        :param amount: the decrement
+        :type amount: float
+        """
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help='', buckets=DEFAULT_BUCKETS):
+        """
+        :param name: the metric name
+        :param help: the metric description
+        :param buckets: upper bounds of the histogram buckets
+
+        :type name: str
+        :type help: str
+        :type buckets: tuple
+        """
+        super().__init__(name, help=help)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, val, **labels):
+        """
+        Record observation `val`.
+
+        :param val: the observed value
+        :type val: float
+        """
+        key = _label_key(labels)
+        with self._lock:
+            data = self._values.get(key)
+            if data is None:
+                data = {'buckets': [0] * (len(self.buckets) + 1), 'sum': 0.0, 'count': 0}
+                self._values[key] = data
+            data['buckets'][bisect.bisect_left(self.buckets, val)] += 1
+            data['sum'] += val
+            data['count'] += 1
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for key, data in self._values.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float('inf'),), data['buckets']):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    samples.append(('{}_bucket'.format(self.name), key + (('le', le),), cumulative))
+                samples.append(('{}_sum'.format(self.name), key, data['sum']))
+                samples.append(('{}_count'.format(self.name), key, data['count']))
+        return samples
+
+    def as_dict(self):
+        with self._lock:
+            values = [{'labels': dict(key),
+                       'buckets': dict(zip([repr(b) for b in self.buckets] + ['+Inf'], data['buckets'])),
+                       'sum': data['sum'],
+                       'count': data['count']}
+                      for key, data in self._values.items()]
+        return {'type': self.type, 'help': self.help, 'values': values}
+
+
+class MetricsRegistry:
+    """
+    Collection of named metrics.
+    """
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, cls, name, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = cls(name, **kwargs)
+                self._metrics[name] = metric
+            elif not isinstance(metric, cls):
+                raise ValueError('Metric {} already registered as {}'.format(name, metric.type))
+            return metric
+
+    def counter(self, name, help=''):
+        """
+        Return counter `name`, creating it if required.
+
+        :returns: Counter
+        """
+        return self._get_or_create(Counter, name, help=help)
+
+    def gauge(self, name, help=''):
+        """
+        Return gauge `name`, creating it if required.
+
+        :returns: Gauge
+        """
+        return self._get_or_create(Gauge, name, help=help)
+
+    def histogram(self, name, help='', buckets=DEFAULT_BUCKETS):
+        """
+        Return histogram `name`, creating it if required.
+
+        :returns: Histogram
+        """
+        return self._get_or_create(Histogram, name, help=help, buckets=buckets)
+
+    def to_prometheus(self):
+        """
+        Render metrics in Prometheus text exposition format.
+
+        :returns: str
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append('# HELP {} {}'.format(metric.name, metric.help))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.type))
+            for name, key, val in metric.samples():
+                lines.append('{}{} {}'.format(name, _format_labels(key), val))
+        return '\n'.join(lines) + '\n'
+
+    def as_dict(self):
+        """
+        Return dictionary representation of object.
+
+        :returns: dict
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return {metric.name: metric.as_dict() for metric in metrics}
+
+    def dump(self, path):
+        """
+        Write metrics as json to `path`.
+
+        :param path: the file path
+        :type path: str
+        """
+        with open(path, 'w') as f:
+            json.dump(self.as_dict(), f, indent=4)
+
+    def serve(self, port, host='127.0.0.1'):
+        """
+        Serve Prometheus text at /metrics from a daemon thread.
+
+        :param port: port to listen on
+        :param host: interface to listen on
+
+        :type port: int
+        :type host: str
+
+        :returns: http.server.ThreadingHTTPServer
+        """
+        registry = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = registry.to_prometheus().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                _logger.debug(format % args)
+
+        server = http.server.ThreadingHTTPServer((host, port), Handler)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        _logger.info('Serving metrics on {}:{}'.format(host, port))
+        return server
+
+
+# Default registry shared by clients and the command line
+REGISTRY = MetricsRegistry()
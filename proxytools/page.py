@@ -1,24 +1,32 @@
 """
 Module for Page class.
 """
+import yarl
+
 from .parser import ProxyParser, ParserError
 
 
 class Page:
     url = None
     html = None
+    timings = None
 
-    def __init__(self, url, html):
+    def __init__(self, url, html, timings=None, parser=None):
         """
         :param url: the page URL
         :param html: the page html
+        :param timings: seconds spent in each fetch step
+        :param parser: parser used to extract proxies
 
         :type url: yarl.URL
         :type html: str
+        :type timings: dict
+        :type parser: proxytools.parser.ProxyParser
         """
         self.url = url
         self.html = html
-        self.parser = ProxyParser()
+        self.timings = timings or {}
+        self.parser = parser or ProxyParser()
 
     def contains_ips(self):
         """
@@ -43,6 +51,9 @@ class Page:
             proxies = self.parser.parse_proxies(self.html)
         except ParserError:
             proxies = []
+        source = yarl.URL(str(self.url)).host
+        for proxy in proxies:
+            proxy.source = source
         return proxies
 
 
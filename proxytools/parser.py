@@ -3,18 +3,33 @@
 Parser module.
 """
 import inscriptis
+import io
 import ipaddress
 import logging
 import math
 import pandas
+import html as htmllib
 import re
+import socket
+import struct
 import sys
+import time
 # Proxytools
 from .proxy import Proxy
+from .trace import TRACER
 
 # Module vars
 _logger = logging.getLogger(__name__)
 
+# ip:port pairs in raw text, precompiled once for the plain text fast path.
+# Octets are range checked when packed, which is cheaper than in the regex.
+_TEXT_PROXY_REGEX = re.compile(
+    rb'(?<![0-9.])([0-9]{1,3}\.[0-9]{1,3}\.[0-9]{1,3}\.[0-9]{1,3})[ \t]*:[ \t]*([0-9]{1,5})(?![0-9])')
+_PACKED_RECORD = struct.Struct('>4sH')
+# Chromium wraps text/plain documents in a bare <pre>
+_TEXT_DOCUMENT_REGEX = re.compile(
+    r'^\s*<html><head>.*?</head><body><pre[^>]*>(.*)</pre></body></html>\s*$', re.DOTALL)
+
 
 # Custom exceptions
 class ParserError(Exception):
@@ -33,8 +48,61 @@ class IPNotFound(Exception):
     ''' Could not parse IP. '''
 
 
+class PackedProxies:
+    """
+    Proxies packed as 6 byte records of IPv4 address and port.
+    """
+    record_size = _PACKED_RECORD.size
+
+    def __init__(self, data=b'', scheme='http'):
+        """
+        :param data: packed records in network byte order
+        :param scheme: scheme of the proxies
+
+        :type data: bytes
+        :type scheme: str
+        """
+        self.data = bytes(data)
+        self.scheme = scheme
+
+    def __len__(self):
+        return len(self.data) // self.record_size
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError('Proxy index out of range')
+        address, port = _PACKED_RECORD.unpack_from(self.data, idx * self.record_size)
+        return Proxy(host=socket.inet_ntoa(address), port=port, scheme=self.scheme)
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+    def as_strings(self):
+        """
+        Return proxy URL strings, formatted as `str(proxy)`.
+
+        :returns: list
+        """
+        inet_ntoa = socket.inet_ntoa
+        template = self.scheme + '://{}:{}'
+        return [template.format(inet_ntoa(address), port)
+                for address, port in _PACKED_RECORD.iter_unpack(self.data)]
+
+
 class ProxyParser():
-    def __init__(self):
+    def __init__(self, metrics=None, tracer=None):
+        """
+        :param metrics: registry recording parse durations
+        :param tracer: tracer recording parse spans
+
+        :type metrics: proxytools.metrics.MetricsRegistry
+        :type tracer: proxytools.trace.Tracer
+        """
+        self.metrics = metrics
+        self.tracer = tracer if tracer is not None else TRACER
         self.ip_host_regex = r'([0-9]+(?:\.[0-9]+){3})+(\s*:\s*[0-9]{1,5})?'
         self.ip_regex = r'\b(?:(?:25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)\.){3}(?:25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)\b'
 
@@ -60,7 +128,11 @@ class ProxyParser():
         :type html: str
         :returns: list
         """
-        text = inscriptis.get_text(html)
+        text = self.plain_text(html)
+        if text is None:
+            text = inscriptis.get_text(html)
+        elif not isinstance(text, str):
+            text = bytes(text).decode('utf-8', errors='replace')
         matches = re.findall(self.ip_regex, text)
         ips = [m.replace(' ', '').replace('\t', '') for m in matches]
         return ips
@@ -74,19 +146,81 @@ class ProxyParser():
         :returns: proxytools.Proxy
         :raises: ParserError
         """
-        text = inscriptis.get_text(html)
-        matches = re.findall(self.ip_host_regex, text)
+        with self.tracer.span('inscriptis.get_text'):
+            text = inscriptis.get_text(html)
+        with self.tracer.span('re.findall'):
+            matches = re.findall(self.ip_host_regex, text)
         matches = self._format_regex_results(matches)
         proxies = []
-        for match in matches:
-            _logger.info(match)
+        for host, port in matches:
+            _logger.debug('{}{}'.format(host, port))
+            # IPs without a port are not proxies, tables are left to pandas
+            if not port:
+                continue
             try:
-                proxy = Proxy(host=match[0], port=match[1])
-                proxies.append(proxy)
+                port = int(port.lstrip(':'))
             except ValueError:
                 raise ParserError('Could not parse proxies with regex')
+            if 0 < port < 65536:
+                proxies.append(Proxy(host=host, port=port))
         return proxies
 
+    def plain_text(self, content):
+        """
+        Return the text of `content` if it is a plain text document.
+
+        Accepts raw text, or html of a text/plain document as rendered by
+        chromium.
+
+        :param content: the page html or raw file content
+        :type content: str or bytes-like
+        :returns: the text, or None if `content` is html
+        """
+        if isinstance(content, str):
+            head = content[:1024]
+            if '<' not in head:
+                return content
+            if head.lstrip().startswith('<html><head>'):
+                match = _TEXT_DOCUMENT_REGEX.match(content)
+                if match and '<' not in match.group(1):
+                    return htmllib.unescape(match.group(1))
+            return None
+        if b'<' not in content[:1024]:
+            return content
+        return None
+
+    def parse_packed(self, text):
+        """
+        Extract ip:port proxies from plain `text` in one regex pass over
+        its bytes.
+
+        Zero-padded octets are read as decimal, as by the regex parser:
+
+        >>> ProxyParser().parse_packed(b'010.001.002.003:8080 08.1.1.1:3128').as_strings()
+        ['http://10.1.2.3:8080', 'http://8.1.1.1:3128']
+
+        :param text: the text, or a bytes-like object such as an mmap
+        :type text: str or bytes-like
+        :returns: PackedProxies
+        """
+        if isinstance(text, str):
+            text = text.encode('utf-8', errors='replace')
+        pack = _PACKED_RECORD.pack
+        records = []
+        with self.tracer.span('parse_packed'):
+            for host, port in _TEXT_PROXY_REGEX.findall(text):
+                port = int(port)
+                if not 0 < port < 65536:
+                    continue
+                try:
+                    # int() reads zero-padded octets as decimal, unlike inet_aton
+                    address = bytes(map(int, host.split(b'.')))
+                except ValueError:
+                    # Octet over 255
+                    continue
+                records.append(pack(address, port))
+        return PackedProxies(b''.join(records))
+
     def get_host_column_from_df(self, df):
         """
         Search dataframe `df` for "Host" column.
@@ -147,7 +281,9 @@ class ProxyParser():
         """
         proxies = []
         try:
-            dfs = pandas.read_html(html)
+            with self.tracer.span('pandas.read_html'):
+                # Literal html must be wrapped, newer pandas treat strings as paths
+                dfs = pandas.read_html(io.StringIO(html))
         except ValueError:
             # No tables found
             raise ParserError('Could not extract proxies with pandas, no tables found')
@@ -172,14 +308,14 @@ class ProxyParser():
 
             # Extract the proxies
             for idx, row in df.iterrows():
-                host = str(row[host_col]).strip()
+                host = str(row.iloc[host_col]).strip()
                 try:
-                    host = self.parse_ip(row[host_col])
+                    host = self.parse_ip(row.iloc[host_col])
                 except IPNotFound:
                     continue
 
                 try:
-                    port = self.parse_port(row[port_col])
+                    port = self.parse_port(row.iloc[port_col])
                 except PortNotFound:
                     continue
 
@@ -241,6 +377,14 @@ class ProxyParser():
             _logger.debug('Could not extract ip from text: {}'.format(text))
             raise IPNotFound('Could not parse IP')
 
+    def _observe(self, parser, start):
+        """
+        Record duration of a parse attempt started at `start`.
+        """
+        if self.metrics is not None:
+            self.metrics.histogram('proxytools_parse_seconds', 'Proxy parse duration by parser') \
+                .observe(time.perf_counter() - start, parser=parser)
+
     def parse_proxies(self, html):
         """
         Extract proxies from `html`.
@@ -250,22 +394,37 @@ class ProxyParser():
         :returns: list
         :raises: ParserError
         """
-        # Try regex first
         proxies = []
 
+        # Plain text lists skip html to text conversion
+        text = self.plain_text(html)
+        if text is not None:
+            start = time.perf_counter()
+            proxies = list(self.parse_packed(text))
+            self._observe('text', start)
+            if proxies:
+                return proxies
+
+        # Try regex first
+        start = time.perf_counter()
         try:
-            proxies =  self.parse_proxies_with_regex(html)
+            with self.tracer.span('parse_proxies', parser='regex'):
+                proxies =  self.parse_proxies_with_regex(html)
         except ParserError:
             pass
+        self._observe('regex', start)
 
         if not proxies:
             _logger.info('Regex parsing failed, attempting extraction with Pandas')
             # Try pandas
+            start = time.perf_counter()
             try:
-                proxies =  self.parse_proxies_with_pandas(html)
+                with self.tracer.span('parse_proxies', parser='pandas'):
+                    proxies =  self.parse_proxies_with_pandas(html)
             except ParserError:
                 _logger.info('Pandas parsing failed')
                 pass
+            self._observe('pandas', start)
 
         if not proxies:
             raise ParserError('Could not parse proxies with either regex or Pandas')
@@ -0,0 +1,362 @@
+# -*- coding: utf-8 -*-
+"""
+Module for ProxyPool class.
+"""
+import asyncio
+import heapq
+import itertools
+import logging
+import statistics
+import time
+
+from .proxy import Proxy
+
+# Module vars
+_logger = logging.getLogger(__name__)
+
+
+class PoolEmpty(Exception):
+    """
+    No healthy proxy is available.
+    """
+    pass
+
+
+class ProxyStats:
+    """
+    Health statistics for a pooled proxy.
+    """
+    def __init__(self, proxy, latency=None):
+        """
+        :param proxy: the proxy
+        :param latency: initial latency estimate in seconds
+
+        :type proxy: proxytools.Proxy
+        :type latency: float
+        """
+        self.proxy = proxy
+        self.success = 1.0
+        self.latency = latency
+        self.failures = 0
+        self.opened_at = None
+        self.in_use = False
+        self.version = 0
+
+    @property
+    def is_open(self):
+        """
+        True if the circuit breaker has tripped.
+        """
+        return self.opened_at is not None
+
+    def score(self):
+        """
+        Return health score, higher is better.
+
+        :returns: float
+        """
+        latency = self.latency if self.latency is not None else 1.0
+        return self.success / (1.0 + latency)
+
+    def as_dict(self):
+        """
+        Return dictionary representation of object.
+
+        :returns: dict
+        """
+        return {
+            'proxy': str(self.proxy),
+            'success': round(self.success, 3),
+            'latency': None if self.latency is None else round(self.latency, 3),
+            'failures': self.failures,
+            'open': self.is_open,
+            'in_use': self.in_use
+        }
+
+
+class ProxyPool:
+    """
+    Long-lived pool of tested proxies.
+
+    Tracks EWMA success rate and latency per proxy and serves the
+    healthiest idle proxy from a heap. Proxies failing
+    `failure_threshold` times in a row are taken out of rotation until a
+    background revalidation test passes.
+    """
+    def __init__(self, client, url, selector=None, timeout=10,
+                 browser_concurrency=2, alpha=0.3, failure_threshold=3,
+                 reset_timeout=60, revalidate_interval=30, min_score=0.25,
+                 headless=True, bin_path=None, chrome_args=[]):
+        """
+        :param client: client used to test proxies
+        :param url: the URL to test the proxies against
+        :param selector: css selector used to verify page load
+        :param timeout: seconds to wait before quitting each test
+        :param browser_concurrency: max concurrent chromium browsers for revalidation
+        :param alpha: EWMA smoothing factor [0-1]
+        :param failure_threshold: consecutive failures before the circuit opens
+        :param reset_timeout: seconds before an open circuit is retested
+        :param revalidate_interval: seconds between background revalidation runs
+        :param min_score: proxies scoring below this share of the median pool
+            score are revalidated
+        :param headless: run chrome headless mode
+        :param bin_path: path to chrome executable
+        :param chrome_args: headless chromium args
+
+        :type client: proxytools.AsyncClient
+        :type url: str
+        :type selector: str
+        :type timeout: int
+        :type browser_concurrency: int
+        :type alpha: float
+        :type failure_threshold: int
+        :type reset_timeout: float
+        :type revalidate_interval: float
+        :type min_score: float
+        :type headless: bool
+        :type bin_path: str
+        :type chrome_args: list
+        """
+        self.client = client
+        self.url = url
+        self.selector = selector
+        self.timeout = timeout
+        self.browser_concurrency = browser_concurrency
+        self.alpha = alpha
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.revalidate_interval = revalidate_interval
+        self.min_score = min_score
+        self.headless = headless
+        self.bin_path = bin_path
+        self.chrome_args = chrome_args
+        self._stats = {}
+        self._heap = []
+        self._counter = itertools.count()
+        self._task = None
+
+    def __len__(self):
+        return len(self._stats)
+
+    def _push(self, stats):
+        """
+        Queue `stats` for acquisition, invalidating older heap entries.
+        """
+        stats.version += 1
+        heapq.heappush(self._heap, (-stats.score(), next(self._counter), stats.version, stats))
+
+    def _record(self, stats, ok, latency=None):
+        """
+        Update EWMA statistics and circuit state for `stats`.
+        """
+        stats.success = (1 - self.alpha) * stats.success + self.alpha * (1.0 if ok else 0.0)
+        if ok:
+            stats.failures = 0
+            stats.opened_at = None
+            if latency is not None:
+                if stats.latency is None:
+                    stats.latency = latency
+                else:
+                    stats.latency = (1 - self.alpha) * stats.latency + self.alpha * latency
+        else:
+            stats.failures += 1
+            if stats.failures >= self.failure_threshold and not stats.is_open:
+                _logger.info('Circuit opened for {}'.format(str(stats.proxy)))
+                stats.opened_at = time.monotonic()
+
+    def add(self, proxy, latency=None):
+        """
+        Add `proxy` to the pool.
+
+        :param proxy: proxy or proxy url string
+        :param latency: initial latency estimate in seconds
+
+        :type proxy: proxytools.Proxy or str
+        :type latency: float
+        """
+        if not isinstance(proxy, Proxy):
+            proxy = Proxy.from_string(str(proxy))
+        key = str(proxy)
+        if key in self._stats:
+            return
+        stats = ProxyStats(proxy, latency=latency)
+        self._stats[key] = stats
+        self._push(stats)
+
+    def remove(self, proxy):
+        """
+        Remove `proxy` from the pool.
+
+        :param proxy: proxy or proxy url string
+        :type proxy: proxytools.Proxy or str
+        """
+        stats = self._stats.pop(str(proxy), None)
+        if stats:
+            # Invalidate queued heap entries
+            stats.version += 1
+
+    def add_results(self, results):
+        """
+        Add working proxies from `AsyncClient.test_proxies` results.
+
+        :param results: proxy test results
+        :type results: list
+        """
+        for result in results:
+            if isinstance(result, dict) and result['status'] == 'OK':
+                latency = result.get('latency', {}).get('total')
+                self.add(result['proxy'], latency=latency)
+
+    async def populate(self, proxies):
+        """
+        Test `proxies` and add the working ones to the pool.
+
+        :param proxies: list of proxies
+        :type proxies: list of proxytools.Proxy
+        """
+        results = await self.client.test_proxies(
+            proxies, self.url, selector=self.selector, timeout=self.timeout,
+            browser_concurrency=self.browser_concurrency, headless=self.headless,
+            bin_path=self.bin_path, chrome_args=self.chrome_args)
+        self.add_results(results)
+
+    def acquire(self):
+        """
+        Check out the healthiest idle proxy.
+
+        :returns: proxytools.Proxy
+        :raises: PoolEmpty
+        """
+        while self._heap:
+            _, _, version, stats = heapq.heappop(self._heap)
+            if version != stats.version or stats.in_use or stats.is_open:
+                continue
+            stats.in_use = True
+            return stats.proxy
+        raise PoolEmpty('No healthy proxies available')
+
+    def release(self, result):
+        """
+        Return a proxy to the pool with the outcome of using it.
+
+        `result` has the shape of an `AsyncClient.test_proxies` result:
+        ``{'proxy': ..., 'status': 'OK', 'latency': ...}`` where latency is
+        either seconds or a latency dict with a `total` key.
+
+        :param result: outcome of using the proxy
+        :type result: dict
+        """
+        stats = self._stats.get(str(result['proxy']))
+        if stats is None:
+            return
+        latency = result.get('latency')
+        if isinstance(latency, dict):
+            latency = latency.get('total')
+        stats.in_use = False
+        self._record(stats, result['status'] == 'OK', latency=latency)
+        if not stats.is_open:
+            self._push(stats)
+
+    def _weak(self):
+        """
+        Return idle proxies due for revalidation.
+
+        :returns: list
+        """
+        now = time.monotonic()
+        weak = []
+        # Relative to the pool, so slow but healthy pools aren't all weak
+        scores = [s.score() for s in self._stats.values() if not s.is_open]
+        threshold = self.min_score * statistics.median(scores) if scores else 0
+        for stats in self._stats.values():
+            if stats.in_use:
+                continue
+            if stats.is_open:
+                if now - stats.opened_at >= self.reset_timeout:
+                    weak.append(stats)
+            elif stats.score() < threshold:
+                weak.append(stats)
+        return weak
+
+    async def revalidate(self):
+        """
+        Retest weak and tripped proxies, restoring those that pass.
+        """
+        weak = self._weak()
+        if not weak:
+            return
+        _logger.info('Revalidating {} proxies'.format(len(weak)))
+        # Hold proxies out of rotation while they are tested
+        for stats in weak:
+            stats.in_use = True
+        error = None
+        try:
+            results = await self.client.test_proxies(
+                [stats.proxy for stats in weak], self.url, selector=self.selector,
+                timeout=self.timeout, browser_concurrency=self.browser_concurrency,
+                headless=self.headless, bin_path=self.bin_path, chrome_args=self.chrome_args)
+        except Exception as e:
+            error = e
+            results = []
+        finally:
+            for stats in weak:
+                stats.in_use = False
+
+        outcomes = {}
+        for result in results:
+            if not isinstance(result, dict):
+                _logger.warning(result)
+                continue
+            outcomes[result['proxy']] = result
+        for stats in weak:
+            if self._stats.get(str(stats.proxy)) is not stats:
+                # Removed while being tested
+                continue
+            # Proxies without a result count as failed, rather than leaving rotation
+            result = outcomes.get(str(stats.proxy), {'status': 'No result'})
+            ok = result['status'] == 'OK'
+            if stats.is_open and ok:
+                _logger.info('Circuit closed for {}'.format(str(stats.proxy)))
+            elif stats.is_open:
+                # Half-open test failed, wait another `reset_timeout`
+                stats.opened_at = time.monotonic()
+            self._record(stats, ok, latency=(result.get('latency') or {}).get('total'))
+            if not stats.is_open:
+                self._push(stats)
+        if error is not None:
+            raise error
+
+    async def _revalidate_forever(self):
+        while True:
+            await asyncio.sleep(self.revalidate_interval)
+            try:
+                await self.revalidate()
+            except Exception as e:
+                _logger.warning('Revalidation failed: {}'.format(e))
+
+    def start(self):
+        """
+        Start background revalidation on the running event loop.
+        """
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._revalidate_forever())
+
+    async def close(self):
+        """
+        Stop background revalidation.
+        """
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self):
+        """
+        Return health statistics for every pooled proxy.
+
+        :returns: list
+        """
+        return [stats.as_dict() for stats in self._stats.values()]
@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+"""
+Module for cheap network probes run against proxy endpoints.
+"""
+import asyncio
+import logging
+import os
+import time
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+# Module vars
+_logger = logging.getLogger(__name__)
+
+
+class ProbeError(Exception):
+    """
+    Generic probe exception.
+    """
+    pass
+
+
+async def connect_time(host, port, timeout=10):
+    """
+    Return seconds taken to open a TCP connection to `host`:`port`.
+
+    :param host: the host to connect to
+    :param port: the port to connect to
+    :param timeout: seconds to wait before giving up
+
+    :type host: str
+    :type port: int
+    :type timeout: float
+
+    :returns: float
+    :raises: ProbeError
+    """
+    start = time.perf_counter()
+    try:
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(host, port), timeout=timeout)
+    except asyncio.TimeoutError:
+        raise ProbeError('Connect timed out')
+    except OSError as e:
+        raise ProbeError(str(e))
+    elapsed = time.perf_counter() - start
+
+    # Cleanup
+    try:
+        writer.close()
+    except:
+        pass
+
+    return elapsed
+
+
+def raise_fd_limit():
+    """
+    Raise the soft RLIMIT_NOFILE limit to the hard limit where permitted.
+
+    Changes the limit for the whole process, so it is called explicitly
+    by the probe entry points rather than by `max_sockets`.
+    """
+    if resource is None:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+            _logger.debug('Raised file descriptor limit from {} to {}'.format(soft, hard))
+        except (ValueError, OSError):
+            pass
+
+
+def _open_fds():
+    """
+    Return number of descriptors open in this process, 0 if unknown.
+    """
+    for path in ('/proc/self/fd', '/dev/fd'):
+        try:
+            return len(os.listdir(path))
+        except OSError:
+            continue
+    return 0
+
+
+def max_sockets(reserve=64):
+    """
+    Return how many more sockets can safely be open at once.
+
+    Descriptors already open, by browsers, journals or sqlite, count
+    against the soft RLIMIT_NOFILE limit, and `reserve` are kept free
+    for the rest of the process.
+
+    :param reserve: descriptors kept free
+    :type reserve: int
+    :returns: int
+    """
+    if resource is None:
+        return 512
+    soft, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft == resource.RLIM_INFINITY:
+        soft = 65536
+    return max(1, soft - _open_fds() - reserve)
+
+
+async def _map_endpoints(endpoints, probe, concurrency):
+    """
+    Run `probe` over `endpoints` with a fixed pool of workers.
+
+    Memory does not grow with the size of the input.
+
+    :returns: dict mapping endpoint index to probe result
+    """
+    results = {}
+    queue = enumerate(endpoints)
+
+    async def worker():
+        for idx, (host, port) in queue:
+            try:
+                results[idx] = await probe(host, port)
+            except ProbeError:
+                pass
+
+    await asyncio.gather(*[worker() for _ in range(max(1, concurrency))])
+    return results
+
+
+async def sweep(endpoints, timeout=2, concurrency=4096):
+    """
+    TCP connect sweep of `endpoints`.
+
+    :param endpoints: (host, port) pairs to probe
+    :param timeout: seconds to wait for each connect
+    :param concurrency: max open sockets, capped by the file descriptor limit
+
+    :type endpoints: iterable
+    :type timeout: float
+    :type concurrency: int
+
+    :returns: dict mapping endpoint index to connect time for live endpoints
+    """
+    raise_fd_limit()
+    concurrency = min(concurrency, max_sockets())
+
+    async def probe(host, port):
+        return await connect_time(host, port, timeout=timeout)
+
+    return await _map_endpoints(endpoints, probe, concurrency)
+
+
+# Scheme used to address a proxy speaking each protocol. Proxies that only
+# accept CONNECT are still addressed as http proxies by chromium.
+PROTOCOL_SCHEMES = {
+    'http': 'http',
+    'connect': 'http',
+    'socks4': 'socks4',
+    'socks5': 'socks5',
+}
+
+
+async def _handshake(host, port, request, check, read_size):
+    """
+    Send `request` to `host`:`port` and validate the first `read_size`
+    bytes of the reply with `check`.
+    """
+    try:
+        reader, writer = await asyncio.open_connection(host, port)
+    except (OSError, ValueError) as e:
+        raise ProbeError(str(e))
+    try:
+        writer.write(request)
+        await writer.drain()
+        # Replies may arrive split over several reads
+        reply = await reader.readexactly(read_size)
+    except asyncio.IncompleteReadError:
+        raise ProbeError('Short reply')
+    except OSError as e:
+        raise ProbeError(str(e))
+    finally:
+        writer.close()
+    try:
+        ok = check(reply)
+    except (IndexError, ValueError):
+        ok = False
+    if not ok:
+        raise ProbeError('Unexpected reply')
+
+
+def _http_ok(reply):
+    parts = reply.split(b' ', 2)
+    return (len(parts) > 1 and parts[0].startswith(b'HTTP/1.')
+            and parts[1][:1] in (b'2', b'3'))
+
+
+def _connect_ok(reply):
+    parts = reply.split(b' ', 2)
+    return len(parts) > 1 and parts[0].startswith(b'HTTP/1.') and parts[1] == b'200'
+
+
+def _socks4_ok(reply):
+    # Any SOCKS4 reply code identifies the protocol, even a rejection
+    return len(reply) >= 2 and reply[0] == 0 and 0x5a <= reply[1] <= 0x5d
+
+
+def _socks5_ok(reply):
+    return reply[:2] == b'\x05\x00'
+
+
+async def detect_protocol(host, port, timeout=5, target_host='example.com', target_port=80):
+    """
+    Detect which proxy protocol `host`:`port` speaks.
+
+    HTTP, HTTPS CONNECT, SOCKS4 and SOCKS5 handshakes run in parallel over
+    separate connections and the first to succeed wins.
+
+    :param host: the proxy host
+    :param port: the proxy port
+    :param timeout: seconds allowed for all handshakes
+    :param target_host: host the proxy is asked to reach
+    :param target_port: port the proxy is asked to reach
+
+    :type host: str
+    :type port: int
+    :type timeout: float
+    :type target_host: str
+    :type target_port: int
+
+    :returns: str, one of PROTOCOL_SCHEMES
+    :raises: ProbeError
+    """
+    http_request = ('GET http://{0}/ HTTP/1.1\r\nHost: {0}\r\nConnection: close\r\n\r\n'
+                    .format(target_host)).encode()
+    connect_request = ('CONNECT {0}:443 HTTP/1.1\r\nHost: {0}:443\r\n\r\n'
+                       .format(target_host)).encode()
+    # SOCKS4a form, so the proxy resolves the target
+    socks4_request = (b'\x04\x01' + target_port.to_bytes(2, 'big')
+                      + b'\x00\x00\x00\x01\x00' + target_host.encode() + b'\x00')
+    socks5_request = b'\x05\x01\x00'
+
+    handshakes = {
+        'http': (http_request, _http_ok, 16),
+        'connect': (connect_request, _connect_ok, 16),
+        'socks4': (socks4_request, _socks4_ok, 8),
+        'socks5': (socks5_request, _socks5_ok, 2),
+    }
+    tasks = {}
+    for protocol, (request, check, read_size) in handshakes.items():
+        task = asyncio.ensure_future(_handshake(host, port, request, check, read_size))
+        tasks[task] = protocol
+
+    deadline = time.monotonic() + timeout
+    pending = set(tasks)
+    try:
+        while pending:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            done, pending = await asyncio.wait(
+                pending, timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+            # Retrieve every exception so failed handshakes aren't logged
+            succeeded = [task for task in done if task.exception() is None]
+            if succeeded:
+                return tasks[succeeded[0]]
+    finally:
+        for task in pending:
+            task.cancel()
+    raise ProbeError('No supported proxy protocol detected')
+
+
+async def detect_protocols(endpoints, timeout=5, concurrency=1024):
+    """
+    Detect proxy protocol of each endpoint in `endpoints`.
+
+    :param endpoints: (host, port) pairs to probe
+    :param timeout: seconds allowed for each endpoint
+    :param concurrency: max open sockets, capped by the file descriptor limit
+
+    :type endpoints: iterable
+    :type timeout: float
+    :type concurrency: int
+
+    :returns: dict mapping endpoint index to protocol for detected endpoints
+    """
+    raise_fd_limit()
+    # Each endpoint holds one socket per handshake
+    concurrency = max(1, min(concurrency, max_sockets()) // 4)
+
+    async def probe(host, port):
+        return await detect_protocol(host, port, timeout=timeout)
+
+    return await _map_endpoints(endpoints, probe, concurrency)
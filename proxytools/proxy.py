@@ -16,16 +16,26 @@ class Proxy:
         self.host = str(host)
         self.port = port
         self.scheme = scheme
-        self.url = yarl.URL.build(scheme=self.scheme, host=self.host, port=str(self.port))
+        # Host of the page the proxy was scraped from
+        self.source = None
+
+    @property
+    def url(self):
+        return yarl.URL.build(scheme=self.scheme, host=self.host, port=self.port)
 
     def __str__(self):
-        return str(self.url)
+        # yarl drops default ports (e.g. http on 80), keep them explicit
+        return '{}://{}:{}'.format(self.scheme, self.host, self.port)
 
     @staticmethod
     def from_string(url):
         """
         Static method to return proxy from url string.
+
+        Bare `host:port` strings are treated as http proxies.
         """
+        if '://' not in url:
+            url = 'http://{}'.format(url)
         url = yarl.URL(url)
         return Proxy(host=url.host, port=url.port, scheme=url.scheme)
 
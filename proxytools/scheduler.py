@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+"""
+Module for ordering proxy tests by predicted success.
+"""
+import logging
+import math
+import time
+
+from .state import load_json, save_json
+
+# Module vars
+_logger = logging.getLogger(__name__)
+
+# Ports commonly used by open proxies
+COMMON_PORTS = (80, 1080, 3128, 8000, 8080, 8888)
+
+# Upper bounds, in seconds, of the last-seen age buckets
+AGE_BUCKETS = ((3600, '1h'), (86400, '1d'), (604800, '1w'))
+
+
+def _logit(p):
+    return math.log(p / (1 - p))
+
+
+class SuccessScheduler:
+    """
+    Orders proxy tests by predicted success probability.
+
+    Success rates are learnt per source, /24 subnet, port and last-seen
+    age bucket from previous test results. The feature rates are
+    combined naive Bayes style as log odds relative to the overall
+    success rate, so a feature without history has no effect.
+    """
+    features = ('source', 'subnet', 'port', 'age')
+
+    def __init__(self, path=None, prior_weight=2, port_prior=0.2, max_seen=100000):
+        """
+        :param path: json file the statistics are persisted to
+        :param prior_weight: pseudo-tests pulling sparse rates towards the overall rate
+        :param port_prior: prior success rate of common proxy ports
+        :param max_seen: max proxies whose last success is remembered
+
+        :type path: str
+        :type prior_weight: float
+        :type port_prior: float
+        :type max_seen: int
+        """
+        self.path = path
+        self.prior_weight = prior_weight
+        self.port_prior = port_prior
+        self.max_seen = max_seen
+        self._sources = {}
+        data = load_json(path, default={}) if path else {}
+        self.total = data.get('total', [0, 0])
+        self.stats = {feature: data.get(feature, {}) for feature in self.features}
+        self.seen = data.get('seen', {})
+
+    def _base_rate(self):
+        successes, tests = self.total
+        # Smoothed so the rate is never 0 or 1
+        return (successes + 1) / (tests + 2)
+
+    def _age_bucket(self, proxy, now):
+        last = self.seen.get(proxy)
+        if last is None:
+            return 'never'
+        age = now - last
+        for bound, name in AGE_BUCKETS:
+            if age < bound:
+                return name
+        return 'older'
+
+    def _values(self, proxy, now):
+        """
+        Return feature values of `proxy`.
+
+        :param proxy: the proxy
+        :type proxy: proxytools.Proxy
+        :returns: dict
+        """
+        key = str(proxy)
+        source = getattr(proxy, 'source', None) or self._sources.get(key)
+        return {
+            'source': source,
+            'subnet': '.'.join(proxy.host.split('.')[:3]),
+            'port': str(proxy.port),
+            'age': self._age_bucket(key, now),
+        }
+
+    def _rate(self, feature, value, base):
+        successes, tests = self.stats[feature].get(value, (0, 0))
+        prior = base
+        if feature == 'port' and int(value) in COMMON_PORTS:
+            prior = max(base, self.port_prior)
+        return (successes + prior * self.prior_weight) / (tests + self.prior_weight)
+
+    def score(self, proxy, now=None):
+        """
+        Return predicted success probability of `proxy`.
+
+        :param proxy: the proxy
+        :param now: current unix time
+
+        :type proxy: proxytools.Proxy
+        :type now: float
+
+        :returns: float
+        """
+        now = now or time.time()
+        base = self._base_rate()
+        log_odds = _logit(base)
+        for feature, value in self._values(proxy, now).items():
+            if value is None:
+                continue
+            rate = min(max(self._rate(feature, value, base), 1e-6), 1 - 1e-6)
+            log_odds += _logit(rate) - _logit(base)
+        return 1 / (1 + math.exp(-log_odds))
+
+    def order(self, proxies):
+        """
+        Return `proxies` sorted by descending predicted success.
+
+        Sources of the proxies are remembered for recording results.
+
+        :param proxies: list of proxies
+        :type proxies: list of proxytools.Proxy
+
+        :returns: list of proxytools.Proxy
+        """
+        now = time.time()
+        for proxy in proxies:
+            source = getattr(proxy, 'source', None)
+            if source:
+                self._sources[str(proxy)] = source
+        # Python's sort is stable, so ties keep scrape order
+        return sorted(proxies, key=lambda proxy: -self.score(proxy, now))
+
+    def record(self, proxy, success):
+        """
+        Record a test outcome for `proxy`.
+
+        :param proxy: the tested proxy
+        :param success: the test passed
+
+        :type proxy: proxytools.Proxy
+        :type success: bool
+        """
+        now = time.time()
+        for feature, value in self._values(proxy, now).items():
+            if value is None:
+                continue
+            counts = self.stats[feature].setdefault(value, [0, 0])
+            counts[0] += int(success)
+            counts[1] += 1
+        self.total[0] += int(success)
+        self.total[1] += 1
+        if success:
+            self.seen[str(proxy)] = now
+
+    def save(self):
+        """
+        Persist statistics to `self.path`.
+        """
+        if not self.path:
+            return
+        if len(self.seen) > self.max_seen:
+            recent = sorted(self.seen.items(), key=lambda item: item[1])[-self.max_seen:]
+            self.seen = dict(recent)
+        data = dict(self.stats, total=self.total, seen=self.seen)
+        save_json(self.path, data)
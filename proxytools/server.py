@@ -0,0 +1,390 @@
+# -*- coding: utf-8 -*-
+"""
+Module for local rotating forward proxy server.
+"""
+import asyncio
+import logging
+import time
+
+from . import httputil
+from .proxy import Proxy
+
+# Module vars
+_logger = logging.getLogger(__name__)
+
+HOP_BY_HOP_HEADERS = [
+    'Proxy-Connection',
+    'Proxy-Authorization',
+    'Keep-Alive',
+    'TE',
+    'Trailer',
+    'Upgrade',
+]
+
+
+class UpstreamError(Exception):
+    """
+    Upstream proxy failed to handle a request.
+    """
+    pass
+
+
+class Upstream:
+    """
+    Upstream proxy with a pool of idle keep-alive connections.
+    """
+    def __init__(self, proxy, latency=None, max_idle=8, cooldown=30):
+        """
+        :param proxy: the upstream proxy
+        :param latency: initial latency estimate in seconds
+        :param max_idle: max idle connections kept open
+        :param cooldown: seconds an upstream is skipped after failing
+
+        :type proxy: proxytools.Proxy
+        :type latency: float
+        :type max_idle: int
+        :type cooldown: float
+        """
+        self.proxy = proxy
+        self.latency = latency
+        self.max_idle = max_idle
+        self.cooldown = cooldown
+        self.failed_at = None
+        self.idle = []
+
+    def __str__(self):
+        return str(self.proxy)
+
+    def healthy(self, now=None):
+        """
+        Return False if the upstream failed within `cooldown` seconds.
+
+        :returns: bool
+        """
+        if self.failed_at is None:
+            return True
+        now = now or time.monotonic()
+        return now - self.failed_at >= self.cooldown
+
+    def record(self, ok, latency=None, alpha=0.3):
+        """
+        Update health with the outcome of a request.
+
+        :param ok: request succeeded
+        :param latency: seconds until the response head arrived
+        :param alpha: EWMA smoothing factor
+
+        :type ok: bool
+        :type latency: float
+        :type alpha: float
+        """
+        if not ok:
+            self.failed_at = time.monotonic()
+            self.close_idle()
+            return
+        self.failed_at = None
+        if latency is not None:
+            if self.latency is None:
+                self.latency = latency
+            else:
+                self.latency = (1 - alpha) * self.latency + alpha * latency
+
+    async def connect(self, timeout):
+        """
+        Return an idle connection or open a new one.
+
+        :param timeout: seconds to wait for a new connection
+        :type timeout: float
+        :returns: tuple of (reader, writer, reused)
+        """
+        while self.idle:
+            reader, writer = self.idle.pop()
+            if not writer.is_closing() and not reader.at_eof():
+                return reader, writer, True
+            writer.close()
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(self.proxy.host, self.proxy.port), timeout=timeout)
+        return reader, writer, False
+
+    def checkin(self, reader, writer):
+        """
+        Return a connection to the idle pool.
+        """
+        if len(self.idle) < self.max_idle and not writer.is_closing():
+            self.idle.append((reader, writer))
+        else:
+            writer.close()
+
+    def close_idle(self):
+        """
+        Close all idle connections.
+        """
+        while self.idle:
+            _, writer = self.idle.pop()
+            writer.close()
+
+
+class UpstreamSelector:
+    """
+    Chooses the upstream proxy for each request.
+
+    Upstreams are spoken to with HTTP requests and CONNECT, so SOCKS
+    proxies are left out.
+    """
+    strategies = ['round-robin', 'least-latency']
+    schemes = ['http', 'https']
+
+    def __init__(self, upstreams, strategy='round-robin'):
+        """
+        :param upstreams: the upstream proxies
+        :param strategy: `round-robin` or `least-latency`
+
+        :type upstreams: list of Upstream
+        :type strategy: str
+        """
+        if strategy not in self.strategies:
+            raise ValueError('strategy must be one of {}'.format(', '.join(self.strategies)))
+        supported = [u for u in upstreams if u.proxy.scheme in self.schemes]
+        if len(supported) < len(upstreams):
+            _logger.warning('Skipping {} upstream proxies without HTTP support'
+                            .format(len(upstreams) - len(supported)))
+        upstreams = supported
+        if not upstreams:
+            raise ValueError('At least one upstream HTTP proxy is required')
+        self.upstreams = upstreams
+        self.strategy = strategy
+        self._next = 0
+
+    def choose(self, exclude=()):
+        """
+        Return next upstream, skipping failed ones where possible.
+
+        :param exclude: upstreams already tried for this request
+        :type exclude: collection
+        :returns: Upstream
+        :raises: UpstreamError
+        """
+        now = time.monotonic()
+        candidates = [u for u in self.upstreams if u not in exclude]
+        if not candidates:
+            raise UpstreamError('No upstream proxies left to try')
+        healthy = [u for u in candidates if u.healthy(now)] or candidates
+
+        if self.strategy == 'least-latency':
+            return min(healthy, key=lambda u: float('inf') if u.latency is None else u.latency)
+
+        for _ in range(len(self.upstreams)):
+            upstream = self.upstreams[self._next % len(self.upstreams)]
+            self._next += 1
+            if upstream in healthy:
+                return upstream
+        return healthy[0]
+
+
+class ForwardProxyServer:
+    """
+    Asyncio HTTP/CONNECT forward proxy rotating over upstream proxies.
+    """
+    def __init__(self, selector, host='127.0.0.1', port=8899, retries=3,
+                 connect_timeout=5, response_timeout=30):
+        """
+        :param selector: upstream selection strategy
+        :param host: interface to listen on
+        :param port: port to listen on
+        :param retries: upstreams tried per request before failing
+        :param connect_timeout: seconds to wait for an upstream connection
+        :param response_timeout: seconds to wait for an upstream response head
+
+        :type selector: UpstreamSelector
+        :type host: str
+        :type port: int
+        :type retries: int
+        :type connect_timeout: float
+        :type response_timeout: float
+        """
+        self.selector = selector
+        self.host = host
+        self.port = port
+        self.retries = retries
+        self.connect_timeout = connect_timeout
+        self.response_timeout = response_timeout
+        self._server = None
+
+    @classmethod
+    def from_results(cls, results, strategy='round-robin', **kwargs):
+        """
+        Create server from working `Client.test_proxies` results.
+
+        :param results: proxy test results
+        :param strategy: upstream selection strategy
+
+        :type results: list
+        :type strategy: str
+
+        :returns: ForwardProxyServer
+        """
+        upstreams = []
+        for result in results:
+            if isinstance(result, dict) and result['status'] == 'OK':
+                latency = result.get('latency', {}).get('total')
+                upstreams.append(Upstream(Proxy.from_string(result['proxy']), latency=latency))
+        return cls(UpstreamSelector(upstreams, strategy=strategy), **kwargs)
+
+    async def start(self):
+        """
+        Start listening for client connections.
+        """
+        self._server = await asyncio.start_server(self._handle_client, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        _logger.info('Serving on {}:{} with {} upstream proxies'
+                     .format(self.host, self.port, len(self.selector.upstreams)))
+
+    async def close(self):
+        """
+        Stop the server and close idle upstream connections.
+        """
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+        for upstream in self.selector.upstreams:
+            upstream.close_idle()
+
+    async def _handle_client(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request = await httputil.read_request(reader)
+                except EOFError:
+                    break
+                if request.method == 'CONNECT':
+                    await self._tunnel(request, reader, writer)
+                    break
+                if not await self._forward(request, reader, writer):
+                    break
+        except (httputil.HTTPError, OSError, asyncio.TimeoutError) as e:
+            _logger.debug('Client connection error: {}'.format(e))
+        finally:
+            writer.close()
+
+    async def _send_error(self, writer, status, reason):
+        body = reason.encode()
+        writer.write('HTTP/1.1 {} {}\r\nContent-Length: {}\r\nConnection: close\r\n\r\n'
+                     .format(status, reason, len(body)).encode() + body)
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+
+    async def _upstream_request(self, data, request_method):
+        """
+        Send raw request `data` to upstreams until one returns a response head.
+
+        :returns: tuple of (upstream, reader, writer, response)
+        :raises: UpstreamError
+        """
+        tried = []
+        for _ in range(self.retries):
+            upstream = self.selector.choose(exclude=tried)
+            tried.append(upstream)
+            start = time.perf_counter()
+            try:
+                up_reader, up_writer, reused = await upstream.connect(self.connect_timeout)
+            except (OSError, asyncio.TimeoutError) as e:
+                _logger.info('Upstream {} connect failed: {}'.format(upstream, e))
+                upstream.record(False)
+                continue
+            try:
+                up_writer.write(data)
+                await up_writer.drain()
+                response = await asyncio.wait_for(
+                    httputil.read_response(up_reader), timeout=self.response_timeout)
+            except (OSError, EOFError, httputil.HTTPError, asyncio.TimeoutError) as e:
+                up_writer.close()
+                if reused:
+                    # Stale keep-alive connection, retry without penalty
+                    _logger.debug('Stale connection to {}: {}'.format(upstream, e))
+                    tried.remove(upstream)
+                    continue
+                _logger.info('Upstream {} failed: {}'.format(upstream, e))
+                upstream.record(False)
+                continue
+            if response.status == 407 or (request_method == 'CONNECT' and response.status != 200):
+                _logger.info('Upstream {} refused request: {}'.format(upstream, response.status))
+                up_writer.close()
+                upstream.record(False)
+                continue
+            upstream.record(True, latency=time.perf_counter() - start)
+            return upstream, up_reader, up_writer, response
+        raise UpstreamError('All upstream proxies failed')
+
+    async def _forward(self, request, reader, writer):
+        """
+        Forward plain HTTP `request` over a pooled upstream connection.
+
+        :returns: True if the client connection can be reused
+        """
+        # Buffer request body so the request can be replayed on failover
+        body, _ = await httputil.read_body(reader, request)
+        client_keep_alive = request.keep_alive()
+        for header in HOP_BY_HOP_HEADERS:
+            request.remove_header(header)
+        request.set_header('Connection', 'keep-alive')
+
+        try:
+            upstream, up_reader, up_writer, response = await self._upstream_request(
+                request.to_bytes() + body, request.method)
+        except UpstreamError as e:
+            await self._send_error(writer, 502, str(e))
+            return False
+
+        upstream_keep_alive = response.keep_alive()
+        writer.write(response.to_bytes())
+        try:
+            reusable = await httputil.relay_body(up_reader, writer.write, response, request.method,
+                                                 drain=writer.drain)
+            await writer.drain()
+        except (httputil.HTTPError, OSError) as e:
+            _logger.info('Upstream {} response failed: {}'.format(upstream, e))
+            up_writer.close()
+            return False
+
+        if reusable and upstream_keep_alive:
+            upstream.checkin(up_reader, up_writer)
+        else:
+            up_writer.close()
+        return client_keep_alive and reusable
+
+    async def _tunnel(self, request, reader, writer):
+        """
+        Open CONNECT tunnel through an upstream proxy.
+        """
+        connect = httputil.Request(
+            ('CONNECT', request.target, 'HTTP/1.1'), [('Host', request.target)])
+        try:
+            upstream, up_reader, up_writer, response = await self._upstream_request(
+                connect.to_bytes(), 'CONNECT')
+        except UpstreamError as e:
+            await self._send_error(writer, 502, str(e))
+            return
+
+        async def pipe(src, dst):
+            try:
+                while True:
+                    data = await src.read(httputil.CHUNK_SIZE)
+                    if not data:
+                        break
+                    dst.write(data)
+                    await dst.drain()
+                # Half-close, the other direction may still be sending
+                if dst.can_write_eof():
+                    dst.write_eof()
+            except OSError:
+                dst.close()
+
+        try:
+            writer.write(b'HTTP/1.1 200 Connection established\r\n\r\n')
+            await writer.drain()
+            await asyncio.gather(pipe(reader, up_writer), pipe(up_reader, writer))
+        finally:
+            up_writer.close()
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""
+Module for sharding proxy tests across processes.
+
+Each process runs its own event loop and browsers, so devtools message
+handling and result bookkeeping spread over all CPU cores.
+"""
+import asyncio
+import logging
+import multiprocessing
+import os
+import queue
+
+# Module vars
+_logger = logging.getLogger(__name__)
+
+
+def _test_shard(shard, url, kwargs, results_queue, stop_event):
+    """
+    Test `shard` in a child process, streaming results to `results_queue`.
+    """
+    # Imported here to avoid a circular import with the client module
+    from .client import AsyncClient
+
+    def on_result(result):
+        if not isinstance(result, dict):
+            _logger.warning(result)
+            return
+        results_queue.put(('result', result))
+
+    async def run():
+        async with AsyncClient() as client:
+            await client.test_proxies(shard, url, on_result=on_result,
+                                      should_stop=stop_event.is_set, **kwargs)
+
+    try:
+        asyncio.run(run())
+    finally:
+        results_queue.put(('done', os.getpid()))
+
+
+def test_proxies_in_processes(proxies, url, processes, is_success,
+                              exit_success_count=None, on_result=None, **kwargs):
+    """
+    Test `proxies` across `processes` child processes.
+
+    Proxies are dealt round-robin so every shard keeps the input
+    priority order. Results are returned in order of completion. Once
+    `exit_success_count` working proxies are found, every child stops
+    after its current batch.
+
+    Metrics and trace spans recorded in child processes are not merged
+    into the parent.
+
+    :param proxies: list of proxies
+    :param url: the URL or list of targets to test the proxies against
+    :param processes: number of child processes
+    :param is_success: callable returning True for a working result
+    :param exit_success_count: stop when number of working proxies is reached
+    :param on_result: callback receiving each result as it completes
+    :param kwargs: keyword arguments for `AsyncClient.test_proxies`
+
+    :type proxies: list of proxytools.Proxy
+    :type url: str or list
+    :type processes: int
+    :type is_success: callable
+    :type exit_success_count: int
+    :type on_result: callable
+
+    :returns: list
+    """
+    proxies = [str(p) for p in proxies]
+    shards = [proxies[i::processes] for i in range(processes)]
+    shards = [shard for shard in shards if shard]
+    # Spawn, as forking a process with a running event loop is unsafe
+    ctx = multiprocessing.get_context('spawn')
+    results_queue = ctx.Queue()
+    stop_event = ctx.Event()
+    procs = [ctx.Process(target=_test_shard,
+                         args=(shard, url if isinstance(url, list) else str(url), dict(kwargs),
+                               results_queue, stop_event))
+             for shard in shards]
+    for proc in procs:
+        proc.start()
+
+    results = []
+    status_ok_count = 0
+    running = len(procs)
+    while running:
+        try:
+            kind, val = results_queue.get(timeout=1)
+        except queue.Empty:
+            if not any(proc.is_alive() for proc in procs):
+                _logger.warning('Test processes exited without finishing')
+                break
+            continue
+        if kind == 'done':
+            running -= 1
+            continue
+        results.append(val)
+        if on_result is not None:
+            on_result(val)
+        if is_success(val):
+            status_ok_count += 1
+            if exit_success_count is not None and status_ok_count >= exit_success_count:
+                stop_event.set()
+
+    for proc in procs:
+        proc.join()
+    return results
@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+"""
+Module for per-source statistics and crawl budget allocation.
+"""
+import logging
+import random
+import time
+
+import yarl
+
+from .state import load_json, save_json
+
+# Module vars
+_logger = logging.getLogger(__name__)
+
+
+def source_key(url):
+    """
+    Return the statistics key of source `url`, its host.
+
+    :param url: the source page URL
+    :type url: str or yarl.URL
+    :returns: str
+    """
+    return yarl.URL(str(url)).host or str(url)
+
+
+class SourceStats:
+    """
+    Yield statistics of one proxy source.
+    """
+    def __init__(self, fetches=0, parsed=0, tested=0, alive=0, yield_ewma=None,
+                 last_fetch=None, last_yield=None):
+        """
+        :param fetches: pages fetched
+        :param parsed: proxies parsed from fetched pages
+        :param tested: proxies tested
+        :param alive: proxies that passed a test
+        :param yield_ewma: smoothed live proxies per fetch
+        :param last_fetch: unix time of the last fetch
+        :param last_yield: unix time live proxies were last found
+
+        :type fetches: int
+        :type parsed: int
+        :type tested: int
+        :type alive: int
+        :type yield_ewma: float
+        :type last_fetch: float
+        :type last_yield: float
+        """
+        self.fetches = fetches
+        self.parsed = parsed
+        self.tested = tested
+        self.alive = alive
+        self.yield_ewma = yield_ewma
+        self.last_fetch = last_fetch
+        self.last_yield = last_yield
+
+    def as_dict(self):
+        """
+        Return dictionary representation of object.
+
+        :returns: dict
+        """
+        return {
+            'fetches': self.fetches,
+            'parsed': self.parsed,
+            'tested': self.tested,
+            'alive': self.alive,
+            'yield_ewma': self.yield_ewma,
+            'last_fetch': self.last_fetch,
+            'last_yield': self.last_yield
+        }
+
+
+class SourceAllocator:
+    """
+    Spends fetch and test budget on the best-yielding sources.
+
+    Sources are scored by smoothed live proxies per fetch, decayed by
+    the time since they last yielded. Most of the budget goes to the
+    highest scores; a small share explores unseen sources and
+    occasionally resamples low-yield ones, so a recovered source is
+    noticed.
+    """
+    def __init__(self, path=None, alpha=0.3, explore=0.2, min_yield=1,
+                 half_life=7 * 86400, rng=None):
+        """
+        :param path: json file the statistics are persisted to
+        :param alpha: weight of the newest fetch in the smoothed yield
+        :param explore: share of the fetch budget for unseen and low-yield sources
+        :param min_yield: live proxies per fetch below which a source is low-yield
+        :param half_life: seconds without live proxies that halve a source's score
+        :param rng: random number generator used for sampling
+
+        :type path: str
+        :type alpha: float
+        :type explore: float
+        :type min_yield: float
+        :type half_life: float
+        :type rng: random.Random
+        """
+        self.path = path
+        self.alpha = alpha
+        self.explore = explore
+        self.min_yield = min_yield
+        self.half_life = half_life
+        self.rng = rng or random.Random()
+        self.stats = {}
+        self._pending = {}
+        if path:
+            for key, data in load_json(path, default={}).items():
+                self.stats[key] = SourceStats(**data)
+
+    def get(self, url):
+        """
+        Return statistics of source `url`, creating them if required.
+
+        :returns: SourceStats
+        """
+        key = source_key(url)
+        stats = self.stats.get(key)
+        if stats is None:
+            stats = self.stats[key] = SourceStats()
+        return stats
+
+    def score(self, url, now=None):
+        """
+        Return expected live proxies per fetch of source `url`.
+
+        :returns: float or None for unseen sources
+        """
+        stats = self.stats.get(source_key(url))
+        if stats is None or stats.yield_ewma is None:
+            return None
+        now = now or time.time()
+        age = now - (stats.last_yield or stats.last_fetch or now)
+        return stats.yield_ewma * 0.5 ** (age / self.half_life)
+
+    def allocate(self, urls, budget):
+        """
+        Choose up to `budget` of `urls` to fetch.
+
+        :param urls: candidate source URLs
+        :param budget: max pages to fetch
+
+        :type urls: list
+        :type budget: int
+
+        :returns: list
+        """
+        now = time.time()
+        scored = [(url, self.score(url, now)) for url in urls]
+        unseen = [url for url, score in scored if score is None]
+        known = sorted([item for item in scored if item[1] is not None], key=lambda item: -item[1])
+        good = [url for url, score in known if score >= self.min_yield]
+        low = [url for url, score in known if score < self.min_yield]
+
+        explore_n = int(round(budget * self.explore)) if unseen or low else 0
+        if good:
+            explore_n = min(explore_n, budget - 1) if budget > 1 else 0
+        chosen = good[:budget - explore_n]
+        self.rng.shuffle(unseen)
+        candidates = unseen + self.rng.sample(low, len(low))
+        chosen.extend(candidates[:budget - len(chosen)])
+        # Unused exploration slots go back to good sources
+        if len(chosen) < budget:
+            chosen.extend(good[budget - explore_n:][:budget - len(chosen)])
+        _logger.info('Allocated {} of {} sources ({} unseen, {} low-yield)'
+                     .format(len(chosen), len(urls), len(unseen), len(low)))
+        return chosen
+
+    def allocate_tests(self, proxies, budget):
+        """
+        Return up to `budget` of `proxies`, best-yielding sources first.
+
+        :param proxies: scraped proxies with `source` set
+        :param budget: max proxies to test
+
+        :type proxies: list of proxytools.Proxy
+        :type budget: int
+
+        :returns: list of proxytools.Proxy
+        """
+        now = time.time()
+
+        def key(proxy):
+            score = self.score(proxy.source, now) if proxy.source else None
+            # Unseen sources rank between good and low-yield ones
+            return -(score if score is not None else self.min_yield)
+
+        return sorted(proxies, key=key)[:budget]
+
+    def record_fetch(self, url, parsed):
+        """
+        Record a fetch of source `url` yielding `parsed` proxies.
+
+        :param url: the source page URL
+        :param parsed: number of proxies parsed from the page
+
+        :type url: str
+        :type parsed: int
+        """
+        stats = self.get(url)
+        stats.fetches += 1
+        stats.parsed += parsed
+        stats.last_fetch = time.time()
+        # Pages sharing a host add up to one yield for the host
+        pending = self._pending.setdefault(source_key(url), {'parsed': 0, 'tested': 0, 'alive': 0})
+        pending['parsed'] += parsed
+
+    def record_test(self, source, success):
+        """
+        Record a test of a proxy scraped from `source`.
+
+        :param source: the source host
+        :param success: the test passed
+
+        :type source: str
+        :type success: bool
+        """
+        stats = self.get(source)
+        stats.tested += 1
+        if success:
+            stats.alive += 1
+            stats.last_yield = time.time()
+        pending = self._pending.get(source_key(source))
+        if pending is not None:
+            pending['tested'] += 1
+            pending['alive'] += int(success)
+
+    def commit(self):
+        """
+        Fold live proxies found since the last fetches into the smoothed
+        yields.
+
+        When only some of a source's proxies were tested, its yield is
+        extrapolated from the tested share. Sources with no tests are left
+        out, except that sources whose pages were empty count as zero yield.
+        """
+        for key, pending in self._pending.items():
+            if pending['tested']:
+                page_yield = pending['alive'] / pending['tested'] * max(pending['parsed'], pending['tested'])
+            elif pending['parsed'] == 0:
+                page_yield = 0.0
+            else:
+                continue
+            stats = self.stats[key]
+            if stats.yield_ewma is None:
+                stats.yield_ewma = page_yield
+            else:
+                stats.yield_ewma = self.alpha * page_yield + (1 - self.alpha) * stats.yield_ewma
+        self._pending = {}
+
+    def save(self):
+        """
+        Persist statistics to `self.path`.
+        """
+        if self.path:
+            save_json(self.path, {key: stats.as_dict() for key, stats in self.stats.items()})
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""
+Module for persisting proxytools state between runs.
+"""
+import json
+import logging
+import os
+import tempfile
+
+# Module vars
+_logger = logging.getLogger(__name__)
+
+
+def state_dir():
+    """
+    Return the proxytools state directory, creating it if required.
+
+    Defaults to `~/.proxytools` and can be overridden with the
+    PROXYTOOLS_HOME environment variable.
+
+    :returns: str
+    """
+    path = os.environ.get('PROXYTOOLS_HOME',
+                          os.path.join(os.path.expanduser('~'), '.proxytools'))
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def state_path(name):
+    """
+    Return path of state file `name`.
+
+    :param name: the file name
+    :type name: str
+    :returns: str
+    """
+    return os.path.join(state_dir(), name)
+
+
+def load_json(path, default=None):
+    """
+    Load json from `path`, returning `default` if missing or corrupt.
+
+    :param path: the file path
+    :param default: value returned when file can't be read
+
+    :type path: str
+
+    :returns: object
+    """
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return default
+    except ValueError:
+        _logger.warning('Ignoring corrupt state file: {}'.format(path))
+        return default
+
+
+def save_json(path, data):
+    """
+    Atomically write `data` as json to `path`.
+
+    :param path: the file path
+    :param data: json serialisable data
+
+    :type path: str
+    """
+    dirname = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=dirname, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+    except:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
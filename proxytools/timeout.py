@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""
+Module for adaptive proxy test timeouts.
+"""
+import collections
+import logging
+import math
+
+from .state import load_json, save_json
+
+# Module vars
+_logger = logging.getLogger(__name__)
+
+
+class LatencyHistory:
+    """
+    Rolling window of successful page load latencies.
+    """
+    def __init__(self, maxlen=500, path=None):
+        """
+        :param maxlen: max number of samples kept
+        :param path: json file the samples are persisted to
+
+        :type maxlen: int
+        :type path: str
+        """
+        self.path = path
+        self.samples = collections.deque(maxlen=maxlen)
+        if path:
+            self.samples.extend(load_json(path, default=[]))
+
+    def __len__(self):
+        return len(self.samples)
+
+    def record(self, seconds):
+        """
+        Add a latency sample.
+
+        :param seconds: the page load latency
+        :type seconds: float
+        """
+        self.samples.append(seconds)
+
+    def percentile(self, pct):
+        """
+        Return the `pct` percentile of recorded samples.
+
+        :param pct: percentile [0-100]
+        :type pct: float
+        :returns: float
+        :raises: ValueError
+        """
+        if not self.samples:
+            raise ValueError('No latency samples recorded')
+        ordered = sorted(self.samples)
+        idx = int(math.ceil(pct / 100 * len(ordered))) - 1
+        return ordered[max(0, min(idx, len(ordered) - 1))]
+
+    def save(self):
+        """
+        Persist samples to `self.path`.
+        """
+        if self.path:
+            save_json(self.path, list(self.samples))
+
+
+class AdaptiveTimeout:
+    """
+    Per-proxy timeout policy.
+
+    The base timeout tracks a high percentile of historical successful
+    loads, falling back to the static `timeout` until enough samples
+    exist. A TCP connect probe then caps it, since a proxy with a slow
+    handshake can't load a page quickly either.
+    """
+    def __init__(self, timeout=10, min_timeout=2, max_timeout=None,
+                 probe_timeout=2, rtt_multiplier=40, percentile=95,
+                 headroom=1.5, min_samples=20, history=None):
+        """
+        :param timeout: static timeout used without history
+        :param min_timeout: lower bound for any timeout
+        :param max_timeout: upper bound for any timeout (defaults to `timeout`)
+        :param probe_timeout: seconds to wait for the connect probe
+        :param rtt_multiplier: timeout allowed per second of connect RTT
+        :param percentile: historical latency percentile to track
+        :param headroom: multiplier applied to the historical percentile
+        :param min_samples: samples required before history is used
+        :param history: historical latencies
+
+        :type timeout: float
+        :type min_timeout: float
+        :type max_timeout: float
+        :type probe_timeout: float
+        :type rtt_multiplier: float
+        :type percentile: float
+        :type headroom: float
+        :type min_samples: int
+        :type history: LatencyHistory
+        """
+        self.timeout = timeout
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout or timeout
+        self.probe_timeout = probe_timeout
+        self.rtt_multiplier = rtt_multiplier
+        self.percentile = percentile
+        self.headroom = headroom
+        self.min_samples = min_samples
+        self.history = history if history is not None else LatencyHistory()
+
+    def base_timeout(self):
+        """
+        Return timeout before connect probe adjustment.
+
+        :returns: float
+        """
+        if len(self.history) < self.min_samples:
+            return self.timeout
+        return self.history.percentile(self.percentile) * self.headroom
+
+    def timeout_for(self, rtt=None):
+        """
+        Return timeout for a proxy with connect round trip `rtt`.
+
+        :param rtt: seconds taken to connect to the proxy
+        :type rtt: float
+        :returns: float
+        """
+        timeout = self.base_timeout()
+        if rtt is not None:
+            timeout = min(timeout, rtt * self.rtt_multiplier)
+        return max(self.min_timeout, min(timeout, self.max_timeout))
+
+    def record(self, seconds):
+        """
+        Record a successful page load latency.
+
+        :param seconds: the page load latency
+        :type seconds: float
+        """
+        self.history.record(seconds)
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+Module for span tracing in Chrome trace-event format.
+
+Traces open in chrome://tracing or https://ui.perfetto.dev.
+"""
+import asyncio
+import contextlib
+import json
+import logging
+import os
+import threading
+import time
+import weakref
+
+# Module vars
+_logger = logging.getLogger(__name__)
+
+
+class Tracer:
+    """
+    Records timed spans.
+
+    Each asyncio task gets its own track so concurrent spans nest
+    correctly in the trace viewer.
+    """
+    def __init__(self, enabled=False):
+        """
+        :param enabled: record spans
+        :type enabled: bool
+        """
+        self.enabled = enabled
+        self.events = []
+        self._origin = time.perf_counter()
+        # Weakly keyed, as task and thread ids are reused once they are collected
+        self._tids = weakref.WeakKeyDictionary()
+        self._next_tid = 1
+        self._lock = threading.Lock()
+
+    def _tid(self):
+        """
+        Return track id for the current asyncio task or thread.
+        """
+        try:
+            task = asyncio.current_task()
+        except RuntimeError:
+            task = None
+        key = task if task is not None else threading.current_thread()
+        with self._lock:
+            tid = self._tids.get(key)
+            if tid is None:
+                tid = self._next_tid
+                self._next_tid += 1
+                self._tids[key] = tid
+                self.events.append({
+                    'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': tid,
+                    'args': {'name': task.get_name() if task is not None else 'main'}})
+            return tid
+
+    @contextlib.contextmanager
+    def span(self, name, **args):
+        """
+        Context manager timing the enclosed block as span `name`.
+
+        :param name: the span name
+        :param args: extra values shown with the span
+
+        :type name: str
+        """
+        if not self.enabled:
+            yield
+            return
+        tid = self._tid()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            event = {
+                'name': name,
+                'ph': 'X',
+                'ts': (start - self._origin) * 1e6,
+                'dur': (end - start) * 1e6,
+                'pid': os.getpid(),
+                'tid': tid,
+            }
+            if args:
+                event['args'] = {k: str(v) for k, v in args.items()}
+            with self._lock:
+                self.events.append(event)
+
+    def dump(self, path):
+        """
+        Write recorded spans as a Chrome trace-event json file.
+
+        :param path: the file path
+        :type path: str
+        """
+        with self._lock:
+            events = list(self.events)
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+        _logger.info('Wrote {} trace events to {}'.format(len(events), path))
+
+
+# Default tracer shared by clients and the command line, disabled until
+# tracing is requested
+TRACER = Tracer()
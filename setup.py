@@ -18,6 +18,7 @@ setup(
     url='https://github.com/lukemaxwell/proxytools',
     license=license,
     packages=['proxytools'],
+    python_requires='>=3.11',
     entry_points = {
         'console_scripts': ['proxytools=proxytools.cli:cli'],
     },